@@ -0,0 +1,327 @@
+# Micro-benchmarks do backend. Uso (na pasta backend/):
+#   python benchmarks.py render [--modulo contestacao|contestacao_v1] [--paginas 10] [--repeticoes 200]
+#   python benchmarks.py geracao [--paginas 8] [--caracteres-por-segundo 600] [--real --pdf peticao.pdf]
+#   python benchmarks.py citacoes [--paginas 10] [--repeticoes 200]
+#   python benchmarks.py resumos [--paginas-processo 400] [--caracteres-entrada-por-segundo 200000]
+#   python benchmarks.py avaliacao [--variantes avaliacao/variantes.json] [--gravar] [--detalhes]
+import argparse
+import importlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import types
+
+os.environ.setdefault('GEMINI_API_KEY', 'benchmark') # Nenhuma chamada à IA é feita pelos benchmarks
+
+
+def gerar_minuta_sintetica(paginas=10, linhas_por_pagina=35):
+    # Aproxima uma contestação real: títulos em negrito, parágrafos longos e alguns caracteres a escapar
+    linhas = []
+    for pagina in range(paginas):
+        linhas.append(f"**{pagina + 1}. DA FUNDAMENTAÇÃO JURÍDICA - TÓPICO {pagina + 1}**")
+        for linha in range(linhas_por_pagina - 1):
+            linhas.append(
+                f"Conforme o art. 257, § 7º do CTB, a **presunção de responsabilidade** do proprietário <linha {linha}> "
+                "somente é afastada por prova idônea & robusta, o que não ocorreu nos autos."
+            )
+    return "\n".join(linhas)
+
+
+def medir(funcao, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    return (time.perf_counter() - inicio) / repeticoes * 1000
+
+
+def bench_render(args):
+    modulo = importlib.import_module(args.modulo)
+    gerador = modulo.HTMLGenerator
+    minuta = gerar_minuta_sintetica(args.paginas)
+    minuta_data = {"CONTESTAÇÃO COMPLETA": minuta}
+
+    def formatar_sem_cache():
+        gerador._format_cache.clear()
+        gerador.format_text_for_html(minuta)
+
+    with modulo.app.test_request_context('/'):
+        print(f"Minuta sintética: {args.paginas} páginas, {len(minuta)} caracteres ({args.modulo})")
+        print(f"format_text_for_html sem cache: {medir(formatar_sem_cache, args.repeticoes):.3f} ms/requisição")
+        print(f"format_text_for_html com cache: {medir(lambda: gerador.format_text_for_html(minuta), args.repeticoes):.3f} ms/requisição")
+        print(f"generate_page completo (cache quente): {medir(lambda: gerador.generate_page(minuta_data=minuta_data), args.repeticoes):.3f} ms/requisição")
+
+
+class ModeloSimulado:
+    # Latência ~ tempo até o primeiro token + caracteres emitidos / velocidade de emissão, como num modelo real
+    def __init__(self, caracteres_totais, caracteres_por_segundo, latencia_inicial):
+        self.caracteres_totais = caracteres_totais
+        self.caracteres_por_segundo = caracteres_por_segundo
+        self.latencia_inicial = latencia_inicial
+
+    def generate_content(self, contents, generation_config=None):
+        prompt = contents[0]
+        secao = re.search(r"REDIGIR APENAS A SEÇÃO (\S+)", prompt)
+        if "APENAS O PLANO" in prompt:
+            texto = "FATOS ESSENCIAIS E DISTRIBUIÇÃO DOS ARGUMENTOS. " * 30
+        elif secao:
+            texto = gerar_minuta_sintetica(1, linhas_por_pagina=1) + "\n" + "Parágrafo da seção. " * (self.caracteres_totais // 6 // 20)
+        else:
+            texto = "Parágrafo da minuta. " * (self.caracteres_totais // 21)
+        time.sleep(self.latencia_inicial + len(texto) / self.caracteres_por_segundo)
+        parte = types.SimpleNamespace(text=texto)
+        candidato = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[parte]))
+        return types.SimpleNamespace(prompt_feedback=None, candidates=[candidato])
+
+
+def bench_geracao(args):
+    modulo = importlib.import_module("contestacao")
+    if args.real:
+        if not modulo.gemini_pool_instance:
+            raise SystemExit("Modelo Gemini não carregado: defina GEMINI_API_KEY com uma chave válida.")
+        with open(args.pdf, "rb") as fh:
+            texto, erro = modulo.PDFProcessor.extract_text_from_bytes(os.path.basename(args.pdf), fh.read())
+        if erro:
+            raise SystemExit(erro)
+        gerador = modulo.MinutaGenerator(modulo.gemini_pool_instance)
+    else:
+        caracteres = len(gerar_minuta_sintetica(args.paginas))
+        gerador = modulo.MinutaGenerator(ModeloSimulado(caracteres, args.caracteres_por_segundo, args.latencia_inicial))
+        texto = gerar_minuta_sintetica(2)
+        print(f"Modelo simulado: minuta de {args.paginas} páginas ({caracteres} caracteres), "
+              f"{args.caracteres_por_segundo} caracteres/s, {args.latencia_inicial}s até o primeiro token")
+
+    for modo in ("unica", "secoes"):
+        inicio = time.perf_counter()
+        minuta = gerador.generate_minuta(texto, mode=modo)
+        duracao = time.perf_counter() - inicio
+        print(f"Modo '{modo}': {duracao:.2f} s, {len(minuta)} caracteres{' (ERRO: ' + minuta[:80] + ')' if minuta.startswith('Erro') else ''}")
+
+
+class ModeloContador(ModeloSimulado):
+    # Além da latência de emissão, cobra a leitura do prompt e conta tokens (~4 caracteres por token)
+    def __init__(self, caracteres_totais, caracteres_por_segundo, latencia_inicial, caracteres_entrada_por_segundo):
+        super().__init__(caracteres_totais, caracteres_por_segundo, latencia_inicial)
+        self.caracteres_entrada_por_segundo = caracteres_entrada_por_segundo
+        self.lock = threading.Lock()
+        self.zerar()
+
+    def zerar(self):
+        self.chamadas, self.tokens_entrada, self.tokens_saida = 0, 0, 0
+
+    def generate_content(self, contents, generation_config=None):
+        prompt = contents[0]
+        if "RESUMO ESTRUTURADO" in prompt:
+            texto = "DOCUMENTO: extrato. FATOS E DATAS: notificação em 10/01/2024. " * 40
+            time.sleep(self.latencia_inicial + len(texto) / self.caracteres_por_segundo)
+            parte = types.SimpleNamespace(text=texto)
+            resposta = types.SimpleNamespace(prompt_feedback=None, candidates=[
+                types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[parte]))])
+        else:
+            resposta = super().generate_content(contents, generation_config)
+        time.sleep(len(prompt) / self.caracteres_entrada_por_segundo)
+        with self.lock:
+            self.chamadas += 1
+            self.tokens_entrada += len(prompt) // 4
+            self.tokens_saida += len(resposta.candidates[0].content.parts[0].text) // 4
+        return resposta
+
+
+def gerar_processo_sintetico(paginas, caracteres_por_pagina=2500):
+    # Petição curta seguida de anexos longos (extratos, processo administrativo), no formato de PDFProcessor.extract_pages
+    pagina = "Lançamento de pontuação referente ao auto de infração, com notificação e prazo para defesa prévia. "
+    blocos = ["=== ARQUIVO: peticao.pdf ===\n" + gerar_minuta_sintetica(2, linhas_por_pagina=20) + "\n"]
+    for arquivo in range(4):
+        texto = "".join(f"--- Pág {i + 1} ---\n{(pagina * (caracteres_por_pagina // len(pagina) + 1))[:caracteres_por_pagina]}\n\n"
+                        for i in range(paginas // 4))
+        blocos.append(f"=== ARQUIVO: anexo_{arquivo + 1}.pdf ===\n{texto}\n")
+    return "".join(blocos)
+
+
+def bench_resumos(args):
+    modulo = importlib.import_module("contestacao")
+    processo = gerar_processo_sintetico(args.paginas_processo)
+    caracteres = len(gerar_minuta_sintetica(args.paginas))
+    modelo = ModeloContador(caracteres, args.caracteres_por_segundo, args.latencia_inicial, args.caracteres_entrada_por_segundo)
+    cache = modulo.DocumentDigestCache(os.path.join(tempfile.mkdtemp(), "resumos.sqlite3"))
+    gerador = modulo.MinutaGenerator(modelo, digest_cache=cache)
+    print(f"Processo sintético: {args.paginas_processo} páginas, {len(processo)} caracteres; minuta de {args.paginas} páginas; "
+          f"leitura de {args.caracteres_entrada_por_segundo} caracteres/s e emissão de {args.caracteres_por_segundo} caracteres/s")
+    for rotulo, map_reduce in (("direto", False), ("map-reduce (cache vazio)", True), ("map-reduce (cache quente)", True)):
+        modelo.zerar()
+        inicio = time.perf_counter()
+        minuta = gerador.generate_minuta(processo, mode="unica", map_reduce=map_reduce)
+        duracao = time.perf_counter() - inicio
+        print(f"{rotulo}: {duracao:.2f} s, {modelo.chamadas} chamadas, {modelo.tokens_entrada} tokens de entrada, "
+              f"{modelo.tokens_saida} tokens de saída{' (ERRO: ' + minuta[:80] + ')' if minuta.startswith('Erro') else ''}")
+
+
+CITACOES_SINTETICAS = (
+    "Nos termos dos arts. 280 e 281 do CTB, da Resolução CONTRAN nº 918/2022 e da Súmula 312 do STJ "
+    "(REsp 1.234.567/MS; AgInt no AREsp 765.432/SP), bem como do art. 489 do CPC e do art. 165-A do Código de Trânsito Brasileiro."
+)
+
+
+def bench_citacoes(args):
+    modulo = importlib.import_module("contestacao")
+    verificador = modulo.CitationChecker.load_if_available(modulo.CITATION_INDEX_PATH)
+    if not verificador:
+        raise SystemExit(f"Índice de citações não encontrado em '{modulo.CITATION_INDEX_PATH}'.")
+    # Uma citação a cada parágrafo, mais algumas inválidas para exercitar os avisos
+    paragrafos = gerar_minuta_sintetica(args.paginas).split("\n")
+    minuta = "\n".join(p + " " + CITACOES_SINTETICAS if i % 5 == 0 else p for i, p in enumerate(paragrafos))
+    minuta += "\nO art. 400 do CTB, a Súmula 999/STJ e a Resolução CONTRAN 1.918/2022 são citações a conferir."
+    problemas = verificador.check(minuta)
+    print(f"Minuta sintética: {args.paginas} páginas, {len(minuta)} caracteres, {len(problemas)} citações a conferir")
+    print(f"CitationChecker.check: {medir(lambda: verificador.check(minuta), args.repeticoes):.3f} ms/minuta")
+
+
+PASTA_AVALIACAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "avaliacao")
+ANONIMIZACAO = (
+    (re.compile(r"\b\d{7}-?\d{2}\.?\d{4}\.?\d\.?\d{2}\.?\d{4}\b"), "0000000-00.0000.0.00.0000"), # Número CNJ, antes de CPF e CNPJ
+    (re.compile(r"\b\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2}\b"), "00.000.000/0000-00"), # CNPJ antes do CPF
+    (re.compile(r"\b\d{3}\.?\d{3}\.?\d{3}-?\d{2}\b"), "000.000.000-00"),
+    (re.compile(r"\b[A-Z]{3}-?\d[A-Z0-9]\d{2}\b"), "AAA0A00"), # Placas (padrão antigo e Mercosul)
+    (re.compile(r"(RENAVAM\D{0,20})\d{9,11}", re.IGNORECASE), r"\g<1>00000000000"),
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"), "email@exemplo.com"),
+    (re.compile(r"\(?\b\d{2}\)?\s?9?\d{4}-\d{4}\b"), "(00) 00000-0000"),
+)
+
+
+def anonimizar(texto):
+    # Mascara identificadores; nomes de pessoas precisam ser trocados à mão antes de o arquivo entrar no corpus
+    for padrao, substituto in ANONIMIZACAO:
+        texto = padrao.sub(substituto, texto)
+    return texto
+
+
+def carregar_corpus(pasta):
+    corpus = []
+    for nome in sorted(os.listdir(pasta)):
+        if nome.endswith(".txt"):
+            with open(os.path.join(pasta, nome), "r", encoding="utf-8") as fh:
+                corpus.append((nome[:-4], anonimizar(fh.read())))
+    return corpus
+
+
+def latencia_simulada(chamadas, workers):
+    # Resumos e seções rodam em paralelo (ondas de até `workers` chamadas); as demais etapas são sequenciais
+    paralelas = {}
+    total = 0.0
+    for chamada in chamadas:
+        etapa = chamada["etapa"].split(" ")[0]
+        if etapa in ("resumo", "secao"):
+            paralelas.setdefault(etapa, []).append(chamada["latenciaMs"])
+        else:
+            total += chamada["latenciaMs"]
+    for etapa, latencias in paralelas.items():
+        latencias.sort(reverse=True)
+        total += sum(latencias[i] for i in range(0, len(latencias), workers[etapa]))
+    return total / 1000
+
+
+def bench_avaliacao(args):
+    modulo = importlib.import_module("contestacao")
+    corpus = carregar_corpus(args.corpus)
+    with open(args.variantes, "r", encoding="utf-8") as fh:
+        variantes = json.load(fh)
+    if not corpus:
+        raise SystemExit(f"Nenhuma petição (.txt) em '{args.corpus}'.")
+    if args.gravar and not modulo.gemini_pool_instance:
+        raise SystemExit("Modelo Gemini não carregado: defina GEMINI_API_KEY com uma chave válida para gravar.")
+    workers = {"resumo": modulo.MAP_REDUCE_WORKERS, "secao": modulo.SECTION_GENERATION_WORKERS}
+    modulo.logger.setLevel(logging.CRITICAL) # Chamadas sem gravação interrompem a avaliação com a lista do que falta, não com tracebacks no log
+    print(f"Corpus: {len(corpus)} petições em '{args.corpus}'; {len(variantes)} variantes; "
+          f"{'GRAVANDO com o Gemini (consome cota da API)' if args.gravar else 'reprodução offline dos cassetes'}")
+
+    for variante in variantes:
+        nome_modelo = variante.get("modelo", modulo.TARGET_MODEL_NAME_BASE)
+        caminho = os.path.join(args.cassetes, f"{variante.get('cassete', nome_modelo)}.jsonl")
+        registro = modulo.PromptRegistry(variante.get("prompts_dir", modulo.PROMPTS_DIR), pinned_versions=variante.get("versoes"))
+        modelo_real = modulo.genai.GenerativeModel(nome_modelo) if args.gravar else None
+        cassete = modulo.ModelCassette(caminho, model=modelo_real, model_name=nome_modelo, prefill_ms_per_1k_tokens=args.ms_por_mil_tokens_entrada)
+        gerador = modulo.MinutaGenerator(cassete, legal_index=modulo.legal_index_instance, prompt_registry=registro)
+        preco_entrada = variante.get("preco_entrada", modulo.USAGE_PRICE_INPUT_PER_MTOK)
+        preco_saida = variante.get("preco_saida", modulo.USAGE_PRICE_OUTPUT_PER_MTOK)
+        resultados = []
+        for caso, texto in corpus:
+            cassete.case_id = caso
+            minuta = gerador.generate_minuta(texto, mode=variante.get("modo", "unica"), map_reduce=variante.get("map_reduce"))
+            chamadas = [c for c in cassete.calls if c["caso"] == caso]
+            template = registro.classify(texto)[0]
+            problemas = [f"seção ausente: {titulo}" for titulo in template.missing_headings(minuta)] if not minuta.startswith("Erro") else [minuta[:200]]
+            if modulo.MinutaGenerator.is_truncated(minuta): problemas.append("texto incompleto (MAX_TOKENS)")
+            if not minuta.startswith("Erro") and "deferimento" not in minuta.lower(): problemas.append("sem fecho")
+            resultados.append({"caso": caso, "modelo": template.key, "chamadas": chamadas, "problemas": problemas,
+                               "latencia": latencia_simulada(chamadas, workers), "caracteres": len(minuta)})
+
+        chamadas = [c for r in resultados for c in r["chamadas"]]
+        faltantes = sorted({f"{c['caso']} ({c['etapa']})" for c in chamadas if c["reproducao"] == "sem_gravacao"})
+        if faltantes:
+            raise SystemExit(f"Variante '{variante['nome']}': cassete {caminho} sem gravação de {', '.join(faltantes)}. "
+                             f"Grave a variante com --gravar antes de compará-la.")
+        reproducao = {tipo: sum(1 for c in chamadas if c["reproducao"] == tipo) for tipo in ("gravada", "exata", "aproximada")}
+        tokens_entrada = sum(c["tokensEntrada"] for c in chamadas)
+        tokens_saida = sum(c["tokensSaida"] for c in chamadas)
+        latencias = [r["latencia"] for r in resultados]
+        print(f"\nVariante '{variante['nome']}' ({nome_modelo}, modo {variante.get('modo', 'unica')}, cassete {os.path.basename(caminho)})")
+        print(f"  chamadas: {len(chamadas)} ({', '.join(f'{n} {tipo}' for tipo, n in reproducao.items() if n)})")
+        print(f"  tokens de entrada: {tokens_entrada} ({tokens_entrada // len(corpus)} por caso); tokens de saída: {tokens_saida} "
+              f"({tokens_saida // len(corpus)} por caso); custo estimado: US$ {(tokens_entrada * preco_entrada + tokens_saida * preco_saida) / 1_000_000:.4f}")
+        print(f"  latência {'medida' if args.gravar else 'simulada'}: média {sum(latencias) / len(latencias):.1f} s, máxima {max(latencias):.1f} s por caso")
+        print(f"  estrutura completa em {sum(1 for r in resultados if not r['problemas'])}/{len(resultados)} casos")
+        for resultado in resultados:
+            if args.detalhes or resultado["problemas"]:
+                print(f"    {resultado['caso']} ({resultado['modelo']}): {len(resultado['chamadas'])} chamadas, {resultado['latencia']:.1f} s, "
+                      f"{resultado['caracteres']} caracteres{'; ' + '; '.join(resultado['problemas']) if resultado['problemas'] else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks do gerador de contestações.")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    render = subparsers.add_parser("render", help="Tempo de renderização HTML de uma minuta longa.")
+    render.add_argument("--modulo", default="contestacao", choices=["contestacao", "contestacao_v1"])
+    render.add_argument("--paginas", type=int, default=10)
+    render.add_argument("--repeticoes", type=int, default=200)
+    render.set_defaults(func=bench_render)
+
+    geracao = subparsers.add_parser("geracao", help="Latência da geração em chamada única versus por seções em paralelo.")
+    geracao.add_argument("--paginas", type=int, default=8, help="Tamanho da minuta simulada.")
+    geracao.add_argument("--caracteres-por-segundo", type=int, default=600, help="Velocidade de emissão do modelo simulado.")
+    geracao.add_argument("--latencia-inicial", type=float, default=1.0, help="Segundos até o primeiro token no modelo simulado.")
+    geracao.add_argument("--real", action="store_true", help="Usa o Gemini de verdade (consome cota da API).")
+    geracao.add_argument("--pdf", help="Petição usada com --real.")
+    geracao.set_defaults(func=bench_geracao)
+
+    resumos = subparsers.add_parser("resumos", help="Tokens e latência do modo direto versus map-reduce num processo longo.")
+    resumos.add_argument("--paginas-processo", type=int, default=400, help="Páginas do processo sintético.")
+    resumos.add_argument("--paginas", type=int, default=3, help="Tamanho da minuta simulada.")
+    resumos.add_argument("--caracteres-por-segundo", type=int, default=600, help="Velocidade de emissão do modelo simulado.")
+    resumos.add_argument("--caracteres-entrada-por-segundo", type=int, default=200000, help="Velocidade de leitura do prompt no modelo simulado.")
+    resumos.add_argument("--latencia-inicial", type=float, default=1.0, help="Segundos até o primeiro token no modelo simulado.")
+    resumos.set_defaults(func=bench_resumos)
+
+    citacoes = subparsers.add_parser("citacoes", help="Tempo da conferência de citações de uma minuta longa.")
+    citacoes.add_argument("--paginas", type=int, default=10)
+    citacoes.add_argument("--repeticoes", type=int, default=200)
+    citacoes.set_defaults(func=bench_citacoes)
+
+    avaliacao = subparsers.add_parser("avaliacao", help="Tokens, latência e estrutura das minutas de variantes de prompt/modelo sobre um corpus fixo.")
+    avaliacao.add_argument("--corpus", default=os.path.join(PASTA_AVALIACAO, "corpus"), help="Pasta com as petições anonimizadas (.txt).")
+    avaliacao.add_argument("--variantes", default=os.path.join(PASTA_AVALIACAO, "variantes.json"))
+    avaliacao.add_argument("--cassetes", default=os.path.join(PASTA_AVALIACAO, "cassetes"), help="Pasta dos cassetes (um por modelo).")
+    avaliacao.add_argument("--gravar", action="store_true", help="Chama o Gemini de verdade e grava as respostas nos cassetes.")
+    avaliacao.add_argument("--ms-por-mil-tokens-entrada", type=float, default=40.0, help="Leitura do prompt na latência simulada de prompts alterados.")
+    avaliacao.add_argument("--detalhes", action="store_true", help="Mostra todos os casos, não só os com problemas.")
+    avaliacao.set_defaults(func=bench_avaliacao)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ from flask import (
     redirect,
     url_for,
     make_response,
+    send_file,
     g,
+    Request,
 )
 from flask_session import Session
 from flask_cors import CORS
@@ -19,243 +21,1249 @@ import google.generativeai as genai
 from werkzeug.utils import secure_filename
 # import tempfile # Não será mais necessário para o texto_pdfs_original na sessão
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 import html
 from markupsafe import escape
 import uuid
+import sys
+import types
+import json
+import time
+import unicodedata
+import difflib
+import hashlib
+import heapq
+import itertools
+import struct
+import sqlite3
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import zipfile
+import tempfile
+import shutil
+
+import gzip
+import cProfile
+import pstats
+import io
+import random
+import hmac
+import contextvars
+import functools
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:  # numpy é opcional: sem ele o índice jurídico local fica desativado
+    np = None
+
+try:
+    import brotli
+except ImportError:  # brotli é opcional: sem ele as respostas são comprimidas apenas com gzip
+    brotli = None
 
 # --- Configuração de Logging ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Request id da requisição corrente em todas as linhas de log (propagado às threads com contextvars)
+request_id_var = contextvars.ContextVar("request_id", default="-")
+# Sessão/usuário/caso da requisição corrente, para o registro de uso de tokens (UsageLedger); cada requisição define um dict novo
+usage_context_var = contextvars.ContextVar("usage_context", default=None)
+
+class RequestIdLogFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] - %(message)s')
+for _handler in logging.getLogger().handlers: _handler.addFilter(RequestIdLogFilter())
 logger = logging.getLogger(__name__)
 
 # --- Configuração Inicial ---
 app = Flask(__name__)
+app.secret_key = os.environ.get('FLASK_SECRET_KEY', os.urandom(32)) # Assina o cookie de ID da sessão (SESSION_USE_SIGNER)
 
 
 # --- Configuração do Flask-Session (Sessões no Lado do Servidor) ---
 app.config['SESSION_TYPE'] = 'filesystem'  # Armazena sessões no sistema de arquivos
-app.config['SESSION_FILE_DIR'] = os.path.join(os.path.dirname(__file__), '.flask_session') # Pasta para arquivos de sessão
+app.config['SESSION_FILE_DIR'] = os.getenv('SESSION_FILE_DIR', os.path.join(os.path.dirname(__file__), '.flask_session')) # Pasta para arquivos de sessão
 app.config['SESSION_PERMANENT'] = False # Sessões expiram quando o navegador fecha (ou configure lifetime)
 app.config['SESSION_USE_SIGNER'] = True # Assina o cookie de ID da sessão para segurança
 # app.config['SESSION_FILE_THRESHOLD'] = 500 # Número de arquivos de sessão antes de começar a limpar (opcional)
-Session(app) # Inicializa a extensão Flask-Session
-# Garante que o diretório de sessão exista
-os.makedirs(app.config['SESSION_FILE_DIR'], exist_ok=True)
-logger.info(f"Flask-Session configurado para usar o sistema de arquivos em: {app.config['SESSION_FILE_DIR']}")
+# Session(app) e a pasta de sessões ficam para init_app: importar o módulo não cria arquivos
 
 
 # --- Configuração do Modelo Gemini ---
-model = None
+# Só a chave é configurada na importação: os GenerativeModel são criados sob demanda pelo GeminiClientPool
 TARGET_MODEL_NAME_BASE = 'gemini-2.5-flash-preview-05-20' 
 ACTUAL_MODEL_NAME_LOADED = "NENHUM MODELO CARREGADO"
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
 try:
-    GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-    api_key_source = "variável de ambiente"
     if not GEMINI_API_KEY:
-        # Descomente e substitua pela sua chave APENAS para teste local rápido.
-        # Lembre-se dos riscos e NÃO FAÇA COMMIT desta linha com sua chave real.
-        # GEMINI_API_KEY = "SUA_CHAVE_API_REAL_AQUI_PARA_TESTE_LOCAL" 
-        # api_key_source = "hardcoded para teste"
-        # if GEMINI_API_KEY == "SUA_CHAVE_API_REAL_AQUI_PARA_TESTE_LOCAL" or not GEMINI_API_KEY:
         raise ValueError("A variável de ambiente GEMINI_API_KEY não foi definida.")
-
-    logger.info(f"GEMINI_API_KEY obtida via {api_key_source}. Configurando genai...")
+    logger.info("GEMINI_API_KEY obtida via variável de ambiente. Configurando genai...")
     genai.configure(api_key=GEMINI_API_KEY)
-
-    model_names_to_try = [TARGET_MODEL_NAME_BASE, f'models/{TARGET_MODEL_NAME_BASE}']
-    for model_name_attempt in model_names_to_try:
-        try:
-            logger.info(f"Tentando carregar modelo Gemini: '{model_name_attempt}'")
-            model = genai.GenerativeModel(model_name_attempt)
-            ACTUAL_MODEL_NAME_LOADED = model_name_attempt
-            logger.info(f"Modelo Gemini '{ACTUAL_MODEL_NAME_LOADED}' carregado.")
-            break 
-        except Exception as e:
-            logger.warning(f"Falha ao carregar modelo '{model_name_attempt}': {e}")
-            if model_name_attempt == model_names_to_try[-1]:
-                logger.error("Todas as tentativas de carregar o modelo Gemini falharam.", exc_info=True)
-                raise ValueError(f"Não foi possível carregar um modelo Gemini. Último erro: {e}")
-    if not model: raise EnvironmentError("Modelo Gemini não inicializado.")
+    ACTUAL_MODEL_NAME_LOADED = TARGET_MODEL_NAME_BASE
 except Exception as e: 
+    GEMINI_API_KEY = None
     logger.error(f"Erro Crítico na Configuração Inicial do Gemini: {e}", exc_info=True)
 
-if model: logger.info(f"Configuração final: Modelo Gemini '{ACTUAL_MODEL_NAME_LOADED}' está carregado.")
+if GEMINI_API_KEY: logger.info(f"Configuração final: Modelo Gemini '{ACTUAL_MODEL_NAME_LOADED}' configurado.")
 else: logger.critical("Configuração final: Modelo Gemini NÃO CARREGADO. Geração de minuta INDISPONÍVEL.")
 
 # --- Constantes ---
 MAX_FILES = 5
 MAX_FILE_SIZE = 10 * 1024 * 1024
+MAX_PDF_PAGES = int(os.getenv('MAX_PDF_PAGES', '1000')) # Verificado já nos primeiros bytes quando o PDF é linearizado
+# Werkzeug recusa pelo Content-Length antes de ler o corpo (margem de 1MB para os cabeçalhos do multipart)
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILES * MAX_FILE_SIZE + 1024 * 1024
 ALLOWED_EXTENSIONS = {'pdf'}
+STATIC_ASSETS_URL_PREFIX = '/assets'
+STATIC_ASSETS_MAX_AGE = 365 * 24 * 3600 # Assets versionados pelo hash podem ficar um ano em cache
+COMPRESSION_MIN_BYTES = 1024 # Respostas menores que isso não compensam a compressão
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR', os.path.join(os.path.dirname(__file__), '.upload_spool'))
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # Tamanho de cada parte no upload retomável
+UPLOAD_SPOOL_TTL_HOURS = float(os.getenv('UPLOAD_SPOOL_TTL_HOURS', '24'))
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '2')) # Threads de extração de PDFs em segundo plano
+EXTRACTION_WAIT_TIMEOUT = 120 # Segundos aguardando extrações pendentes ao gerar a minuta
+EXTRACTION_PAGE_BUDGET = int(os.getenv('EXTRACTION_PAGE_BUDGET', '80')) # Páginas extraídas por caso; as demais ficam sob demanda
+EXTRACTION_CHAR_BUDGET = int(os.getenv('EXTRACTION_CHAR_BUDGET', '400000')) # Caracteres extraídos por caso
+PREFLIGHT_SAMPLE_PAGES = 3 # Páginas lidas na varredura prévia para classificar cada arquivo
+ANNEX_HEAD_PAGES = int(os.getenv('ANNEX_HEAD_PAGES', '5')) # Páginas iniciais extraídas de anexos (extratos, prontuários...)
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR', os.path.join(os.path.dirname(__file__), '.export_cache'))
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '2')) # Threads de fundo para gerar DOCX/PDF
+EXPORT_CACHE_TTL_HOURS = float(os.getenv('EXPORT_CACHE_TTL_HOURS', '72')) # Exportações não pedidas há mais tempo são apagadas
+EXPORT_CACHE_MAX_MB = float(os.getenv('EXPORT_CACHE_MAX_MB', '500')) # Acima disso, as exportações usadas há mais tempo saem primeiro
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+LEGAL_INDEX_DIR = os.getenv('LEGAL_INDEX_DIR', os.path.join(os.path.dirname(__file__), '.legal_index'))
+LEGAL_INDEX_TOP_K = int(os.getenv('LEGAL_INDEX_TOP_K', '6'))
+LEGAL_CHUNK_CHARS = 1200 # Tamanho aproximado de cada trecho indexado
+LEGAL_SOURCE_EXTENSIONS = {'txt', 'md', 'pdf'}
+CITATION_INDEX_PATH = os.getenv('CITATION_INDEX_PATH', os.path.join(os.path.dirname(__file__), 'legal_citations.json')) # Artigos, resoluções e súmulas válidos
+CITATION_WARNINGS_MAX = 10 # Avisos de citação por minuta; o excedente é resumido num aviso só
+CASE_MEMORY_DB = os.getenv('CASE_MEMORY_DB', os.path.join(os.path.dirname(__file__), '.case_memory.sqlite3'))
+CASE_MEMORY_MIN_SIMILARITY = float(os.getenv('CASE_MEMORY_MIN_SIMILARITY', '0.3')) # Similaridade mínima para sugerir um caso anterior
+CASE_MEMORY_DRAFT_MIN_SIMILARITY = float(os.getenv('CASE_MEMORY_DRAFT_MIN_SIMILARITY', '0.6')) # Mínimo para reaproveitar a minuta como rascunho
+DUPLICATE_UPLOAD_MIN_SIMILARITY = float(os.getenv('DUPLICATE_UPLOAD_MIN_SIMILARITY', '0.9')) # Acima disso o upload é tratado como o mesmo caso
+DUPLICATE_UPLOAD_WINDOW_HOURS = float(os.getenv('DUPLICATE_UPLOAD_WINDOW_HOURS', '72'))
+PROMPTS_DIR = os.getenv('PROMPTS_DIR', os.path.join(os.path.dirname(__file__), 'prompts')) # Modelos de prompt versionados (<id>.v<N>.md)
+PROMPT_DEFAULT_TEMPLATE = os.getenv('PROMPT_DEFAULT_TEMPLATE', 'transferencia_pontos') # Usado quando o classificador não decide
+PROMPT_VERSIONS = json.loads(os.getenv('PROMPT_VERSIONS', '{}')) # Fixa versões, ex.: {"auto_infracao": 1}; ausente = mais recente
+PROMPT_CLASSIFIER_CHARS = 20000 # O classificador lê o início do texto extraído (petição e primeiras páginas)
+PROMPT_CLASSIFIER_MIN_SCORE = int(os.getenv('PROMPT_CLASSIFIER_MIN_SCORE', '3'))
+MAP_REDUCE_MIN_CHARS = int(os.getenv('MAP_REDUCE_MIN_CHARS', '300000')) # Acima disso os documentos longos são resumidos antes da geração; 0 = nunca
+MAP_REDUCE_CHUNK_CHARS = int(os.getenv('MAP_REDUCE_CHUNK_CHARS', '60000')) # Tamanho de cada trecho resumido (cortado entre páginas)
+MAP_REDUCE_VERBATIM_CHARS = int(os.getenv('MAP_REDUCE_VERBATIM_CHARS', '20000')) # Arquivos até esse tamanho seguem na íntegra
+MAP_REDUCE_WORKERS = int(os.getenv('MAP_REDUCE_WORKERS', '4')) # Resumos gerados em paralelo
+MAP_REDUCE_DIGEST_TOKENS = 6000 # Limite de saída de cada resumo (inclui os tokens de raciocínio)
+DIGEST_CACHE_DB = os.getenv('DIGEST_CACHE_DB', os.path.join(os.path.dirname(__file__), '.digest_cache.sqlite3'))
+GENERATION_MODE = os.getenv('GENERATION_MODE', 'unica') # 'unica' (uma chamada) ou 'secoes' (seções redigidas em paralelo)
+SECTION_GENERATION_WORKERS = int(os.getenv('SECTION_GENERATION_WORKERS', '6'))
+CONTINUATION_MAX_ROUNDS = int(os.getenv('CONTINUATION_MAX_ROUNDS', '3')) # Chamadas extras que continuam uma resposta cortada em MAX_TOKENS
+FAST_DRAFT_ENABLED = os.getenv('FAST_DRAFT_ENABLED', 'false').lower() == 'true' # Rascunho curto imediato + versão completa em segundo plano
+DRAFT_MAX_OUTPUT_TOKENS = int(os.getenv('DRAFT_MAX_OUTPUT_TOKENS', '8000')) # Inclui os tokens de raciocínio do modelo
+BACKGROUND_GENERATION_WORKERS = int(os.getenv('BACKGROUND_GENERATION_WORKERS', '4')) # Versões completas geradas em paralelo
+GENERATION_CONCURRENCY = int(os.getenv('GENERATION_CONCURRENCY', '4')) # Gerações simultâneas por processo; as demais esperam na fila por prazo
+GENERATION_QUEUE_TIMEOUT_S = float(os.getenv('GENERATION_QUEUE_TIMEOUT_S', '600')) # Espera máxima na fila antes de desistir com erro
+GENERATION_DEFAULT_DEADLINE_HOURS = float(os.getenv('GENERATION_DEFAULT_DEADLINE_HOURS', '72')) # Prazo presumido dos casos sem prazo conhecido
+GENERATION_INITIAL_ESTIMATE_S = 60 # Duração presumida de uma geração até haver medições (estimativa de espera)
+CONTESTACAO_PRAZO_DIAS_UTEIS = int(os.getenv('CONTESTACAO_PRAZO_DIAS_UTEIS', '30')) # 15 dias úteis em dobro (art. 183 do CPC), se a citação não disser
+GEMINI_CLIENT_POOL_SIZE = int(os.getenv('GEMINI_CLIENT_POOL_SIZE', '4')) # Clientes (canais gRPC) por processo, compartilhados por todas as threads
+GEMINI_CLIENT_WARMUP = os.getenv('GEMINI_CLIENT_WARMUP', 'true').lower() == 'true' # warm_up_gemini_clients() abre as conexões ao subir o servidor (count_tokens, sem gerar texto)
+GEMINI_KEEPALIVE_S = int(os.getenv('GEMINI_KEEPALIVE_S', '60')) # Ping HTTP/2 que mantém o canal ocioso aberto entre chamadas
+HEDGING_ENABLED = os.getenv('HEDGING_ENABLED', 'false').lower() == 'true' # Segunda chamada ao Gemini quando a primeira demora
+HEDGE_MODEL_NAME = os.getenv('HEDGE_MODEL_NAME', '') # Modelo (mais rápido) para a chamada de hedge; vazio = mesmo modelo
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '0.95')) # Percentil das latências recentes que dispara o hedge
+HEDGE_INITIAL_DELAY_S = float(os.getenv('HEDGE_INITIAL_DELAY_S', '90')) # Atraso usado até haver latências suficientes
+HEDGE_MIN_DELAY_S = float(os.getenv('HEDGE_MIN_DELAY_S', '10'))
+HEDGE_BUDGET_RATIO = float(os.getenv('HEDGE_BUDGET_RATIO', '0.1')) # Chamadas extras limitadas a 10% das chamadas principais
+HEDGE_WORKERS = 8
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '') # Habilita o cabeçalho X-Profile: <token>; os perfis são lidos em /admin/perfis (ADMIN_TOKEN)
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0')) # Fração das requisições perfiladas por amostragem
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(__file__), '.profiles'))
+PROFILE_MAX_REPORTS = int(os.getenv('PROFILE_MAX_REPORTS', '50')) # Perfis mais antigos são apagados
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'none') # 'none', 'console' (stderr) ou 'file' (linhas OTLP/JSON em TRACE_FILE)
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(os.path.dirname(__file__), 'traces.jsonl'))
+TRACE_SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'contestacao-backend')
+CASE_WORKSPACE_DB = os.getenv('CASE_WORKSPACE_DB', os.path.join(os.path.dirname(__file__), '.case_workspace.sqlite3'))
+VERSION_SNAPSHOT_INTERVAL = int(os.getenv('VERSION_SNAPSHOT_INTERVAL', '10')) # A cada N versões de um caso, uma é guardada completa
+TRUSTED_USER_HEADER = os.getenv('TRUSTED_USER_HEADER', '') # Cabeçalho com o usuário autenticado pelo proxy; vazio = identidade da sessão. Só configure se o proxy sobrescreve o cabeçalho em toda requisição
+CASE_FILES_DIR = os.getenv('CASE_FILES_DIR', os.path.join(os.path.dirname(__file__), '.case_files')) # PDFs com páginas ainda não extraídas
+USAGE_LEDGER_DB = os.getenv('USAGE_LEDGER_DB', os.path.join(os.path.dirname(__file__), '.usage_ledger.sqlite3'))
+USAGE_DAILY_TOKEN_BUDGET = int(os.getenv('USAGE_DAILY_TOKEN_BUDGET', '0')) # Tokens por usuário por dia; 0 = sem limite
+USAGE_USER_BUDGETS = json.loads(os.getenv('USAGE_USER_BUDGETS', '{}')) # Limites por usuário, ex.: {"fulano": 2000000}
+USAGE_PRICE_INPUT_PER_MTOK = float(os.getenv('USAGE_PRICE_INPUT_PER_MTOK', '0.30')) # USD por milhão de tokens de entrada
+USAGE_PRICE_OUTPUT_PER_MTOK = float(os.getenv('USAGE_PRICE_OUTPUT_PER_MTOK', '2.50')) # USD por milhão de tokens de saída
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '') # Cabeçalho X-Admin-Token dos endpoints /admin (perfis, uso, fila); vazio = /admin desativado
 # COOKIE_SAFE_LIMIT_BYTES não é mais necessário para os dados principais da sessão
 
 # --- Classes (MinutaGenerator, PDFProcessor, MinutaParser, HTMLGenerator) ---
 # (As classes permanecem as mesmas da versão anterior, pois a lógica interna delas não muda
 #  com a forma como a sessão é armazenada pelo Flask-Session)
 
-class MinutaGenerator: # Mantida como antes
-    def __init__(self, model_instance):
+class Tracer:
+    """Spans leves por requisição, exportados no formato OTLP/JSON do OpenTelemetry.
+
+    Cada span exportado é uma linha {"resourceSpans": [...]} (o mesmo formato lido pelo receptor
+    'otlpjsonfile' do OpenTelemetry Collector), gravada em TRACE_FILE ('file') ou no stderr ('console').
+    O span corrente fica num ContextVar, então tarefas enviadas a threads com contextvars.copy_context()
+    continuam no mesmo trace e com o mesmo request id nos logs.
+    """
+    TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+    def __init__(self, exporter=TRACE_EXPORTER, file_path=TRACE_FILE, service_name=TRACE_SERVICE_NAME):
+        self.exporter = exporter
+        self.file_path = file_path
+        self.service_name = service_name
+        self._current = contextvars.ContextVar("trace_span", default=None)
+        self._lock = threading.Lock()
+
+    def current_span(self):
+        return self._current.get()
+
+    def start_span(self, name, kind=1, traceparent=None, **attributes):
+        # kind segue o OTLP: 1 = INTERNAL, 2 = SERVER. Retorna (span, token) para end_span.
+        parent = self._current.get()
+        remote = self.TRACEPARENT_RE.match(traceparent or "") if not parent else None
+        span = {"traceId": parent["traceId"] if parent else (remote.group(1) if remote else os.urandom(16).hex()),
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": parent["spanId"] if parent else (remote.group(2) if remote else ""),
+                "name": name, "kind": kind, "startTimeUnixNano": time.time_ns(),
+                "attributes": dict(attributes), "status": {"code": 0}}
+        return span, self._current.set(span)
+
+    def end_span(self, span, token, error=None):
+        self._current.reset(token)
+        span["endTimeUnixNano"] = time.time_ns()
+        if error is not None: span["status"] = {"code": 2, "message": str(error)}
+        elif span["status"]["code"] == 0: span["status"] = {"code": 1}
+        self.export(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span, token = self.start_span(name, **attributes)
+        try:
+            yield span
+        except Exception as e:
+            self.end_span(span, token, error=e); raise
+        self.end_span(span, token)
+
+    @staticmethod
+    def _otlp_value(value):
+        if isinstance(value, bool): return {"boolValue": value}
+        if isinstance(value, int): return {"intValue": str(value)}
+        if isinstance(value, float): return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def to_otlp(self, span):
+        otlp_span = dict(span, startTimeUnixNano=str(span["startTimeUnixNano"]), endTimeUnixNano=str(span["endTimeUnixNano"]),
+                         attributes=[{"key": k, "value": self._otlp_value(v)} for k, v in span["attributes"].items()])
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "contestacao"}, "spans": [otlp_span]}]}]}
+
+    def export(self, span):
+        if self.exporter not in ("file", "console"):
+            return
+        try:
+            line = json.dumps(self.to_otlp(span), ensure_ascii=False)
+            with self._lock:
+                if self.exporter == "file":
+                    with open(self.file_path, 'a', encoding='utf-8') as fh: fh.write(line + "\n")
+                else:
+                    print(line, file=sys.stderr, flush=True)
+        except Exception as e:
+            logger.warning(f"Tracer: Falha ao exportar span '{span['name']}': {e}")
+
+    @staticmethod
+    def bind(fn):
+        # Executa fn em outra thread com o contexto atual (span e request id); uma cópia por tarefa
+        return functools.partial(contextvars.copy_context().run, fn)
+
+class TracedSessionInterface:
+    # Envolve a interface do Flask-Session para medir a gravação da sessão como um span próprio
+    def __init__(self, wrapped):
+        self._wrapped = wrapped
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def save_session(self, *args, **kwargs):
+        with tracer_instance.span("sessao.gravacao"):
+            return self._wrapped.save_session(*args, **kwargs)
+
+class GeminiClientPool:
+    """Pool de clientes do Gemini por processo, compartilhado pelas rotas e pelas threads de seções, resumos e hedging.
+
+    Sem o pool, todo GenerativeModel usa o cliente global do SDK, criado sem trava na primeira chamada, e a conexão e o
+    TLS caem na primeira requisição de cada worker. Aqui cada posição tem um GenerativeModel com cliente gRPC próprio e
+    keep-alive, reaproveitado entre chamadas. Cada chamada usa a posição com menos chamadas em andamento, de preferência
+    uma já conectada; o canal HTTP/2 multiplexa as chamadas simultâneas. Um fork (gunicorn --preload) recria os
+    clientes no processo filho, já que canais gRPC não sobrevivem a ele, e um cliente com erro de conexão é descartado.
+    Nada é criado no construtor: os clientes nascem na primeira chamada ou em warm_up(), que abre as conexões com
+    count_tokens (não gera texto) e só roda quando chamado explicitamente. Métricas: conexões novas versus reaproveitadas.
+
+    O SDK não tem API pública para dar a um GenerativeModel um cliente próprio: a fábrica padrão usa a configuração
+    interna do genai e, se a versão instalada não a expuser, avisa uma vez e fica com o cliente padrão do SDK.
+    """
+    _dedicated_client_warned = False
+
+    def __init__(self, model_name, size=GEMINI_CLIENT_POOL_SIZE, model_factory=None, keepalive_s=GEMINI_KEEPALIVE_S):
+        self.model_name = model_name
+        self.size = max(1, size)
+        self.keepalive_s = keepalive_s
+        self.model_factory = model_factory or self._default_model_factory
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._slots = [None] * self.size # {"model", "usos", "emUso"}; None = cliente ainda não criado
+        self.metrics = {"chamadas": 0, "conexoesNovas": 0, "conexoesReaproveitadas": 0, "chamadasCompartilhadas": 0,
+                        "clientesCriados": 0, "clientesDescartados": 0, "aquecimentos": 0, "falhasAquecimento": 0}
+
+    def _default_model_factory(self, model_name):
+        # GenerativeModel com cliente gRPC próprio; se o SDK não permitir, fica com o cliente padrão do genai
+        model = genai.GenerativeModel(model_name)
+        try:
+            from google.ai import generativelanguage as glm
+            from google.generativeai import client as genai_client
+        except ImportError as e:
+            return self._default_client(model, f"módulos do SDK indisponíveis ({e})")
+        # Atributos internos do google-generativeai: conferidos antes do uso, já que podem mudar entre versões
+        config = getattr(getattr(genai_client, "_client_manager", None), "client_config", None)
+        if not isinstance(config, dict) or "_client" not in getattr(model, "__dict__", {}):
+            return self._default_client(model, "esta versão do SDK não expõe a configuração do cliente")
+        config = dict(config)
+        if config.get("transport", "grpc") != "grpc":
+            return model
+        try:
+            transport_class = glm.GenerativeServiceClient.get_transport_class("grpc")
+            keepalive = [("grpc.keepalive_time_ms", self.keepalive_s * 1000), ("grpc.keepalive_timeout_ms", 20000),
+                         ("grpc.keepalive_permit_without_calls", 1), ("grpc.http2.max_pings_without_data", 0)]
+
+            def create_channel(host, **kwargs):
+                kwargs["options"] = list(kwargs.get("options") or []) + keepalive
+                return transport_class.create_channel(host, **kwargs)
+            config["transport"] = lambda **kwargs: transport_class(channel=create_channel, **kwargs)
+            model._client = glm.GenerativeServiceClient(**config)
+        except Exception as e:
+            return self._default_client(model, str(e))
+        return model
+
+    @classmethod
+    def _default_client(cls, model, reason):
+        if not cls._dedicated_client_warned:
+            cls._dedicated_client_warned = True
+            logger.warning(f"GeminiClientPool: Cliente dedicado indisponível ({reason}); usando o cliente padrão do SDK.")
+        return model
+
+    def _reset_after_fork(self):
+        # Chamado com self._lock; os clientes herdados do processo pai são abandonados
+        if self._pid != os.getpid():
+            self._pid, self._slots = os.getpid(), [None] * self.size
+
+    def _slot(self, index):
+        # Chamado com self._lock
+        if self._slots[index] is None:
+            self._slots[index] = {"model": self.model_factory(self.model_name), "usos": 0, "emUso": 0}
+            self.metrics["clientesCriados"] += 1
+        return self._slots[index]
+
+    def _checkout(self):
+        with self._lock:
+            self._reset_after_fork()
+            def load(i):
+                slot = self._slots[i]
+                return (slot["emUso"], slot["usos"] == 0, slot["usos"]) if slot else (0, True, 0) # Reparte entre os conectados
+            index = min(range(self.size), key=load)
+            slot = self._slot(index)
+            self.metrics["chamadas"] += 1
+            self.metrics["conexoesReaproveitadas" if slot["usos"] else "conexoesNovas"] += 1
+            if slot["emUso"]: self.metrics["chamadasCompartilhadas"] += 1
+            slot["usos"] += 1
+            slot["emUso"] += 1
+            return index, slot
+
+    def _release(self, index, slot, error=None):
+        with self._lock:
+            slot["emUso"] -= 1
+            # UNAVAILABLE: o canal caiu; a próxima chamada nesta posição abre um cliente novo
+            if error is not None and (type(error).__name__ == "ServiceUnavailable" or "UNAVAILABLE" in str(error)) and self._slots[index] is slot:
+                self._slots[index] = None
+                self.metrics["clientesDescartados"] += 1
+
+    def generate_content(self, *args, **kwargs):
+        index, slot = self._checkout()
+        try:
+            response = slot["model"].generate_content(*args, **kwargs)
+        except Exception as e:
+            self._release(index, slot, e)
+            raise
+        self._release(index, slot)
+        return response
+
+    def warm_up(self):
+        # Conecta todas as posições em sequência; falhas só ficam nas métricas (a chamada real tenta de novo)
+        started_at = time.perf_counter()
+        for index in range(self.size):
+            with self._lock:
+                self._reset_after_fork()
+                slot = self._slot(index)
+                if slot["usos"]: continue
+                slot["usos"] += 1
+                slot["emUso"] += 1
+            try:
+                slot["model"].count_tokens("ok")
+                with self._lock: self.metrics["aquecimentos"] += 1
+            except Exception as e:
+                with self._lock: self.metrics["falhasAquecimento"] += 1
+                logger.warning(f"GeminiClientPool: Falha ao aquecer o cliente {index + 1}/{self.size}: {e}")
+                self._release(index, slot, e)
+                continue
+            self._release(index, slot)
+        logger.info(f"GeminiClientPool: {self.size} clientes de '{self.model_name}' aquecidos em {time.perf_counter() - started_at:.2f}s.")
+
+    def start_warm_up(self):
+        threading.Thread(target=self.warm_up, name="gemini-aquecimento", daemon=True).start()
+
+    def snapshot(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+            connected = sum(1 for slot in self._slots if slot and slot["usos"])
+            in_use = sum(slot["emUso"] for slot in self._slots if slot)
+        first_uses = metrics["conexoesNovas"] + metrics["conexoesReaproveitadas"]
+        return {"modelo": self.model_name, "tamanho": self.size, "conectados": connected, "emUso": in_use, **metrics,
+                "taxaReaproveitamento": round(metrics["conexoesReaproveitadas"] / first_uses, 3) if first_uses else None}
+
+class HedgedModelCaller:
+    """Chamadas ao Gemini com 'hedging' para cortar a cauda de latência (opcional, HEDGING_ENABLED=true).
+
+    Se a chamada principal não responder dentro do percentil HEDGE_PERCENTILE das latências recentes,
+    uma segunda chamada é feita (no modelo de hedge, se configurado) e vale a que terminar primeiro.
+    O SDK síncrono não interrompe uma requisição HTTP em andamento: a perdedora é cancelada se ainda
+    não começou e, caso contrário, tem o resultado descartado, mas os tokens são cobrados: `on_attempt` é
+    chamado ao fim de cada tentativa (principal ou de hedge, com ou sem erro) para registrar o uso de todas.
+    HEDGE_BUDGET_RATIO limita as chamadas extras a uma fração das últimas `window` chamadas principais.
+    """
+    def __init__(self, hedge_model=None, percentile=HEDGE_PERCENTILE, initial_delay=HEDGE_INITIAL_DELAY_S,
+                 min_delay=HEDGE_MIN_DELAY_S, budget_ratio=HEDGE_BUDGET_RATIO, window=200, min_samples=20):
+        self.hedge_model = hedge_model
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._recent = deque(maxlen=window) # [houve hedge] por chamada principal recente, para o orçamento
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="gemini-hedge")
+        self.metrics = {"chamadas": 0, "hedges": 0, "vitoriasHedge": 0, "hedgesNegadosOrcamento": 0}
+
+    def hedge_delay(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.min_samples:
+            return self.initial_delay # Sem histórico suficiente para estimar o percentil
+        return max(self.min_delay, samples[min(len(samples) - 1, int(self.percentile * len(samples)))])
+
+    def _record_latency(self, started_at):
+        def callback(future):
+            if not future.cancelled() and future.exception() is None:
+                with self._lock: self._latencies.append(time.monotonic() - started_at)
+        return callback
+
+    def _take_budget(self, slot):
+        # Janela deslizante: hedges entre as últimas chamadas principais, e o primeiro da janela é sempre permitido
+        # (contar desde o início do processo bloquearia o hedge nas primeiras 1/ratio chamadas)
+        with self._lock:
+            hedges = sum(1 for hedged in self._recent if hedged[0])
+            if self.budget_ratio <= 0 or hedges >= max(1, self.budget_ratio * len(self._recent)):
+                self.metrics["hedgesNegadosOrcamento"] += 1
+                return False
+            slot[0] = True
+            self.metrics["hedges"] += 1
+            return True
+
+    @staticmethod
+    def attempt(generate, on_attempt, hedge, **kwargs):
+        # Uma tentativa de chamada, com `on_attempt(resposta ou None, início, hedge)` ao terminar; também usada sem hedging
+        started_at = time.perf_counter()
+        try:
+            response = generate(**kwargs)
+        except Exception:
+            if on_attempt: on_attempt(None, started_at, hedge)
+            raise
+        if on_attempt: on_attempt(response, started_at, hedge)
+        return response
+
+    def call(self, model_instance, on_attempt=None, **kwargs):
+        slot = [False]
+        with self._lock:
+            self.metrics["chamadas"] += 1
+            self._recent.append(slot)
+        delay = self.hedge_delay()
+        primary = self._executor.submit(Tracer.bind(self.attempt), model_instance.generate_content, on_attempt, False, **kwargs)
+        primary.add_done_callback(self._record_latency(time.monotonic())) # Só a latência do modelo principal entra no percentil
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_budget(slot):
+            return primary.result()
+
+        logger.info(f"HedgedModelCaller: Sem resposta após {delay:.1f}s; disparando chamada de hedge.")
+        backup = self._executor.submit(Tracer.bind(self.attempt), (self.hedge_model or model_instance).generate_content, on_attempt, True, **kwargs)
+        pending, first_error = {primary, backup}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    first_error = first_error or future.exception()
+                    continue
+                for loser in pending: loser.cancel()
+                if future is backup:
+                    with self._lock: self.metrics["vitoriasHedge"] += 1
+                logger.info(f"HedgedModelCaller: Venceu a chamada {'de hedge' if future is backup else 'principal'}.")
+                return future.result()
+        raise first_error
+
+    def snapshot(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+        metrics["taxaVitoriaHedge"] = round(metrics["vitoriasHedge"] / metrics["hedges"], 3) if metrics["hedges"] else None
+        metrics["atrasoHedgeSegundos"] = round(self.hedge_delay(), 2)
+        return metrics
+
+class ModelCassette:
+    """Cassete (JSONL) de chamadas generate_content, para avaliar variantes de prompt e de modelo offline.
+
+    Com `model`, cada chamada é repassada ao modelo real e gravada: caso, etapa, hash do prompt, texto, finish reason,
+    tokens e latência. Sem `model`, as respostas são reproduzidas: vale a gravação do mesmo prompt no mesmo caso e,
+    se o prompt mudou (variante), a próxima gravação da mesma etapa, com os tokens de entrada reestimados pela razão
+    tokens/caractere gravada e a latência ajustada pela diferença de tokens a ler. Cada chamada fica em `calls`.
+    """
+    SECTION_RE = re.compile(r'^## TAREFA DESTA ETAPA: REDIGIR APENAS A SEÇÃO (\S+)$', re.MULTILINE)
+
+    def __init__(self, path, model=None, model_name=None, prefill_ms_per_1k_tokens=40.0):
+        self.path = path
+        self.model = model
+        self.model_name = model_name or ACTUAL_MODEL_NAME_LOADED
+        self.prefill_ms_per_1k_tokens = prefill_ms_per_1k_tokens # Custo de leitura do prompt na latência simulada
+        self.case_id = None # Definido por quem roda o corpus, antes de cada caso
+        self.entries = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fh:
+                self.entries = [json.loads(line) for line in fh if line.strip()]
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Nova rodada (outra variante) sobre as mesmas gravações
+        with self._lock:
+            self._used = set()
+            self.calls = []
+
+    @classmethod
+    def stage(cls, prompt):
+        # Etapa da geração, reconhecida pelos marcadores que o MinutaGenerator põe no prompt
+        if "\n## CONTINUAÇÃO DA RESPOSTA\n" in prompt: return "continuacao"
+        if "RESUMO ESTRUTURADO" in prompt[:400]: return "resumo"
+        if "\n## TAREFA DESTA ETAPA: APENAS O PLANO\n" in prompt: return "plano"
+        if "\n## TAREFA DESTA ETAPA: RASCUNHO RÁPIDO\n" in prompt: return "rascunho"
+        section = cls.SECTION_RE.search(prompt)
+        return f"secao {section.group(1)}" if section else "minuta"
+
+    def generate_content(self, contents, generation_config=None):
+        prompt = contents[0]
+        if self.model:
+            return self._record(prompt, contents, generation_config)
+        return self._replay(prompt)
+
+    def _record(self, prompt, contents, generation_config):
+        started_at = time.perf_counter()
+        response = self.model.generate_content(contents, generation_config=generation_config)
+        latency_ms = (time.perf_counter() - started_at) * 1000
+        usage = getattr(response, 'usage_metadata', None)
+        finish_reason = MinutaGenerator._finish_reason(response)
+        parts = response.candidates[0].content.parts if finish_reason is not None and response.candidates[0].content else []
+        entry = {"caso": self.case_id, "etapa": self.stage(prompt), "promptSha256": hashlib.sha256(prompt.encode('utf-8')).hexdigest(),
+                 "promptCaracteres": len(prompt), "modelo": self.model_name, "finishReason": finish_reason,
+                 "texto": "".join(getattr(part, 'text', '') for part in parts),
+                 "tokensEntrada": getattr(usage, 'prompt_token_count', 0) or 0, "tokensSaida": getattr(usage, 'candidates_token_count', 0) or 0,
+                 "latenciaMs": round(latency_ms, 1), "gravadoEm": time.time()}
+        with self._lock:
+            self.entries.append(entry)
+            self.calls.append({"caso": self.case_id, "etapa": entry["etapa"], "tokensEntrada": entry["tokensEntrada"],
+                               "tokensSaida": entry["tokensSaida"], "latenciaMs": entry["latenciaMs"], "reproducao": "gravada"})
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as fh:
+                fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return response
+
+    def _replay(self, prompt):
+        digest, stage = hashlib.sha256(prompt.encode('utf-8')).hexdigest(), self.stage(prompt)
+        with self._lock:
+            candidates = [i for i, e in enumerate(self.entries) if e["caso"] == self.case_id and i not in self._used]
+            index = next((i for i in reversed(candidates) if self.entries[i]["promptSha256"] == digest), None)
+            exact = index is not None
+            if not exact:
+                index = next((i for i in candidates if self.entries[i]["etapa"] == stage), None)
+            if index is None:
+                self.calls.append({"caso": self.case_id, "etapa": stage, "tokensEntrada": 0, "tokensSaida": 0, "latenciaMs": 0.0, "reproducao": "sem_gravacao"})
+                raise LookupError(f"Cassete '{self.path}' sem gravação da etapa '{stage}' do caso '{self.case_id}'.")
+            self._used.add(index)
+            entry = self.entries[index]
+            prompt_tokens = entry["tokensEntrada"]
+            if not exact:
+                ratio = entry["tokensEntrada"] / entry["promptCaracteres"] if entry["tokensEntrada"] and entry["promptCaracteres"] else 0.25
+                prompt_tokens = round(len(prompt) * ratio)
+            latency_ms = max(0.0, entry["latenciaMs"] + (prompt_tokens - entry["tokensEntrada"]) * self.prefill_ms_per_1k_tokens / 1000)
+            self.calls.append({"caso": self.case_id, "etapa": stage, "tokensEntrada": prompt_tokens, "tokensSaida": entry["tokensSaida"],
+                               "latenciaMs": round(latency_ms, 1), "reproducao": "exata" if exact else "aproximada"})
+        candidates = [] if entry["finishReason"] is None else [types.SimpleNamespace(
+            finish_reason=entry["finishReason"], content=types.SimpleNamespace(parts=[types.SimpleNamespace(text=entry["texto"])]))]
+        usage = types.SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=entry["tokensSaida"],
+                                      total_token_count=prompt_tokens + entry["tokensSaida"])
+        return types.SimpleNamespace(prompt_feedback=None, candidates=candidates, usage_metadata=usage, model_version=entry["modelo"])
+
+class PromptTemplate:
+    """Modelo de prompt carregado de PROMPTS_DIR: cabeçalho, blocos por seção e diretrizes.
+
+    Os prefixos estáticos (tudo o que vem antes do conteúdo do caso) são montados uma vez no carregamento.
+    """
+    BLOCK_RE = re.compile(r'^@@(cabecalho|secao [\w.]+|diretrizes)\n', re.MULTILINE)
+    HEADING_RE = re.compile(r'^#{2,4} *(?:\d+(?:\.\d+)*\.? *)?\*\*(.+?)\*\*', re.MULTILINE) # '## 2.1. **TÍTULO**' nos blocos de seção
+
+    def __init__(self, template_id, version, title, keywords, max_output_tokens, header, sections, guidelines):
+        self.id = template_id
+        self.version = version
+        self.key = f"{template_id}.v{version}"
+        self.title = title
+        self.keywords = keywords # {termo normalizado: peso}
+        self.max_output_tokens = max_output_tokens
+        self.header = header
+        self.sections = sections # ((chave, bloco), ...) na ordem da peça
+        self.guidelines = guidelines
+        self.required_headings = tuple(title for _, block in sections for title in self.HEADING_RE.findall(block))
+        self.outline_prefix = header + "".join(block for _, block in sections)
+        self.static_prefix = self.outline_prefix + guidelines
+        self.keyword_re = re.compile(r'\b(' + "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True)) + r')\b') if keywords else None
+
+    @classmethod
+    def parse(cls, raw):
+        # Arquivo: cabeçalho '---' com 'chave: valor' e blocos iniciados por '@@cabecalho', '@@secao <n>' e '@@diretrizes'
+        _, front, body = raw.split('---\n', 2)
+        meta = dict(line.split(':', 1) for line in front.strip().splitlines())
+        meta = {k.strip(): v.strip() for k, v in meta.items()}
+        keywords = {}
+        for item in filter(None, (i.strip() for i in meta.get('palavras_chave', '').split(','))):
+            term, _, weight = item.rpartition(':') if item.rpartition(':')[2].isdigit() else (item, '', '1')
+            keywords[" ".join(TextFingerprint.tokens(term))] = int(weight)
+        parts = cls.BLOCK_RE.split(body)
+        blocks = list(zip(parts[1::2], parts[2::2]))
+        return cls(meta['id'], int(meta['versao']), meta.get('titulo', meta['id']), keywords,
+                   int(meta.get('max_tokens_saida', '60000')), header="".join(b for n, b in blocks if n == 'cabecalho'),
+                   sections=tuple((n.split(' ', 1)[1], b) for n, b in blocks if n.startswith('secao ')),
+                   guidelines="".join(b for n, b in blocks if n == 'diretrizes'))
+
+    def missing_headings(self, text):
+        # Títulos de seção pedidos pelo modelo que não aparecem na minuta (sem acentos, caixa e pontuação)
+        normalized = " " + " ".join(TextFingerprint.tokens(text)) + " "
+        return [title for title in self.required_headings if f" {' '.join(TextFingerprint.tokens(title))} " not in normalized]
+
+    def score(self, normalized_text):
+        if not self.keyword_re: return 0
+        counts = Counter(self.keyword_re.findall(normalized_text))
+        return sum(min(count, 3) * self.keywords[term] for term, count in counts.items()) # Um termo repetido não decide sozinho
+
+class PromptRegistry:
+    """Modelos de prompt versionados, carregados uma vez na inicialização, e o classificador do tipo de caso.
+
+    Cada arquivo PROMPTS_DIR/<id>.v<N>.md é uma versão; vale a mais recente, salvo se PROMPT_VERSIONS fixar outra.
+    O classificador pontua as palavras-chave de cada modelo no início do texto extraído (sem chamar a IA) e, abaixo
+    de PROMPT_CLASSIFIER_MIN_SCORE, usa PROMPT_DEFAULT_TEMPLATE. Latência e tokens são acumulados por versão de modelo.
+    """
+    FILE_RE = re.compile(r'^(\w+)\.v(\d+)\.md$')
+
+    def __init__(self, prompts_dir=PROMPTS_DIR, default_id=PROMPT_DEFAULT_TEMPLATE, pinned_versions=None):
+        self.prompts_dir = prompts_dir
+        self.versions = {} # id -> {versão: PromptTemplate}
+        for filename in sorted(os.listdir(prompts_dir)):
+            if not self.FILE_RE.match(filename): continue
+            with open(os.path.join(prompts_dir, filename), 'r', encoding='utf-8') as fh:
+                template = PromptTemplate.parse(fh.read())
+            self.versions.setdefault(template.id, {})[template.version] = template
+        pinned = pinned_versions if pinned_versions is not None else PROMPT_VERSIONS
+        self.templates = {tid: versions[pinned[tid]] if pinned.get(tid) in versions else versions[max(versions)]
+                          for tid, versions in self.versions.items()}
+        if default_id not in self.templates:
+            raise ValueError(f"Modelo de prompt padrão '{default_id}' não encontrado em {prompts_dir}.")
+        self.default = self.templates[default_id]
+        self._lock = threading.Lock()
+        self._stats = {}
+        logger.info(f"PromptRegistry: {len(self.templates)} modelos carregados ({', '.join(t.key for t in self.templates.values())}).")
+
+    def get(self, template_id):
+        return self.templates.get(template_id) or self.default
+
+    def classify(self, text):
+        # Retorna (modelo escolhido, pontuações por id)
+        normalized = " ".join(TextFingerprint.tokens(text[:PROMPT_CLASSIFIER_CHARS]))
+        scores = {tid: template.score(normalized) for tid, template in self.templates.items()}
+        best = max(scores, key=lambda tid: (scores[tid], tid == self.default.id))
+        template = self.templates[best] if scores[best] >= PROMPT_CLASSIFIER_MIN_SCORE else self.default
+        logger.info(f"PromptRegistry: Caso classificado como '{template.key}' (pontuações: {scores}).")
+        return template, scores
+
+    def record(self, template, latency_ms, prompt_tokens, output_tokens, error=False, hedge=False):
+        with self._lock:
+            stats = self._stats.setdefault(template.key, {"chamadas": 0, "erros": 0, "hedges": 0, "latenciaTotalMs": 0.0, "latenciaMaxMs": 0.0,
+                                                          "tokensEntrada": 0, "tokensSaida": 0})
+            stats["chamadas"] += 1
+            stats["erros"] += int(error)
+            stats["hedges"] += int(hedge)
+            stats["latenciaTotalMs"] += latency_ms
+            stats["latenciaMaxMs"] = max(stats["latenciaMaxMs"], latency_ms)
+            stats["tokensEntrada"] += prompt_tokens
+            stats["tokensSaida"] += output_tokens
+
+    def snapshot(self):
+        with self._lock:
+            stats = {key: dict(value) for key, value in self._stats.items()}
+        result = []
+        for template in self.templates.values():
+            entry = stats.get(template.key, {"chamadas": 0})
+            calls = entry.pop("chamadas")
+            result.append({"id": template.id, "versao": template.version, "titulo": template.title, "versoesDisponiveis": sorted(self.versions[template.id]),
+                           "prefixoCaracteres": len(template.static_prefix), "maxTokensSaida": template.max_output_tokens, "chamadas": calls,
+                           **({"erros": entry["erros"], "hedges": entry["hedges"], "latenciaMediaMs": round(entry["latenciaTotalMs"] / calls, 1), "latenciaMaxMs": round(entry["latenciaMaxMs"], 1),
+                               "tokensEntradaMedia": round(entry["tokensEntrada"] / calls),
+                               "tokensSaidaMedia": round(entry["tokensSaida"] / calls)} if calls else {})})
+        return result
+
+class GenerationScheduler:
+    """Fila das gerações de minuta por prazo (earliest deadline first), com limite fixo de gerações simultâneas.
+
+    Cada geração (upload, rascunho, versão completa, ajuste) entra com o prazo da contestação do caso,
+    informado pelo usuário ou lido da citação; sem prazo conhecido vale a chegada + GENERATION_DEFAULT_DEADLINE_HOURS,
+    o que mantém a ordem de chegada entre esses casos sem deixá-los para trás indefinidamente. No máximo
+    GENERATION_CONCURRENCY gerações rodam ao mesmo tempo por processo; a posição na fila e a espera estimada
+    (pela duração média recente de cada tipo de geração) podem ser consultadas pelo id do pedido ou do caso.
+    """
+    PRAZO_FINAL_RE = re.compile(r"prazo[^.\n]{0,60}?(?:venc\w*|termin\w*|encerr\w*|final|at[ée])\D{0,30}?(\d{1,2})/(\d{1,2})/(\d{4})", re.I)
+    CITACAO_RE = re.compile(r"(?:cita[çc][ãa]o|citad[oa]|intima[çc][ãa]o|intimad[oa])\D{0,80}?(\d{1,2})/(\d{1,2})/(\d{4})", re.I)
+    PRAZO_DIAS_RE = re.compile(r"prazo\s+(?:legal\s+)?de\s+(\d{1,3})\s*(?:\([^)]*\)\s*)?dias", re.I)
+
+    def __init__(self, concurrency=GENERATION_CONCURRENCY, queue_timeout=GENERATION_QUEUE_TIMEOUT_S,
+                 default_deadline_hours=GENERATION_DEFAULT_DEADLINE_HOURS, initial_estimate=GENERATION_INITIAL_ESTIMATE_S):
+        self.concurrency = max(1, concurrency)
+        self.queue_timeout = queue_timeout
+        self.default_deadline_hours = default_deadline_hours
+        self.initial_estimate = initial_estimate
+        self._cond = threading.Condition()
+        self._waiting = [] # heap de (prazo, sequência, pedido)
+        self._running = {} # sequência -> pedido
+        self._tickets = {} # id do pedido -> pedido (na fila ou em execução)
+        self._durations = {} # tipo de geração -> média móvel da duração (s)
+        self._sequence = itertools.count()
+
+    def run(self, fn, deadline=None, case_id=None, kind="completa", ticket_id=None):
+        # Executa fn() quando chegar a vez do pedido; retorna "Erro: ..." se a espera passar de queue_timeout
+        ticket = {"id": ticket_id or uuid.uuid4().hex, "seq": next(self._sequence), "case_id": case_id, "kind": kind,
+                  "deadline": deadline or time.time() + self.default_deadline_hours * 3600, "started_at": None}
+        with self._cond:
+            heapq.heappush(self._waiting, (ticket["deadline"], ticket["seq"], ticket))
+            self._tickets[ticket["id"]] = ticket
+        try:
+            if not self._wait_turn(ticket):
+                logger.warning(f"GenerationScheduler: Pedido {ticket['id']} ({kind}) desistiu após {self.queue_timeout:.0f}s na fila.")
+                return f"Erro: Muitas gerações em andamento; o pedido esperou {self.queue_timeout:.0f}s na fila. Tente novamente em instantes."
+            return fn()
+        finally:
+            self._finish(ticket)
+
+    def _wait_turn(self, ticket):
+        give_up_at = time.monotonic() + self.queue_timeout
+        with self._cond:
+            while len(self._running) >= self.concurrency or self._waiting[0][2] is not ticket:
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    self._waiting = [item for item in self._waiting if item[2] is not ticket]
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all() # O próximo da fila pode ter virado o primeiro
+                    return False
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            ticket["started_at"] = time.time()
+            self._running[ticket["seq"]] = ticket
+            self._cond.notify_all() # Com mais de uma vaga livre, o seguinte também pode começar
+        if ticket["deadline"] < time.time():
+            logger.warning(f"GenerationScheduler: Pedido {ticket['id']} (caso {ticket['case_id']}) iniciado após o prazo.")
+        return True
+
+    def _finish(self, ticket):
+        with self._cond:
+            if self._running.pop(ticket["seq"], None):
+                duration = time.time() - ticket["started_at"]
+                previous = self._durations.get(ticket["kind"])
+                self._durations[ticket["kind"]] = duration if previous is None else 0.8 * previous + 0.2 * duration
+            if self._tickets.get(ticket["id"]) is ticket:
+                del self._tickets[ticket["id"]]
+            self._cond.notify_all()
+
+    def _expected_duration(self, kind):
+        return self._durations.get(kind, self.initial_estimate)
+
+    def _estimates(self):
+        # Simula a liberação das vagas: cada geração em andamento termina após a duração média do seu tipo
+        now = time.time()
+        free_at = [max(now, t["started_at"] + self._expected_duration(t["kind"])) for t in self._running.values()]
+        free_at += [now] * (self.concurrency - len(free_at))
+        heapq.heapify(free_at)
+        estimates = {}
+        for position, (_, seq, ticket) in enumerate(sorted(self._waiting), start=1):
+            start = heapq.heappop(free_at)
+            estimates[seq] = (position, start - now)
+            heapq.heappush(free_at, start + self._expected_duration(ticket["kind"]))
+        return estimates
+
+    def _describe(self, ticket, estimates):
+        position, wait_s = estimates.get(ticket["seq"], (0, 0))
+        return {"pedidoId": ticket["id"], "casoId": ticket["case_id"], "tipo": ticket["kind"],
+                "status": "gerando" if ticket["started_at"] else "na_fila", "posicao": position,
+                "esperaEstimadaSegundos": round(wait_s), "prazo": datetime.fromtimestamp(ticket["deadline"]).isoformat(timespec='minutes')}
+
+    def status(self, ticket_id=None, case_id=None):
+        # Situação do pedido (ou do pedido mais urgente do caso); None se não estiver na fila nem em execução
+        with self._cond:
+            tickets = [t for t in self._tickets.values() if (ticket_id and t["id"] == ticket_id) or (case_id and t["case_id"] == case_id)]
+            if not tickets:
+                return None
+            return self._describe(min(tickets, key=lambda t: t["deadline"]), self._estimates())
+
+    def snapshot(self):
+        with self._cond:
+            estimates = self._estimates()
+            tickets = sorted(self._tickets.values(), key=lambda t: (t["started_at"] is None, t["deadline"]))
+            return {"concorrencia": self.concurrency, "emExecucao": len(self._running), "naFila": len(self._waiting),
+                    "duracaoMediaSegundos": {kind: round(d, 1) for kind, d in self._durations.items()},
+                    "pedidos": [self._describe(t, estimates) for t in tickets]}
+
+    @classmethod
+    def deadline_from_text(cls, text, business_days=CONTESTACAO_PRAZO_DIAS_UTEIS):
+        # Prazo da contestação lido dos autos: data final explícita ou data da citação/intimação + prazo em dias úteis
+        # (o informado no mandado ou business_days), contados a partir do dia útil seguinte. Feriados não são considerados.
+        def parse(match):
+            try: return datetime(int(match[2]), int(match[1]), int(match[0]))
+            except ValueError: return None
+        finals = [d for d in map(parse, cls.PRAZO_FINAL_RE.findall(text)) if d]
+        if finals:
+            return max(finals).replace(hour=23, minute=59).timestamp()
+        citations = [d for d in map(parse, cls.CITACAO_RE.findall(text)) if d and d <= datetime.now()]
+        if not citations:
+            return None
+        days = cls.PRAZO_DIAS_RE.search(text)
+        remaining, current = int(days.group(1)) if days else business_days, max(citations)
+        while remaining > 0:
+            current += timedelta(days=1)
+            if current.weekday() < 5: remaining -= 1
+        return current.replace(hour=23, minute=59).timestamp()
+
+class GeneratedText(str):
+    # Texto devolvido pelo MinutaGenerator com truncated=True quando a resposta parou em MAX_TOKENS mesmo depois das
+    # continuações. A marca vai para os metadados da versão e para a resposta da API, nunca para o texto da peça.
+    truncated = False
+
+class MinutaGenerator:
+    # Os blocos do prompt vêm dos modelos do PromptRegistry (um por tipo de caso). O modo de chamada única usa o
+    # prefixo estático completo; o modo por seções (GENERATION_MODE=secoes) usa um bloco de seção por chamada.
+    FINISH_REASONS = {0:"UNSPECIFIED",1:"STOP",2:"MAX_TOKENS",3:"SAFETY",4:"RECITATION",5:"OTHER"}
+    DOCUMENT_HEADER_RE = re.compile(r"^=== (?:ARQUIVO|PÁGINAS ADICIONAIS): (.+?) ===$", re.M) # Cabeçalhos de PDFProcessor.extract_pages
+    PAGE_MARKER_RE = re.compile(r"^--- Pág (\d+) ---$", re.M)
+    DIGEST_PROMPT_VERSION = 1 # Faz parte da chave do DocumentDigestCache: mudar o prompt de resumo invalida os resumos
+    TRUNCATION_WARNING = "Texto incompleto: a resposta do modelo atingiu o limite de tamanho. Peça no ajuste para concluir a minuta."
+
+    def __init__(self, model_instance, legal_index=None, hedger=None, usage_ledger=None, prompt_registry=None, digest_cache=None):
         self.model_instance = model_instance
+        self.legal_index = legal_index # LegalRetrievalIndex opcional (referências locais para o prompt)
+        self.hedger = hedger # HedgedModelCaller opcional (segunda chamada quando a primeira demora)
+        self.usage_ledger = usage_ledger # UsageLedger opcional (tokens, latência e custo de cada chamada)
+        self._prompt_registry = prompt_registry # Sem registro explícito, usa prompt_registry_instance
+        self.digest_cache = digest_cache # DocumentDigestCache opcional (resumos do modo map-reduce)
+
+    @property
+    def prompt_registry(self):
+        return self._prompt_registry or prompt_registry_instance
     
-    def generate_minuta(self, text_from_pdfs, instructions=""):
+    def generate_minuta(self, text_from_pdfs, instructions="", base_minuta=None, mode=None, template_id=None, map_reduce=None):
         if not self.model_instance:
             logger.error("MinutaGenerator: Modelo Gemini não está disponível/configurado.")
             return "Erro: O serviço de IA não está disponível no momento. Tente novamente mais tarde."
 
-        prompt_template = self._build_prompt(text_from_pdfs, instructions)
-        logger.info(f"MinutaGenerator: Prompt construído com {len(prompt_template)} caracteres.")
-        
+        # O tipo de caso escolhido na geração (template_id) é mantido nos ajustes
+        template = self.prompt_registry.get(template_id) if template_id else self.prompt_registry.classify(text_from_pdfs)[0]
+        with tracer_instance.span("prompt.referencias"):
+            passages = self._retrieve_references(text_from_pdfs, instructions)
+        text_from_pdfs = self._prepare_documents(text_from_pdfs, map_reduce)
+        # Ajustes reformulam a minuta inteira, então seguem sempre pelo modo de chamada única
+        if (mode or GENERATION_MODE) == "secoes" and not instructions:
+            minuta = self.generate_minuta_by_sections(text_from_pdfs, passages, base_minuta, template)
+            if not minuta.startswith("Erro"):
+                return minuta
+            logger.warning(f"MinutaGenerator: Geração por seções falhou ({minuta}). Usando chamada única.")
+        with tracer_instance.span("prompt.construcao", modelo_prompt=template.key) as span:
+            prompt_template = self._build_prompt(text_from_pdfs, instructions, passages, base_minuta, template)
+            span["attributes"]["caracteres"] = len(prompt_template)
+        logger.info(f"MinutaGenerator: Prompt '{template.key}' construído com {len(prompt_template)} caracteres.")
+        return self._generate(prompt_template, max_output_tokens=template.max_output_tokens, kind="ajuste" if instructions else "geracao", template=template)
+
+    def _generate(self, prompt, max_output_tokens=60000, kind="geracao", template=None, continuations=CONTINUATION_MAX_ROUNDS):
+        # Resposta cortada em MAX_TOKENS: até `continuations` chamadas seguem do ponto em que o texto parou e as partes
+        # são emendadas. Se as rodadas acabarem ou uma continuação falhar, o texto parcial volta marcado como incompleto.
+        text, finish_reason = self._generate_once(prompt, max_output_tokens, kind, template)
+        round_number = 0
+        while finish_reason == 2 and not text.startswith("Erro") and round_number < continuations:
+            round_number += 1
+            logger.info(f"MinutaGenerator: Resposta cortada em MAX_TOKENS com {len(text)} caracteres; continuação {round_number}/{continuations}.")
+            with tracer_instance.span("gemini.continuacao", rodada=round_number, caracteres_anteriores=len(text)):
+                continuation, next_finish_reason = self._generate_once(self._build_continuation_prompt(prompt, text), max_output_tokens, f"{kind} continuacao", template)
+            if continuation.startswith("Erro"):
+                logger.warning(f"MinutaGenerator: Continuação {round_number} falhou ({continuation}); mantendo o texto parcial.")
+                break
+            text, finish_reason = self.stitch_continuation(text, continuation), next_finish_reason
+        if finish_reason == 2 and not text.startswith("Erro"):
+            logger.warning(f"MinutaGenerator: Texto incompleto após {round_number} continuações ({len(text)} caracteres).")
+            return self.mark_truncated(text)
+        return text
+
+    @staticmethod
+    def mark_truncated(text):
+        text = GeneratedText(text)
+        text.truncated = True
+        return text
+
+    @staticmethod
+    def is_truncated(text):
+        return getattr(text, "truncated", False)
+
+    @staticmethod
+    def _build_continuation_prompt(prompt, partial_text):
+        # O prompt original vem inteiro na frente (mesmo prefixo, aproveitando o cache implícito do Gemini)
+        return prompt + f"""
+
+## CONTINUAÇÃO DA RESPOSTA
+A resposta a este pedido foi interrompida pelo limite de tamanho. O texto já redigido está abaixo.
+Continue EXATAMENTE do ponto em que ele parou, mesmo que seja no meio de uma frase ou palavra, sem repetir o que já foi escrito, sem resumir e sem comentários. Mantenha a numeração, a estrutura e o estilo, e conclua a peça.
+TEXTO JÁ REDIGIDO:
+\"\"\"
+{partial_text}
+\"\"\"
+"""
+
+    @staticmethod
+    def stitch_continuation(text, continuation, max_overlap=600, min_overlap=12):
+        # O modelo às vezes recomeça repetindo o fim do texto anterior: descarta a maior sobreposição entre os dois
+        stripped = continuation.lstrip()
+        for size in range(min(len(stripped), len(text), max_overlap), min_overlap - 1, -1):
+            if text.endswith(stripped[:size]):
+                return text + stripped[size:]
+        return text + continuation
+
+    def _generate_once(self, prompt, max_output_tokens, kind, template):
+        # Uma chamada ao modelo: (texto ou "Erro: ...", finish reason numérico ou None)
+        if self.usage_ledger:
+            budget_error = self.usage_ledger.check_budget(estimated_tokens=len(prompt) // 4) # ~4 caracteres por token
+            if budget_error: return budget_error, None
         try:
             logger.info("MinutaGenerator: Iniciando chamada para self.model_instance.generate_content")
             generation_config = genai.types.GenerationConfig(
-                temperature=0.7, top_p=0.8, top_k=40, max_output_tokens=60000
-            )
-            response = self.model_instance.generate_content(
-                contents=[prompt_template], 
-                generation_config=generation_config,
+                temperature=0.7, top_p=0.8, top_k=40, max_output_tokens=max_output_tokens
             )
-            logger.info("MinutaGenerator: Resposta recebida do modelo Gemini.")
-            return self._extract_response_text(response)
+            with tracer_instance.span("gemini.chamada", modelo=ACTUAL_MODEL_NAME_LOADED, prompt_caracteres=len(prompt)) as span:
+                response = self._call_model(kind, template, contents=[prompt], generation_config=generation_config)
+                logger.info("MinutaGenerator: Resposta recebida do modelo Gemini.")
+                text = self._extract_response_text(response, allow_truncated=True)
+                span["attributes"]["resposta_caracteres"] = len(text)
+                if text.startswith("Erro"): span["status"] = {"code": 2, "message": text}
+            return text, self._finish_reason(response)
         except Exception as e:
             error_detail = str(e)
             if "API_KEY_INVALID" in error_detail or "PermissionDenied" in error_detail or "PERMISSION_DENIED" in error_detail:
                  logger.error(f"MinutaGenerator: Erro de API Key ou Permissão: {error_detail}", exc_info=True)
-                 return "Erro: Falha na autenticação com o serviço de IA. Verifique a API Key e permissões."
+                 return "Erro: Falha na autenticação com o serviço de IA. Verifique a API Key e permissões.", None
             elif "Billing" in error_detail or "billing" in error_detail:
                  logger.error(f"MinutaGenerator: Problema de faturamento: {error_detail}", exc_info=True)
-                 return "Erro: Problema com a conta de faturamento da API Key."
+                 return "Erro: Problema com a conta de faturamento da API Key.", None
             else:
                  logger.error(f"MinutaGenerator: Erro ao chamar Gemini: {error_detail}", exc_info=True)
-                 return f"Erro inesperado ao contatar o serviço de IA: {error_detail}"
-
-    def _build_prompt(self, text_from_pdfs, instructions=""):
-        # (Seu prompt extenso e detalhado permanece aqui, como antes)
-        base_prompt = f"""
-# PROMPT PARA CONTESTAÇÃO JURÍDICA PROFUNDA E ANALÍTICA - TRANSFERÊNCIA DE PONTOS NA CNH
-
-Você é um procurador do Estado especializado em ações de trânsito com vasta experiência em defesa de atos administrativos. Abaixo estão os conteúdos de uma petição inicial e documentos auxiliares em uma ação judicial de **TRANSFERÊNCIA DE PONTOS NA CNH**.
-
-**CONTEXTO ESPECÍFICO:** A ação envolve pedido de transferência judicial de pontos após perda do prazo administrativo (art. 257, § 7º do CTB), baseada apenas em declaração singela do suposto condutor, sem provas robustas que desconstituam a presunção legal de responsabilidade do proprietário do veículo.
-
-Com base nessas informações, redija uma **MINUTA DE CONTESTAÇÃO COMPLETA E DETALHADA** que tenha **OBRIGATORIAMENTE ENTRE 5 A 10 PÁGINAS**, estruturando o texto nos seguintes blocos:
-
-## 1. **RELATÓRIO DOS FATOS** (1-2 páginas)
-Descreva de forma **minuciosa e analítica** o conteúdo da petição inicial, incluindo:
-- Narrativa cronológica detalhada dos eventos
-- Análise crítica das alegações do autor
-- Contextualização dos fatos no âmbito administrativo
-- Identificação de inconsistências ou omissões na inicial
-- Descrição pormenorizada dos documentos juntados
-- Linguagem impessoal, técnica e objetiva
-
-## 2. **FUNDAMENTAÇÃO JURÍDICA** (3-6 páginas)
-Apresente argumentação **extensa e aprofundada** com os seguintes subtópicos obrigatórios:
-
-### 2.1. **DO MÉRITO - ASPECTOS MATERIAIS**
-- **Análise do Código de Trânsito Brasileiro (Lei 9.503/97)**
-  - Art. 257, § 7º - prazo para indicação do condutor
-  - Consequências da perda do prazo administrativo
-  - Sistema de pontuação e penalidades
-  - Competência administrativa para autuação e aplicação de sanções
-- **Princípios do Direito Administrativo aplicáveis**
-  - Legalidade estrita
-  - Presunção de legitimidade dos atos administrativos
-  - Auto-executoriedade
-  - Imperatividade
-- **Normas administrativas pertinentes**
-  - Resoluções do CONTRAN sobre notificação e defesa
-  - Sistema de Notificação Eletrônica (SNE)
-  - Procedimentos para suspensão do direito de dirigir
-  - Instruções normativas sobre identificação de condutores
-
-### 2.3. **JURISPRUDÊNCIA CONSOLIDADA**
-- Precedentes do STJ sobre transferência de pontos
-- Decisões dos Tribunais de Justiça estaduais
-- Orientações dos Tribunais Regionais Federais
-- Súmulas aplicáveis ao caso
-
-### 2.4. **INSUFICIÊNCIA PROBATÓRIA DA MERA DECLARAÇÃO**
-- **Inadequação da prova apresentada pelo autor**
-  - Análise crítica da declaração singela e simplória
-  - Ausência de elementos corroborativos
-  - Inexistência de justificativa para inércia administrativa
-- **Necessidade de prova irrefutável e absolutamente idônea**
-  - Padrão probatório exigido para desconstituir presunção legal
-  - Elementos que poderiam demonstrar a alegada inocência
-  - Comparação com casos de transferência deferida judicialmente
-- **Risco de fraudes e impunidade**
-  - Proteção do sistema contra declarações oportunistas
-  - Preservação da efetividade das normas de trânsito
-  - Impedimento de ganho econômico indevido
-- Refutação ponto a ponto das alegações do autor
-- Demonstração da correção do procedimento administrativo
-- Evidenciação da observância do devido processo legal
-- Comprovação da regularidade da notificação
-
-### 2.5. **QUESTÕES PROBATÓRIAS**
-- Análise da prova documental
-- Discussão sobre inversão do ônus da prova
-- Necessidade de perícia técnica (se aplicável)
-- Valoração das provas administrativas
-
-## 3. **PEDIDOS** (1 página)
-Elabore pedidos **abrangentes e fundamentados**:
-- Pedidos preliminares (se aplicáveis)
-- Pedido principal de improcedência
-- Pedidos subsidiários
-- Condenação em honorários e custas
-- Outros pedidos pertinentes
-
-## DIRETRIZES OBRIGATÓRIAS PARA EXTENSÃO E QUALIDADE:
-
-### **EXTENSÃO MÍNIMA EXIGIDA:**
-- **MÍNIMO ABSOLUTO: 5 páginas completas**
-- **IDEAL: 7-10 páginas**
-- Cada página deve conter aproximadamente 30-35 linhas
-- Parágrafos bem desenvolvidos com 4-8 linhas cada
-
-### **CARACTERÍSTICAS DA ARGUMENTAÇÃO:**
-- **PROFUNDIDADE ANALÍTICA**: Cada argumento deve ser desenvolvido em múltiplos parágrafos
-- **CITAÇÕES EXTENSAS**: Inclua trechos relevantes da legislação e jurisprudência
-- **ANÁLISE COMPARATIVA**: Compare casos similares e suas soluções
-- **ABORDAGEM MULTIDISCIPLINAR**: Considere aspectos administrativos, constitucionais e processuais
-- **ARGUMENTAÇÃO SUBSIDIÁRIA**: Desenvolva argumentos alternativos e complementares
-
-### **ESTRUTURA TEXTUAL OBRIGATÓRIA:**
-- **Parágrafos longos e bem fundamentados** (mínimo 4 linhas cada)
-- **Subdivisões detalhadas** com desenvolvimento completo de cada tópico
-- **Transições argumentativas** entre os diferentes pontos
-- **Conclusões parciais** ao final de cada seção principal
-- **Linguagem jurídica rebuscada** mas clara e precisa
-
-### **ELEMENTOS DE ENRIQUECIMENTO DO TEXTO:**
-- Histórico legislativo das normas aplicáveis
-- Evolução jurisprudencial sobre o tema
-- Análise doutrinária de renomados juristas
-- Comparação com legislações de outros países (quando pertinente)
-- Impactos sociais e econômicos da questão
-
-### **FORMATAÇÃO E APRESENTAÇÃO:**
-- Títulos e subtítulos claramente hierarquizados
-- Numeração sequencial dos argumentos principais
-- Citações em formatação adequada
-- Referências bibliográficas completas
-- Linguagem jurídica formal, técnica e erudita
-
-### **CONTROLE DE QUALIDADE:**
-- Evite repetições desnecessárias MAS desenvolva cada argumento completamente
-- Mantenha coerência lógica entre os argumentos
-- Certifique-se de que cada seção atinja o tamanho mínimo especificado
-- Verifique se a contestação como um todo possui densidade argumentativa suficiente
-
-**ATENÇÃO ESPECIAL:** A contestação deve demonstrar conhecimento jurídico profundo e análise minuciosa do caso, com desenvolvimento completo de todos os aspectos processuais e materiais envolvidos. Cada argumento deve ser tratado de forma exaustiva, com fundamentação múltipla e abordagem de diversos ângulos da questão jurídica.
+                 return f"Erro inesperado ao contatar o serviço de IA: {error_detail}", None
+
+    def _prepare_documents(self, text_from_pdfs, map_reduce=None):
+        # Processos acima de MAP_REDUCE_MIN_CHARS (ou map_reduce=True) seguem para o prompt como resumos (map-reduce)
+        if map_reduce is None:
+            map_reduce = bool(MAP_REDUCE_MIN_CHARS) and len(text_from_pdfs) > MAP_REDUCE_MIN_CHARS
+        if not map_reduce:
+            return text_from_pdfs
+        with tracer_instance.span("prompt.resumos", caracteres=len(text_from_pdfs)):
+            return self.summarize_documents(text_from_pdfs)
+
+    @classmethod
+    def split_documents(cls, text, chunk_chars=MAP_REDUCE_CHUNK_CHARS, verbatim_chars=MAP_REDUCE_VERBATIM_CHARS):
+        # Blocos da etapa de mapa: um por arquivo; arquivos longos viram trechos de até chunk_chars, cortados entre
+        # páginas. Arquivos até verbatim_chars (petição curta, decisões) seguem na íntegra e não são resumidos.
+        headers = list(cls.DOCUMENT_HEADER_RE.finditer(text))
+        bounds = [m.start() for m in headers] + [len(text)]
+        documents = [(m.group(1), text[bounds[n]:bounds[n + 1]]) for n, m in enumerate(headers)]
+        if not headers or text[:bounds[0]].strip():
+            documents.insert(0, ("documentos", text[:bounds[0]] if headers else text))
+        blocks = []
+        for name, document in documents:
+            if len(document) <= verbatim_chars:
+                blocks.append({"label": name, "text": document, "verbatim": True})
+                continue
+            cuts, start, previous = [], 0, 0
+            for boundary in [m.start() for m in cls.PAGE_MARKER_RE.finditer(document)] + [len(document)]:
+                if boundary - start > chunk_chars and previous > start:
+                    cuts.append((start, previous)); start = previous
+                previous = boundary
+            cuts.append((start, len(document)))
+            for begin, end in cuts:
+                for offset in range(begin, end, chunk_chars * 2): # Página isolada maior que o trecho: janelas fixas
+                    chunk = document[offset:min(end, offset + chunk_chars * 2)]
+                    pages = cls.PAGE_MARKER_RE.findall(chunk)
+                    label = f"{name}, págs. {pages[0]}-{pages[-1]}" if pages else name
+                    blocks.append({"label": label, "text": chunk, "verbatim": False})
+        return blocks
+
+    def _digest_key(self, chunk):
+        return hashlib.sha256(f"{self.DIGEST_PROMPT_VERSION}\n{ACTUAL_MODEL_NAME_LOADED}\n{chunk}".encode('utf-8')).hexdigest()
+
+    def summarize_documents(self, text_from_pdfs):
+        # Mapa: cada trecho longo vira um resumo estruturado (em paralelo, até MAP_REDUCE_WORKERS chamadas, com cache
+        # pelo hash do conteúdo). Redução: a contestação é gerada sobre os resumos e os documentos curtos na íntegra.
+        started_at = time.perf_counter()
+        blocks = self.split_documents(text_from_pdfs, MAP_REDUCE_CHUNK_CHARS, MAP_REDUCE_VERBATIM_CHARS)
+        digests, pending = {}, []
+        for index, block in enumerate(blocks):
+            if block["verbatim"]: continue
+            key = self._digest_key(block["text"])
+            cached = self.digest_cache.get(key) if self.digest_cache else None
+            if cached: digests[index] = cached
+            else: pending.append((index, key))
+        if pending:
+            with ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS, thread_name_prefix="resumo") as executor:
+                futures = [executor.submit(Tracer.bind(lambda block=blocks[index]: self._generate(
+                    self._build_digest_prompt(block), max_output_tokens=MAP_REDUCE_DIGEST_TOKENS, kind="resumo", continuations=1)))
+                    for index, _ in pending]
+                results = [future.result() for future in futures]
+            for (index, key), digest in zip(pending, results):
+                if digest.startswith("Erro"):
+                    logger.warning(f"MinutaGenerator: Resumo de '{blocks[index]['label']}' falhou ({digest}); usando o início do trecho.")
+                    continue
+                digests[index] = digest.strip() # Um resumo cortado ainda serve
+                if self.digest_cache: self.digest_cache.put(key, digests[index], len(blocks[index]["text"]))
+
+        parts = ["Os documentos longos do processo foram resumidos (blocos RESUMO); os demais estão na íntegra.\n\n"]
+        for index, block in enumerate(blocks):
+            if block["verbatim"]:
+                parts.append(block["text"])
+            elif index in digests:
+                parts.append(f"=== RESUMO: {block['label']} ===\n{digests[index]}\n\n")
+            else:
+                parts.append(f"=== TRECHO (sem resumo): {block['label']} ===\n{block['text'][:MAP_REDUCE_VERBATIM_CHARS]}\n[...]\n\n")
+        reduced = "".join(parts)
+        summarized = sum(1 for block in blocks if not block["verbatim"])
+        logger.info(f"MinutaGenerator: Map-reduce com {summarized} trechos resumidos ({summarized - len(pending)} do cache) em "
+                    f"{time.perf_counter() - started_at:.1f}s; {len(text_from_pdfs)} -> {len(reduced)} caracteres.")
+        return reduced
+
+    def _build_digest_prompt(self, block):
+        return f"""Você é assistente jurídico da Procuradoria-Geral do Estado. O trecho abaixo faz parte de um processo judicial contra o DETRAN.
+Produza um RESUMO ESTRUTURADO para que outro redator escreva a contestação sem acesso ao original. Use exatamente os tópicos abaixo, de forma objetiva:
+DOCUMENTO: tipo e identificação ({block['label']})
+PARTES E IDENTIFICADORES: nomes, CPF/CNPJ, placas, RENAVAM, números de autos de infração, de processos administrativos e judiciais
+FATOS E DATAS: cronologia objetiva, com as datas exatas
+PEDIDOS E ARGUMENTOS: o que a parte pede e com qual fundamento
+DECISÕES, NOTIFICAÇÕES E PRAZOS:
+PROVAS E DOCUMENTOS RELEVANTES:
+TRECHOS LITERAIS: até 5 citações curtas entre aspas, cada uma com a página
+Não invente dados; escreva "não consta" quando a informação não estiver no trecho.
+TRECHO:
+\"\"\"
+{block['text']}
+\"\"\"
+"""
 
+    def generate_draft(self, text_from_pdfs, base_minuta=None, template_id=None, map_reduce=None):
+        # Primeira camada do modo de rascunho rápido: versão curta, com limite baixo de tokens, para leitura imediata
+        if not self.model_instance:
+            return "Erro: O serviço de IA não está disponível no momento. Tente novamente mais tarde."
+        template = self.prompt_registry.get(template_id) if template_id else self.prompt_registry.classify(text_from_pdfs)[0]
+        passages = self._retrieve_references(text_from_pdfs)
+        text_from_pdfs = self._prepare_documents(text_from_pdfs, map_reduce) # Os resumos ficam em cache para a versão completa
+        prompt = self._build_draft_prompt(self._build_case_context(text_from_pdfs, passages, base_minuta), template)
+        logger.info(f"MinutaGenerator: Prompt de rascunho '{template.key}' construído com {len(prompt)} caracteres.")
+        # Sem continuação: o rascunho vale pela rapidez e a versão completa vem em seguida
+        return self._generate(prompt, max_output_tokens=DRAFT_MAX_OUTPUT_TOKENS, kind="rascunho", template=template, continuations=0)
+
+    def _build_case_context(self, text_from_pdfs, passages=None, base_minuta=None):
+        return f"""{self._build_references_block(passages)}{self._build_base_minuta_block(base_minuta)}
 Conteúdo dos documentos:
 \"\"\"
 {text_from_pdfs}
 \"\"\"
 """
+
+    def _build_draft_prompt(self, case_context, template):
+        return (template.outline_prefix + f"""
+## TAREFA DESTA ETAPA: RASCUNHO RÁPIDO
+Desconsidere a extensão pedida acima. Produza um RASCUNHO CURTO da contestação, de no máximo 2 páginas, que o procurador lerá enquanto a versão completa é redigida:
+- Os mesmos títulos de seção ({", ".join(key for key, _ in template.sections)}), cada um com 1 a 3 parágrafos curtos com os argumentos centrais.
+- Fatos essenciais do caso (partes, placas, datas, autos de infração e pedidos do autor) e os pedidos finais.
+- Sem citações extensas; apenas os dispositivos e precedentes principais.
+{case_context}""")
+
+    def generate_minuta_by_sections(self, text_from_pdfs, passages=None, base_minuta=None, template=None):
+        # 1) Um plano curto define o que cada seção argumenta; 2) as seções são redigidas em paralelo com o
+        # mesmo contexto do caso; 3) o texto é montado na ordem e os parágrafos repetidos entre seções são retirados
+        case_context = self._build_case_context(text_from_pdfs, passages, base_minuta)
+        template = template or self.prompt_registry.default
+        plan = self._generate(self._build_outline_prompt(case_context, template), max_output_tokens=4000, kind="plano", template=template)
+        if plan.startswith("Erro"):
+            return plan
+        logger.info(f"MinutaGenerator: Plano da contestação com {len(plan)} caracteres; redigindo {len(template.sections)} seções em paralelo.")
+        with ThreadPoolExecutor(max_workers=SECTION_GENERATION_WORKERS, thread_name_prefix="secao") as executor:
+            futures = [executor.submit(Tracer.bind(lambda section=section: self._generate(
+                self._build_section_prompt(section, plan, case_context, template), max_output_tokens=16000, kind=f"secao {section[0]}", template=template)))
+                for section in template.sections]
+            sections = [future.result() for future in futures]
+        for (key, _), section_text in zip(template.sections, sections):
+            if section_text.startswith("Erro"):
+                return f"{section_text} (seção {key})"
+        minuta = self.remove_cross_section_repetition([text.strip() for text in sections])
+        return self.mark_truncated(minuta) if any(self.is_truncated(text) for text in sections) else minuta
+
+    def _build_outline_prompt(self, case_context, template):
+        return (template.outline_prefix + f"""
+## TAREFA DESTA ETAPA: APENAS O PLANO
+Não redija a contestação. Produza somente um PLANO objetivo, que será entregue a redatores diferentes, um por seção:
+- **FATOS ESSENCIAIS**: até 15 linhas com partes, placas, datas, autos de infração e pedidos do autor.
+- Para cada seção ({", ".join(key for key, _ in template.sections)}): os argumentos, dispositivos e precedentes que ela deve desenvolver.
+- Cada argumento deve ser atribuído a UMA única seção, para que não haja repetição entre elas.
+{case_context}""")
+
+    def _build_section_prompt(self, section, plan, case_context, template):
+        key, directives = section
+        keys = [k for k, _ in template.sections]
+        position = ""
+        if key == keys[0]:
+            position = "Comece pelo cabeçalho da contestação (endereçamento ao juízo, identificação das partes e título).\n"
+        if key == keys[-1]:
+            position += "Termine com o fecho da peça (termos em que pede deferimento, local, data e assinatura).\n"
+        return (template.header + f"""
+## TAREFA DESTA ETAPA: REDIGIR APENAS A SEÇÃO {key}
+As demais seções ({", ".join(k for k in keys if k != key)}) estão sendo redigidas em paralelo por outros redatores, a partir do mesmo plano.
+Desenvolva somente os argumentos que o plano atribui a esta seção, sem antecipar ou repetir os das outras.
+{position}
+{directives}
+{template.guidelines}
+PLANO DA CONTESTAÇÃO:
+\"\"\"
+{plan}
+\"\"\"
+{case_context}""")
+
+    @staticmethod
+    def remove_cross_section_repetition(sections, min_overlap=0.6):
+        # Passe de consistência local: descarta parágrafos cujo conteúdo (shingles de palavras) já apareceu em
+        # grande parte numa seção anterior. Títulos e parágrafos curtos demais para comparar são mantidos.
+        seen, assembled, removed = set(), [], 0
+        for section in sections:
+            section_seen, kept = set(), []
+            for paragraph in section.split("\n"):
+                shingles = TextFingerprint.shingle_hashes(paragraph)
+                if len(shingles) >= 8 and len(shingles & seen) / len(shingles) >= min_overlap:
+                    removed += 1
+                    continue
+                section_seen |= shingles
+                kept.append(paragraph)
+            seen |= section_seen # Repetições dentro da mesma seção ficam por conta do redator da seção
+            assembled.append("\n".join(kept).strip())
+        if removed:
+            logger.info(f"MinutaGenerator: {removed} parágrafos repetidos entre seções removidos.")
+        return "\n\n".join(assembled)
+
+    def _record_usage(self, kind, response, started_at, template=None, hedge=False):
+        if not self.usage_ledger and not template:
+            return
+        try:
+            usage = getattr(response, 'usage_metadata', None)
+            prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+            output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+            total_tokens = getattr(usage, 'total_token_count', 0) or prompt_tokens + output_tokens
+            value = self._finish_reason(response)
+            finish_reason = "ERRO" if value is None else self.FINISH_REASONS.get(value, str(value))
+            model_name = getattr(response, 'model_version', None) or ACTUAL_MODEL_NAME_LOADED
+            latency_ms = (time.perf_counter() - started_at) * 1000
+            if template:
+                self.prompt_registry.record(template, latency_ms, prompt_tokens, output_tokens, error=finish_reason != "STOP", hedge=hedge)
+            if self.usage_ledger:
+                self.usage_ledger.record(kind, model_name, prompt_tokens, output_tokens, total_tokens, latency_ms, finish_reason, hedge=hedge)
+        except Exception as e: # O registro de uso nunca deve derrubar a geração
+            logger.error(f"MinutaGenerator: Falha ao registrar uso de tokens: {e}", exc_info=True)
+
+    @staticmethod
+    def _finish_reason(response):
+        # Finish reason numérico do primeiro candidato (1 = STOP, 2 = MAX_TOKENS...) ou None sem candidatos
+        if response is None or not getattr(response, 'candidates', None):
+            return None
+        value = response.candidates[0].finish_reason
+        return value.value if hasattr(value, 'value') else value
+
+    def _call_model(self, kind, template, **kwargs):
+        # Registra o uso de cada tentativa, inclusive as de hedge descartadas (os tokens delas também são cobrados)
+        record = lambda response, started_at, hedge=False: self._record_usage(kind, response, started_at, template, hedge=hedge)
+        if self.hedger:
+            return self.hedger.call(self.model_instance, on_attempt=record, **kwargs)
+        return HedgedModelCaller.attempt(self.model_instance.generate_content, record, False, **kwargs)
+
+    def _retrieve_references(self, text_from_pdfs, instructions=""):
+        if not self.legal_index:
+            return []
+        # A consulta usa o início da petição (onde estão os fatos e pedidos) e as instruções de ajuste
+        query_text = f"{text_from_pdfs[:4000]}\n{instructions}"
+        try:
+            return self.legal_index.query(query_text, top_k=LEGAL_INDEX_TOP_K)
+        except Exception as e:
+            logger.error(f"MinutaGenerator: Falha ao consultar índice jurídico local: {e}", exc_info=True)
+            return []
+
+    def _build_references_block(self, passages):
+        if not passages:
+            return ""
+        refs = "\n\n".join([f"[{i+1}] ({p['source']})\n{p['text']}" for i, p in enumerate(passages)])
+        return f"""
+## REFERÊNCIAS NORMATIVAS E JURISPRUDENCIAIS DISPONÍVEIS
+Os trechos abaixo foram recuperados da base local de legislação e jurisprudência. Utilize-os como fonte das citações literais (CTB, Resoluções do CONTRAN, precedentes do STJ e súmulas). Não invente números de artigos, resoluções, súmulas ou processos que não constem destes trechos ou dos documentos do caso.
+\"\"\"
+{refs}
+\"\"\"
+"""
+
+    def _build_base_minuta_block(self, base_minuta):
+        if not base_minuta:
+            return ""
+        return f"""
+## MINUTA DE CASO ANTERIOR SEMELHANTE (PONTO DE PARTIDA)
+A minuta abaixo foi aprovada em um caso anterior muito semelhante. Utilize-a como rascunho: preserve a estrutura e a fundamentação que se aplicarem, adapte partes, datas, autos de infração, fatos e documentos ao caso atual e remova tudo o que não se aplicar. Não copie dados do caso anterior que não constem dos documentos atuais.
+\"\"\"
+{base_minuta}
+\"\"\"
+"""
+
+    def _build_prompt(self, text_from_pdfs, instructions="", passages=None, base_minuta=None, template=None):
+        base_prompt = ((template or self.prompt_registry.default).static_prefix + f"""{self._build_references_block(passages)}{self._build_base_minuta_block(base_minuta)}
+Conteúdo dos documentos:
+\"\"\"
+{text_from_pdfs}
+\"\"\"
+""")
         if instructions:
             base_prompt += f"""
 
@@ -268,7 +1276,7 @@ Incorpore estas instruções na reformulação da minuta, mantendo a estrutura e
 """
         return base_prompt
     
-    def _extract_response_text(self, response): # Mantida como antes
+    def _extract_response_text(self, response, allow_truncated=False): # allow_truncated: devolve o texto parcial em MAX_TOKENS
         try:
             if response is None: logger.warning("MinutaGenerator: Resposta Gemini é None."); return "Erro: Nenhuma resposta IA."
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason') and response.prompt_feedback.block_reason:
@@ -276,8 +1284,11 @@ Incorpore estas instruções na reformulação da minuta, mantendo a estrutura e
                 logger.error(f"MinutaGenerator: Geração bloqueada. Razão: {reason}"); return f"Erro: Solicitação bloqueada ({reason})."
             if not hasattr(response, 'candidates') or not response.candidates: logger.warning("MinutaGenerator: Resposta sem 'candidates'."); return "Erro: Resposta inválida (sem candidatos)."
             first_candidate = response.candidates[0]
-            finish_reason_map = {0:"UNSPECIFIED",1:"STOP",2:"MAX_TOKENS",3:"SAFETY",4:"RECITATION",5:"OTHER"}
+            finish_reason_map = self.FINISH_REASONS
             finish_reason_value = first_candidate.finish_reason.value if hasattr(first_candidate.finish_reason, 'value') else first_candidate.finish_reason
+            if finish_reason_value == 2 and allow_truncated and first_candidate.content and first_candidate.content.parts:
+                partial = "".join([part.text for part in first_candidate.content.parts if hasattr(part, 'text')])
+                if partial: return partial # Texto cortado pelo limite de tokens: quem chamou continua a partir dele
             if finish_reason_value != 1:
                  reason_str = finish_reason_map.get(finish_reason_value, str(finish_reason_value))
                  logger.error(f"MinutaGenerator: Geração não finalizada: {reason_str} ({finish_reason_value})")
@@ -293,11 +1304,21 @@ Incorpore estas instruções na reformulação da minuta, mantendo a estrutura e
         except Exception as e: logger.error(f"MinutaGenerator: Erro extrair texto: {e}", exc_info=True); return f"Erro interno ao processar resposta IA."
 
 class PDFProcessor: # Mantida
+    # Classificação pela amostra da varredura prévia; a ordem define a prioridade no orçamento de páginas
+    FILE_TYPES = {
+        "peticao": re.compile(r"excelent[íi]ssim|peti[çc][ãa]o inicial|dos fatos|dos pedidos|vem,? respeitosamente|requer", re.I),
+        "decisao": re.compile(r"\bdecis[ãa]o\b|\bdecido\b|senten[çc]a|\bdefiro\b|\bindefiro\b|intime-se|cite-se", re.I),
+        "documento": None,
+        "anexo": re.compile(r"extrato|prontu[áa]rio|hist[óo]rico|auto de infra[çc][ãa]o|renach|certid[ãa]o|comprovante|procura[çc][ãa]o|notifica[çc][ãa]o", re.I),
+    }
+
     @staticmethod
     def allowed_file(filename): return ('.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS)
     @staticmethod
-    def extract_text_from_pdfs(pdf_files):
-        full_text, filenames, errors = "", [], []
+    def extract_text_from_pdfs(pdf_files, deferred=None):
+        # Varredura prévia de todos os arquivos, plano de páginas dentro do orçamento do caso e extração só dessas
+        # páginas. Arquivos com páginas de fora são acrescentados a `deferred` (se informado) para carga sob demanda.
+        full_text, filenames, errors, contents = "", [], [], []
         for pdf_file in pdf_files:
             if not pdf_file or not pdf_file.filename: errors.append("Arquivo inválido."); continue
             s_filename = secure_filename(pdf_file.filename)
@@ -305,16 +1326,407 @@ class PDFProcessor: # Mantida
             try:
                 pdf_file.seek(0, os.SEEK_END); file_size = pdf_file.tell(); pdf_file.seek(0, os.SEEK_SET)
                 if file_size > MAX_FILE_SIZE: errors.append(f"{s_filename} ({(file_size/(1024*1024)):.1f}MB) > limite."); continue
-                pdf_content = pdf_file.read()
-                if not pdf_content: errors.append(f"{s_filename} vazio."); continue
+                contents.append((s_filename, pdf_file.read()))
+            except Exception as e: errors.append(f"Erro em {s_filename}: {e}"); logger.error(f"PDFProcessor: Erro {s_filename}: {e}", exc_info=True); continue
+        scans = [PDFProcessor.preflight(name, content) for name, content in contents]
+        plan = PDFProcessor.plan_pages(scans) # Por posição: dois uploads com o mesmo nome têm planos próprios
+        blocks, char_budget = {}, EXTRACTION_CHAR_BUDGET
+        for index in sorted(range(len(contents)), key=lambda i: PDFProcessor._priority(scans[i])): # Orçamento de caracteres vai primeiro para a petição
+            s_filename, pdf_content = contents[index]
+            pages = plan[index]
+            blocks[index] = PDFProcessor.extract_pages(s_filename, pdf_content, pages=pages, char_budget=max(char_budget, 0))
+            char_budget -= len(blocks[index][0] or "")
+        for index, (s_filename, pdf_content) in enumerate(contents):
+            file_block, error, omitted = blocks[index]
+            if file_block: full_text += file_block; filenames.append(s_filename)
+            else: errors.append(error)
+            if file_block and omitted and deferred is not None:
+                deferred.append({"filename": s_filename, "tipo": scans[index]["tipo"], "paginas": scans[index]["paginas"], "omitidas": omitted, "content": pdf_content})
+        return full_text, filenames, errors
+    @staticmethod
+    def extract_text_from_bytes(s_filename, pdf_content):
+        # Extrai um único PDF já lido; retorna (bloco "=== ARQUIVO ... ===", None) ou (None, mensagem de erro)
+        file_block, error, _ = PDFProcessor.extract_pages(s_filename, pdf_content)
+        return file_block, error
+    @staticmethod
+    def extract_pages(s_filename, pdf_content, pages=None, char_budget=None, header=None):
+        # Extrai as páginas indicadas (índices 0-based; None = todas) até char_budget caracteres.
+        # Retorna (bloco, erro, páginas não extraídas); o bloco cita as páginas omitidas para o modelo saber que existem.
+        if not pdf_content: return None, f"{s_filename} vazio.", []
+        try:
+            with tracer_instance.span("pdf.extracao", arquivo=s_filename, bytes=len(pdf_content)) as span:
+                doc = fitz.open(stream=pdf_content, filetype="pdf")
+                wanted = range(len(doc)) if pages is None else [i for i in pages if 0 <= i < len(doc)]
+                parts, used, extracted = [], 0, set()
+                for i in wanted:
+                    if char_budget is not None and used >= char_budget: break
+                    page_text = doc[i].get_text("text")
+                    extracted.add(i)
+                    if page_text.strip():
+                        parts.append(f"--- Pág {i+1} ---\n{page_text}\n\n"); used += len(parts[-1])
+                omitted = [i for i in (range(len(doc)) if header is None else wanted) if i not in extracted]
+                span["attributes"]["paginas"] = len(doc)
+                span["attributes"]["paginasExtraidas"] = len(extracted)
+                doc.close()
+        except Exception as e:
+            logger.error(f"PDFProcessor: Erro {s_filename}: {e}", exc_info=True)
+            return None, f"Erro em {s_filename}: {e}", []
+        file_text = "".join(parts)
+        if not file_text.strip(): return None, f"{s_filename} sem texto legível.", omitted
+        if omitted and header is None:
+            file_text += f"--- Págs {PDFProcessor.page_ranges(omitted)} não extraídas (fora do orçamento de páginas) ---\n\n"
+        return f"=== {header or 'ARQUIVO'}: {s_filename} ===\n{file_text}\n", None, omitted
+    @staticmethod
+    def preflight(s_filename, pdf_content):
+        # Varredura rápida: metadados, número de páginas e texto das primeiras páginas, sem extrair o documento inteiro.
+        # Retorna None se o PDF não puder ser aberto (a extração completa reporta o erro).
+        try:
+            with tracer_instance.span("pdf.varredura", arquivo=s_filename) as span:
                 doc = fitz.open(stream=pdf_content, filetype="pdf")
-                file_text = "".join([f"--- Pág {i+1} ---\n{p.get_text('text')}\n\n" for i,p in enumerate(doc) if p.get_text("text").strip()])
-                if file_text.strip(): full_text += f"=== ARQUIVO: {s_filename} ===\n{file_text}\n"; filenames.append(s_filename)
-                else: errors.append(f"{s_filename} sem texto legível.")
+                total = len(doc)
+                sample = "".join(doc[i].get_text("text") for i in range(min(total, PREFLIGHT_SAMPLE_PAGES)))
+                metadata = {k: v for k, v in (doc.metadata or {}).items() if v and k in ("title", "subject", "producer", "creationDate")}
                 doc.close()
-            except Exception as e: errors.append(f"Erro em {s_filename}: {e}"); logger.error(f"PDFProcessor: Erro {s_filename}: {e}", exc_info=True)
+                tipo = PDFProcessor.classify(s_filename, sample, total)
+                span["attributes"].update(paginas=total, tipo=tipo)
+        except Exception as e:
+            logger.warning(f"PDFProcessor: Varredura prévia de {s_filename} falhou ({e}); extração completa.")
+            return None
+        chars_per_page = len(sample) / max(min(total, PREFLIGHT_SAMPLE_PAGES), 1)
+        return {"filename": s_filename, "paginas": total, "tipo": tipo, "metadados": metadata, "caracteresPorPagina": chars_per_page}
+    @staticmethod
+    def classify(s_filename, sample_text, total_pages):
+        # 'peticao' | 'decisao' | 'documento' | 'anexo', pelo nome do arquivo e pelos termos mais frequentes da amostra
+        text = f"{s_filename.replace('_', ' ')}\n{sample_text[:20000]}"
+        scores = {tipo: len(regex.findall(text)) for tipo, regex in PDFProcessor.FILE_TYPES.items() if regex}
+        tipo, score = max(scores.items(), key=lambda item: item[1])
+        if score == 0: return "anexo" if total_pages > ANNEX_HEAD_PAGES * 4 else "documento"
+        if tipo != "anexo" and scores["anexo"] >= score and total_pages > ANNEX_HEAD_PAGES * 4: return "anexo"
+        return tipo
+    @staticmethod
+    def _priority(scan):
+        return list(PDFProcessor.FILE_TYPES).index(scan["tipo"]) if scan else 0
+    @staticmethod
+    def plan_pages(scans, page_budget=EXTRACTION_PAGE_BUDGET, char_budget=EXTRACTION_CHAR_BUDGET):
+        # Páginas (0-based) a extrair de cada arquivo, na ordem de `scans` (None = sem varredura, extração completa).
+        # Todo arquivo recebe as páginas da amostra; o restante do orçamento vai por prioridade (petição, decisão,
+        # documentos, anexos), com anexos limitados às páginas iniciais.
+        ordered = sorted((index for index, scan in enumerate(scans) if scan), key=lambda index: PDFProcessor._priority(scans[index]))
+        wanted = {index: min(scans[index]["paginas"], PREFLIGHT_SAMPLE_PAGES) for index in ordered}
+        page_budget -= sum(wanted.values())
+        char_budget -= sum(wanted[index] * scans[index]["caracteresPorPagina"] for index in ordered)
+        for index in ordered:
+            scan = scans[index]
+            limit = ANNEX_HEAD_PAGES if scan["tipo"] == "anexo" else scan["paginas"]
+            extra = max(min(limit, scan["paginas"]) - wanted[index], 0)
+            if scan["caracteresPorPagina"] > 0: extra = min(extra, int(max(char_budget, 0) // scan["caracteresPorPagina"]))
+            extra = min(extra, max(page_budget, 0))
+            wanted[index] += extra
+            page_budget -= extra
+            char_budget -= extra * scan["caracteresPorPagina"]
+        return [list(range(wanted[index])) if index in wanted else None for index in range(len(scans))]
+    @staticmethod
+    def page_ranges(pages):
+        # [5, 6, 7, 10] (0-based) -> "6-8, 11"
+        ranges, start = [], None
+        for i, page in enumerate(pages):
+            if start is None: start = page
+            if i + 1 == len(pages) or pages[i + 1] != page + 1:
+                ranges.append(f"{start + 1}-{page + 1}" if page > start else f"{page + 1}"); start = None
+        return ", ".join(ranges)
+
+class UploadRejected(Exception):
+    """Upload recusado durante o recebimento (antes de o corpo inteiro ter sido lido)."""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+class StreamingPDFValidator:
+    """Destino de cada arquivo do multipart: valida os bytes à medida que chegam.
+
+    Verifica a assinatura '%PDF-' e, em PDFs linearizados, o número de páginas (/N) já nos primeiros
+    blocos, além do limite de tamanho por arquivo. Ao violar qualquer regra levanta UploadRejected,
+    o que interrompe a leitura do restante da requisição.
+    """
+    HEADER_WINDOW = 1024 # A especificação admite lixo antes de '%PDF-' dentro do primeiro KB
+    LINEARIZED_RE = re.compile(rb'/Linearized\b.{0,200}?/N\s+(\d+)', re.DOTALL)
+
+    def __init__(self, filename, max_size=MAX_FILE_SIZE, max_pages=MAX_PDF_PAGES):
+        self.filename = secure_filename(filename) if filename else "ArquivoDesconhecido"
+        self.max_size = max_size
+        self.max_pages = max_pages
+        self.size = 0
+        self._head = b""
+        self._header_checked = False
+        self._spool = tempfile.SpooledTemporaryFile(max_size=1024 * 500, mode="rb+")
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadRejected(f"Arquivo '{self.filename}' excede o limite de {(self.max_size/(1024*1024)):.0f}MB.", 413)
+        if not self._header_checked:
+            self._head += chunk[:self.HEADER_WINDOW]
+            if len(self._head) >= self.HEADER_WINDOW:
+                self._check_header()
+        return self._spool.write(chunk)
+
+    def _check_header(self):
+        self._header_checked = True
+        if b"%PDF-" not in self._head[:self.HEADER_WINDOW]:
+            raise UploadRejected(f"Arquivo '{self.filename}' não é um PDF válido.")
+        match = self.LINEARIZED_RE.search(self._head)
+        if match and int(match.group(1)) > self.max_pages:
+            raise UploadRejected(f"Arquivo '{self.filename}' tem {int(match.group(1))} páginas (limite: {self.max_pages}).", 413)
+
+    def seek(self, *args):
+        # O parser do Werkzeug volta ao início ao terminar o arquivo: arquivos menores que a janela são checados aqui
+        if not self._header_checked and self.size:
+            self._check_header()
+        return self._spool.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._spool, name)
+
+    def __iter__(self):
+        return iter(self._spool)
+
+class UploadValidatingRequest(Request):
+    """Request do Flask cujos arquivos multipart passam pelo StreamingPDFValidator."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        self._upload_file_count = getattr(self, '_upload_file_count', 0) + 1
+        if self._upload_file_count > MAX_FILES:
+            raise UploadRejected(f"Por favor, envie no máximo {MAX_FILES} arquivos.")
+        if filename and not PDFProcessor.allowed_file(filename):
+            raise UploadRejected(f"Arquivo '{secure_filename(filename)}' não é um PDF válido.")
+        return StreamingPDFValidator(filename)
+
+app.request_class = UploadValidatingRequest
+
+class ChunkedUploadStore:
+    """Uploads retomáveis em partes (init / envio de parte / conclusão) montados em um diretório de spool.
+
+    Cada upload tem um diretório <spool>/<upload_id> com meta.json, as partes recebidas (<indice>.part)
+    e, após a conclusão, file.pdf. A extração de texto de cada arquivo começa em segundo plano assim
+    que ele é concluído, enquanto os demais ainda estão sendo enviados. Uploads e rascunhos guardam o dono
+    (o mesmo dos casos) e só são acessíveis por ele; para os demais, respondem como inexistentes.
+    """
+    ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, spool_dir=UPLOAD_SPOOL_DIR, chunk_size=UPLOAD_CHUNK_SIZE, executor=None):
+        self.spool_dir = spool_dir
+        self.chunk_size = chunk_size
+        os.makedirs(spool_dir, exist_ok=True)
+        self._executor = executor or ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix="extracao")
+        self._extractions = {}
+        self._lock = threading.Lock()
+
+    def _dir(self, upload_id):
+        if not upload_id or not self.ID_RE.match(upload_id):
+            raise UploadRejected("Identificador de upload inválido.", 404)
+        return os.path.join(self.spool_dir, upload_id)
+
+    def _read_meta(self, upload_id):
+        meta_path = os.path.join(self._dir(upload_id), 'meta.json')
+        if not os.path.exists(meta_path):
+            raise UploadRejected("Upload não encontrado ou expirado.", 404)
+        with open(meta_path, 'r', encoding='utf-8') as fh:
+            return json.load(fh)
+
+    def _owned_meta(self, upload_id, owner):
+        meta = self._read_meta(upload_id)
+        if not owner or meta.get("owner") != owner:
+            raise UploadRejected("Upload não encontrado ou expirado.", 404)
+        return meta
+
+    def _write_meta(self, upload_id, meta):
+        meta_path = os.path.join(self._dir(upload_id), 'meta.json')
+        with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as fh: json.dump(meta, fh)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    def init_upload(self, filename, size, sha256=None, draft_id=None, owner=None):
+        self.cleanup_expired()
+        if draft_id and len(self.draft_upload_ids(draft_id, owner=owner)) >= MAX_FILES:
+            raise UploadRejected(f"Por favor, envie no máximo {MAX_FILES} arquivos.")
+        s_filename = secure_filename(filename or "")
+        if not s_filename or not PDFProcessor.allowed_file(s_filename):
+            raise UploadRejected(f"Arquivo '{s_filename or 'ArquivoDesconhecido'}' não é um PDF válido.")
+        if size <= 0 or size > MAX_FILE_SIZE:
+            raise UploadRejected(f"Arquivo '{s_filename}' ({(size/(1024*1024)):.1f}MB) excede o limite de {(MAX_FILE_SIZE/(1024*1024)):.0f}MB.", 413)
+        if sha256 and not re.match(r'^[0-9a-fA-F]{64}$', sha256):
+            raise UploadRejected("Checksum SHA-256 inválido.")
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._dir(upload_id))
+        total_chunks = (size + self.chunk_size - 1) // self.chunk_size
+        meta = {"filename": s_filename, "size": size, "sha256": (sha256 or "").lower() or None,
+                "chunk_size": self.chunk_size, "total_chunks": total_chunks, "created_at": time.time(), "status": "enviando", "owner": owner}
+        self._write_meta(upload_id, meta)
+        if draft_id: self._update_draft(draft_id, lambda ids: ids + [upload_id], owner) # Ordem do rascunho = ordem de seleção
+        logger.info(f"ChunkedUploadStore: Upload {upload_id} iniciado ({s_filename}, {size} bytes, {total_chunks} partes).")
+        return upload_id, meta
+
+    def received_chunks(self, upload_id):
+        upload_dir = self._dir(upload_id)
+        return sorted(int(name[:-5]) for name in os.listdir(upload_dir) if name.endswith('.part'))
+
+    def status(self, upload_id, owner):
+        # Situação do upload para retomada: o cliente reenvia apenas as partes que não constam em "received"
+        meta = self._owned_meta(upload_id, owner)
+        received = self.received_chunks(upload_id) if meta["status"] == "enviando" else list(range(meta["total_chunks"]))
+        return {**meta, "received": received}
+
+    def put_chunk(self, upload_id, index, data, owner, chunk_sha256=None):
+        meta = self._owned_meta(upload_id, owner)
+        if meta["status"] != "enviando":
+            raise UploadRejected("Upload já concluído.", 409)
+        if index < 0 or index >= meta["total_chunks"]:
+            raise UploadRejected(f"Parte {index} fora do intervalo (0 a {meta['total_chunks'] - 1}).")
+        expected = min(meta["chunk_size"], meta["size"] - index * meta["chunk_size"])
+        if len(data) != expected:
+            raise UploadRejected(f"Parte {index} com {len(data)} bytes (esperado: {expected}).")
+        if chunk_sha256 and hashlib.sha256(data).hexdigest() != chunk_sha256.lower():
+            raise UploadRejected(f"Checksum da parte {index} não confere; reenvie a parte.", 422)
+        if index == 0 and b"%PDF-" not in data[:StreamingPDFValidator.HEADER_WINDOW]:
+            raise UploadRejected(f"Arquivo '{meta['filename']}' não é um PDF válido.")
+        part_path = os.path.join(self._dir(upload_id), f"{index}.part")
+        with open(f"{part_path}.tmp", 'wb') as fh: fh.write(data)
+        os.replace(f"{part_path}.tmp", part_path) # Uma parte interrompida nunca fica registrada pela metade
+
+    def complete(self, upload_id, owner):
+        meta = self._owned_meta(upload_id, owner)
+        upload_dir = self._dir(upload_id)
+        if meta["status"] != "enviando":
+            return meta
+        missing = sorted(set(range(meta["total_chunks"])) - set(self.received_chunks(upload_id)))
+        if missing:
+            raise UploadRejected(f"Faltam {len(missing)} partes (ex.: {missing[:5]}).", 409)
+        digest = hashlib.sha256()
+        file_path = os.path.join(upload_dir, 'file.pdf')
+        with open(f"{file_path}.tmp", 'wb') as out:
+            for index in range(meta["total_chunks"]):
+                with open(os.path.join(upload_dir, f"{index}.part"), 'rb') as part:
+                    data = part.read()
+                digest.update(data); out.write(data)
+        if meta["sha256"] and digest.hexdigest() != meta["sha256"]:
+            os.remove(f"{file_path}.tmp")
+            raise UploadRejected(f"Checksum do arquivo '{meta['filename']}' não confere; reinicie o upload.", 422)
+        os.replace(f"{file_path}.tmp", file_path)
+        for index in range(meta["total_chunks"]):
+            os.remove(os.path.join(upload_dir, f"{index}.part"))
+        meta.update(status="concluido", sha256=digest.hexdigest())
+        self._write_meta(upload_id, meta)
+        self.start_extraction(upload_id)
+        logger.info(f"ChunkedUploadStore: Upload {upload_id} concluído; extração iniciada em segundo plano.")
+        return meta
+
+    def start_extraction(self, upload_id):
+        with self._lock:
+            if upload_id not in self._extractions:
+                self._extractions[upload_id] = self._executor.submit(Tracer.bind(self._extract), upload_id)
+            return self._extractions[upload_id]
+
+    def _extract(self, upload_id):
+        upload_dir = self._dir(upload_id)
+        result_path = os.path.join(upload_dir, 'extracted.json')
+        if os.path.exists(result_path):
+            with open(result_path, 'r', encoding='utf-8') as fh: return json.load(fh)
+        meta = self._read_meta(upload_id)
+        with open(os.path.join(upload_dir, 'file.pdf'), 'rb') as fh:
+            pdf_content = fh.read()
+        # Cada arquivo é extraído assim que chega, então o orçamento de páginas é aplicado por arquivo
+        scan = PDFProcessor.preflight(meta["filename"], pdf_content)
+        pages = PDFProcessor.plan_pages([scan])[0]
+        if pages is not None and len(pages) < scan["paginas"]:
+            text_block, error, omitted = PDFProcessor.extract_pages(meta["filename"], pdf_content, pages=pages, char_budget=EXTRACTION_CHAR_BUDGET)
+        else:
+            (text_block, error), omitted = PDFProcessor.extract_text_from_bytes(meta["filename"], pdf_content), []
+        result = {"filename": meta["filename"], "text": text_block, "error": error, "omitidas": omitted,
+                  "tipo": scan["tipo"] if scan else None, "paginas": scan["paginas"] if scan else None}
+        with open(f"{result_path}.tmp", 'w', encoding='utf-8') as fh: json.dump(result, fh, ensure_ascii=False)
+        os.replace(f"{result_path}.tmp", result_path)
+        return result
+
+    def extraction_status(self, upload_id):
+        # 'enviando' | 'extraindo' | 'pronto' | 'erro', para o cliente acompanhar cada arquivo do rascunho
+        meta = self._read_meta(upload_id)
+        if meta["status"] != "concluido": return meta["status"]
+        future = self.start_extraction(upload_id)
+        if not future.done(): return "extraindo"
+        try: return "pronto" if future.result()["text"] else "erro"
+        except Exception: return "erro"
+
+    # --- Rascunhos por caso: arquivos enviados (e extraídos) à medida que o usuário os seleciona ---
+    def create_draft(self, owner=None):
+        self.cleanup_expired()
+        draft_id = uuid.uuid4().hex
+        os.makedirs(self._dir(draft_id))
+        self._write_draft(draft_id, [], owner)
+        logger.info(f"ChunkedUploadStore: Rascunho {draft_id} criado.")
+        return draft_id
+
+    def _write_draft(self, draft_id, upload_ids, owner):
+        draft_path = os.path.join(self._dir(draft_id), 'draft.json')
+        with open(f"{draft_path}.tmp", 'w', encoding='utf-8') as fh: json.dump({"upload_ids": upload_ids, "owner": owner}, fh)
+        os.replace(f"{draft_path}.tmp", draft_path)
+
+    def draft_upload_ids(self, draft_id, owner):
+        draft_path = os.path.join(self._dir(draft_id), 'draft.json')
+        if not os.path.exists(draft_path):
+            raise UploadRejected("Rascunho não encontrado ou expirado.", 404)
+        with open(draft_path, 'r', encoding='utf-8') as fh:
+            draft = json.load(fh)
+        if not owner or draft.get("owner") != owner:
+            raise UploadRejected("Rascunho não encontrado ou expirado.", 404)
+        return draft["upload_ids"]
+
+    def _update_draft(self, draft_id, change, owner):
+        with self._lock: # Uploads paralelos do mesmo rascunho alteram a mesma lista
+            self._write_draft(draft_id, change(self.draft_upload_ids(draft_id, owner=owner)), owner)
+
+    def remove_from_draft(self, draft_id, upload_id, owner):
+        if upload_id not in self.draft_upload_ids(draft_id, owner=owner):
+            raise UploadRejected("Upload não encontrado ou expirado.", 404)
+        self._update_draft(draft_id, lambda ids: [u for u in ids if u != upload_id], owner)
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+        with self._lock: self._extractions.pop(upload_id, None)
+
+    def draft_status(self, draft_id, owner):
+        files = []
+        for upload_id in self.draft_upload_ids(draft_id, owner=owner):
+            try: files.append({"uploadId": upload_id, "nome": self._read_meta(upload_id)["filename"], "status": self.extraction_status(upload_id)})
+            except UploadRejected: continue # Upload expirado entre a seleção e a consulta
+        return files
+
+    def collect_extractions(self, upload_ids, owner, timeout=EXTRACTION_WAIT_TIMEOUT, deferred=None):
+        # Mesmo formato de retorno (e de `deferred`) de PDFProcessor.extract_text_from_pdfs, na ordem dos ids recebidos
+        full_text, filenames, errors = "", [], []
+        for upload_id in upload_ids:
+            try:
+                meta = self._owned_meta(upload_id, owner)
+                if meta["status"] != "concluido":
+                    errors.append(f"Upload de '{meta['filename']}' ainda não foi concluído."); continue
+                result = self.start_extraction(upload_id).result(timeout=timeout)
+            except UploadRejected as e:
+                errors.append(e.message); continue
+            except Exception as e:
+                logger.error(f"ChunkedUploadStore: Falha na extração do upload {upload_id}: {e}", exc_info=True)
+                errors.append(f"Erro ao extrair o upload {upload_id}: {e}"); continue
+            if result["text"]: full_text += result["text"]; filenames.append(result["filename"])
+            else: errors.append(result["error"])
+            if result["text"] and result.get("omitidas") and deferred is not None:
+                with open(os.path.join(self._dir(upload_id), 'file.pdf'), 'rb') as fh:
+                    deferred.append({"filename": result["filename"], "tipo": result["tipo"], "paginas": result["paginas"],
+                                     "omitidas": result["omitidas"], "content": fh.read()})
         return full_text, filenames, errors
 
+    def cleanup_expired(self, max_age_hours=UPLOAD_SPOOL_TTL_HOURS):
+        limit = time.time() - max_age_hours * 3600
+        for name in os.listdir(self.spool_dir):
+            upload_dir = os.path.join(self.spool_dir, name)
+            if self.ID_RE.match(name) and os.path.getmtime(upload_dir) < limit:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+                with self._lock: self._extractions.pop(name, None)
+
 class MinutaParser: # Mantida
     @staticmethod
     def parse_minuta_to_single_block(minuta_text):
@@ -322,7 +1734,12 @@ class MinutaParser: # Mantida
             return {"CONTESTAÇÃO COMPLETA": minuta_text if minuta_text else "Nenhuma minuta ou erro."}
         return {"CONTESTAÇÃO COMPLETA": minuta_text}
 
-class HTMLGenerator: # Mantida
+class HTMLGenerator:
+    BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+    FORMAT_CACHE_SIZE = 64 # Minutas formatadas mantidas em memória (LRU)
+    _format_cache = OrderedDict()
+    _format_cache_lock = threading.Lock()
+    _static_assets = None
     @staticmethod
     def _escape_html_attribute(value):
         if not value: return ""
@@ -332,40 +1749,68 @@ class HTMLGenerator: # Mantida
         if not text_content:
             return ""
 
+        # A mesma minuta é reexibida a cada GET/ajuste: o HTML formatado fica em cache pelo hash do conteúdo
+        digest = hashlib.sha256(text_content.encode('utf-8')).hexdigest()
+        with HTMLGenerator._format_cache_lock:
+            cached = HTMLGenerator._format_cache.get(digest)
+            if cached is not None:
+                HTMLGenerator._format_cache.move_to_end(digest)
+                return cached
+
         # Normaliza quebras de linha universais para \n primeiro
         processed_text = text_content.replace('\r\n', '\n').replace('\r', '\n')
-        
-        lines = processed_text.split('\n')
-        processed_lines = []
-
-        for line in lines:
-            # 1. Escapa a linha individualmente para neutralizar qualquer HTML
-            #    que a IA possa ter gerado naquela linha.
-            line_escaped = escape(line) # Usa escape de markupsafe
-
-            # 2. Converte **texto** para <strong>texto</strong> na linha já escapada.
-            #    Os asteriscos não são alterados por escape(), então re.sub os encontrará.
-            #    O conteúdo DENTRO dos ** (grupo \1) já foi escapado se continha HTML.
-            line_with_strong = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', line_escaped)
-            
-            processed_lines.append(line_with_strong)
-        
+
+        # 1. Escapa o texto inteiro de uma vez para neutralizar qualquer HTML que a IA possa ter gerado.
+        # 2. Converte **texto** para <strong>texto</strong> no texto já escapado. Como '.' não casa com
+        #    quebra de linha, o negrito continua restrito a uma linha, exatamente como no processamento linha a linha.
+        formatted = HTMLGenerator.BOLD_RE.sub(r'<strong>\1</strong>', str(escape(processed_text)))
+
         # Junta as linhas processadas com <br>\n
-        return "<br>\n".join(processed_lines)
+        formatted = formatted.replace('\n', '<br>\n')
+        with HTMLGenerator._format_cache_lock:
+            HTMLGenerator._format_cache[digest] = formatted
+            while len(HTMLGenerator._format_cache) > HTMLGenerator.FORMAT_CACHE_SIZE:
+                HTMLGenerator._format_cache.popitem(last=False)
+        return formatted
     @staticmethod
     def generate_page(minuta_data=None, erro_msg="", sucesso_msg="", filenames_processados=None, warnings=None): # Removido temp_text_file_id
         warnings = warnings or []; filenames_processados = filenames_processados or []
-        html_output_content = f"""
+        # CSS e JS não são mais embutidos: a página referencia os assets estáticos versionados pelo hash
+        assets = HTMLGenerator.static_assets()
+        html_output_content = "".join([
+            HTMLGenerator._page_head(assets["css_url"]),
+            HTMLGenerator._generate_messages(erro_msg, sucesso_msg, warnings),
+            HTMLGenerator._generate_upload_form(),
+            HTMLGenerator._generate_processed_files(filenames_processados),
+            HTMLGenerator._generate_minuta_display(minuta_data),
+            HTMLGenerator._page_footer(assets["js_url"]),
+        ])
+        return make_response(html_output_content)
+    @staticmethod
+    def _page_head(css_url):
+        return f"""
 <!DOCTYPE html><html lang="pt-BR"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>Gerador de Minutas de Contestação - PGE</title><style>{HTMLGenerator._get_css()}</style></head><body><div class="container">
+<title>Gerador de Minutas de Contestação - PGE</title><link rel="stylesheet" href="{css_url}"></head><body><div class="container">
 <header><h1>📋 Gerador de Minutas de Contestação</h1><p class="subtitle">PGE-MS - Automação Jurídica com IA</p></header>
-{HTMLGenerator._generate_messages(erro_msg, sucesso_msg, warnings)}
-{HTMLGenerator._generate_upload_form()}
-{HTMLGenerator._generate_processed_files(filenames_processados)}
-{HTMLGenerator._generate_minuta_display(minuta_data)} 
+"""
+    @staticmethod
+    def _page_footer(js_url):
+        return f"""
 <footer><p>LAB-PGE • Inovação e Tecnologia • {datetime.now().strftime('%Y')} Versão: FlaskSession</p></footer>
-</div><script>{HTMLGenerator._get_javascript()}</script></body></html>"""
-        return make_response(html_output_content)
+</div><script src="{js_url}"></script></body></html>"""
+    @classmethod
+    def static_assets(cls):
+        # Montados uma única vez por processo; o hash no nome permite cache "immutable" no navegador
+        if cls._static_assets is None:
+            assets = {"css_url": None, "js_url": None, "files": {}}
+            for kind, content, mimetype in (("css", cls._get_css(), "text/css"), ("js", cls._get_javascript(), "application/javascript")):
+                body = content.encode('utf-8')
+                digest = hashlib.sha256(body).hexdigest()[:16]
+                filename = f"minuta.{digest}.{kind}"
+                assets["files"][filename] = {"body": body, "mimetype": f"{mimetype}; charset=utf-8", "etag": f'"{digest}"'}
+                assets[f"{kind}_url"] = f"{STATIC_ASSETS_URL_PREFIX}/{filename}"
+            cls._static_assets = assets
+        return cls._static_assets
     @staticmethod
     def _get_css(): return """* { margin: 0; padding: 0; box-sizing: border-box; } /* ... seu CSS ... */ body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; line-height: 1.6; color: #333; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; } .container { max-width: 1200px; margin: 20px auto; padding: 20px; background: white; border-radius: 15px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); } header { text-align: center; margin-bottom: 30px; border-bottom: 3px solid #667eea; padding-bottom: 20px; } header h1 { color: #2c3e50; font-size: 2.5em; margin-bottom: 10px; } .subtitle { color: #7f8c8d; font-size: 1.1em; } .section { margin: 30px 0; padding: 25px; border-radius: 10px; } .upload-section { background: #f8f9fa; border-left: 5px solid #28a745; } .minuta-content-display { white-space: pre-wrap; font-family: 'Courier New', monospace; padding: 20px; border: 2px solid #dee2e6; border-radius: 8px; background-color: #f8f9fa; min-height: 250px; max-height: 600px; overflow-y: auto; line-height: 1.5; text-align: justify; } .minuta-content-display strong { font-weight: bold; }  .minuta-section { background: #e9ecef; border-left: 5px solid #007bff; }  .adjust-section { background: #fff3cd; border-left: 5px solid #ffc107; }  h2 { color: #2c3e50; margin-bottom: 20px; font-size: 1.8em; } h3 { color: #495057; margin-bottom: 15px; font-size: 1.3em; } label { display: block; margin: 15px 0 8px 0; font-weight: 600; color: #495057; } input[type="file"], textarea { width: 100%; padding: 12px; border: 2px solid #dee2e6; border-radius: 8px; font-size: 14px; transition: border-color 0.3s ease; margin-bottom: 10px; } input[type="file"]:focus, textarea:focus { outline: none; border-color: #667eea; box-shadow: 0 0 0 3px rgba(102, 126, 234, 0.1); } .btn { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 12px 25px; border: none; border-radius: 8px; cursor: pointer; font-size: 16px; font-weight: 600; transition: transform 0.2s ease, box-shadow 0.2s ease; } .btn:hover { transform: translateY(-2px); box-shadow: 0 5px 15px rgba(0,0,0,0.2); } .btn:active { transform: translateY(0); } .alert { padding: 15px; margin: 20px 0; border-radius: 8px; font-weight: 500; word-wrap: break-word; } .alert-error { background: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; } .alert-success { background: #d4edda; color: #155724; border: 1px solid #c3e6cb; } .alert-warning { background: #fff3cd; color: #856404; border: 1px solid #ffeaa7; } .file-list { list-style: none; padding: 0; } .file-item { background: #e9ecef; padding: 10px 15px; margin: 8px 0; border-radius: 6px; border-left: 4px solid #28a745; display: flex; align-items: center; } .file-item::before { content: '📄'; margin-right: 10px; font-size: 1.2em; } .minuta-block { margin: 25px 0; border: none; border-radius: 10px; overflow: hidden; box-shadow: none; } .minuta-block h3 { background: linear-gradient(135deg, #007bff 0%, #0056b3 100%); color: white; padding: 15px 20px; margin: 0; font-size: 1.4em; border-top-left-radius: 8px; border-top-right-radius: 8px;} footer { text-align: center; margin-top: 50px; padding-top: 20px; border-top: 2px solid #dee2e6; color: #6c757d; } .loading { display: none; text-align: center; margin: 20px 0; } .spinner { border: 4px solid #f3f3f3; border-top: 4px solid #667eea; border-radius: 50%; width: 50px; height: 50px; animation: spin 1s linear infinite; margin: 0 auto; } @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } } @media (max-width: 768px) { .container { margin: 10px; padding: 15px; border-radius: 10px; } header h1 { font-size: 2em; } .section { padding: 20px; } }"""
     @staticmethod
@@ -425,13 +1870,1087 @@ class HTMLGenerator: # Mantida
             <input type="submit" value="🔄 Refazer Minuta com Ajustes" class="btn" style="margin-top: 20px;"></form></div>"""
         return html_display
 
+class LegalRetrievalIndex:
+    """Índice BM25 local de legislação e jurisprudência, gravado em arrays NumPy memory-mapped.
+
+    Layout no diretório do índice:
+      - vocab.json: termo -> id
+      - passages.json: lista de {"source", "text"} (um item por trecho indexado)
+      - indptr.npy / doc_ids.npy / weights.npy: listas invertidas em formato CSR, com o peso BM25
+        de cada par (termo, trecho) já pré-calculado. A consulta só soma fatias desses arrays.
+    """
+    TOKEN_RE = re.compile(r'\w+')
+    PARAGRAPH_RE = re.compile(r'\n\s*\n')
+    STOPWORDS = frozenset(
+        "a o as os de da do das dos e em no na nos nas um uma uns umas por para com sem que se ao aos "
+        "à às é ou ser sua seu suas seus pelo pela pelos pelas como mais não nao sobre entre este esta "
+        "esse essa isso isto foi são sao ha há já ja também tambem quando onde".split()
+    )
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def __init__(self, index_dir, vocab, passages, indptr, doc_ids, weights):
+        self.index_dir = index_dir
+        self.vocab = vocab
+        self.passages = passages
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+
+    @staticmethod
+    def tokenize(text):
+        # Remove acentos para que "infração"/"infracao" e "trânsito"/"transito" caiam no mesmo termo
+        normalized = unicodedata.normalize('NFKD', text.lower())
+        normalized = "".join([c for c in normalized if not unicodedata.combining(c)])
+        return [t for t in LegalRetrievalIndex.TOKEN_RE.findall(normalized) if t not in LegalRetrievalIndex.STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+    @staticmethod
+    def chunk_text(text, max_chars=LEGAL_CHUNK_CHARS):
+        chunks, current = [], ""
+        for paragraph in LegalRetrievalIndex.PARAGRAPH_RE.split(text.replace('\r\n', '\n')):
+            paragraph = paragraph.strip()
+            if not paragraph: continue
+            if current and len(current) + len(paragraph) + 2 > max_chars:
+                chunks.append(current); current = ""
+            # Parágrafos muito longos (ex.: artigos extensos) são quebrados em janelas fixas
+            while len(paragraph) > max_chars:
+                chunks.append(paragraph[:max_chars]); paragraph = paragraph[max_chars:]
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+        if current: chunks.append(current)
+        return chunks
+
+    @staticmethod
+    def _read_source_file(path):
+        if path.lower().endswith('.pdf'):
+            doc = fitz.open(path)
+            try: return "\n\n".join([p.get_text("text") for p in doc])
+            finally: doc.close()
+        with open(path, 'r', encoding='utf-8', errors='replace') as fh:
+            return fh.read()
+
+    @classmethod
+    def build(cls, source_dir, index_dir=LEGAL_INDEX_DIR):
+        if np is None:
+            raise RuntimeError("numpy não está instalado; o índice jurídico local não pode ser gerado.")
+        passages = []
+        for root, _, files in os.walk(source_dir):
+            for name in sorted(files):
+                if name.rsplit('.', 1)[-1].lower() not in LEGAL_SOURCE_EXTENSIONS: continue
+                path = os.path.join(root, name)
+                try: text = cls._read_source_file(path)
+                except Exception as e: logger.error(f"LegalRetrievalIndex: Erro ao ler {path}: {e}", exc_info=True); continue
+                rel = os.path.relpath(path, source_dir)
+                passages.extend([{"source": rel, "text": chunk} for chunk in cls.chunk_text(text)])
+        if not passages:
+            raise ValueError(f"Nenhum texto jurídico encontrado em '{source_dir}'.")
+
+        vocab, postings, doc_lengths = {}, [], []
+        for doc_id, passage in enumerate(passages):
+            term_freqs = {}
+            tokens = cls.tokenize(passage["text"])
+            for token in tokens:
+                term_id = vocab.setdefault(token, len(vocab))
+                term_freqs[term_id] = term_freqs.get(term_id, 0) + 1
+            doc_lengths.append(len(tokens))
+            postings.extend([(term_id, doc_id, tf) for term_id, tf in term_freqs.items()])
+
+        postings.sort()
+        term_ids = np.fromiter((p[0] for p in postings), dtype=np.int64, count=len(postings))
+        doc_ids = np.fromiter((p[1] for p in postings), dtype=np.int32, count=len(postings))
+        tfs = np.fromiter((p[2] for p in postings), dtype=np.float32, count=len(postings))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+
+        n_docs = len(passages)
+        doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_len = max(float(doc_lengths.mean()), 1.0)
+        doc_freq = np.diff(indptr).astype(np.float32)
+        idf = np.log(1.0 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        norm = cls.BM25_K1 * (1.0 - cls.BM25_B + cls.BM25_B * doc_lengths[doc_ids] / avg_len)
+        weights = (idf[term_ids] * tfs * (cls.BM25_K1 + 1.0) / (tfs + norm)).astype(np.float32)
+
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, 'indptr.npy'), indptr)
+        np.save(os.path.join(index_dir, 'doc_ids.npy'), doc_ids)
+        np.save(os.path.join(index_dir, 'weights.npy'), weights)
+        with open(os.path.join(index_dir, 'vocab.json'), 'w', encoding='utf-8') as fh: json.dump(vocab, fh, ensure_ascii=False)
+        with open(os.path.join(index_dir, 'passages.json'), 'w', encoding='utf-8') as fh: json.dump(passages, fh, ensure_ascii=False)
+        logger.info(f"LegalRetrievalIndex: {n_docs} trechos e {len(vocab)} termos indexados em '{index_dir}'.")
+        return cls.load(index_dir)
+
+    @classmethod
+    def load(cls, index_dir=LEGAL_INDEX_DIR):
+        with open(os.path.join(index_dir, 'vocab.json'), 'r', encoding='utf-8') as fh: vocab = json.load(fh)
+        with open(os.path.join(index_dir, 'passages.json'), 'r', encoding='utf-8') as fh: passages = json.load(fh)
+        arrays = [np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r') for name in ('indptr', 'doc_ids', 'weights')]
+        return cls(index_dir, vocab, passages, *arrays)
+
+    @classmethod
+    def load_if_available(cls, index_dir=LEGAL_INDEX_DIR):
+        if np is None:
+            logger.info("LegalRetrievalIndex: numpy não instalado; referências jurídicas locais desativadas.")
+            return None
+        if not os.path.exists(os.path.join(index_dir, 'indptr.npy')):
+            logger.info(f"LegalRetrievalIndex: Nenhum índice em '{index_dir}'. Use 'python contestacao.py ingest <pasta>' para criá-lo.")
+            return None
+        try:
+            index = cls.load(index_dir)
+            logger.info(f"LegalRetrievalIndex: Índice carregado de '{index_dir}' ({len(index.passages)} trechos).")
+            return index
+        except Exception as e:
+            logger.error(f"LegalRetrievalIndex: Falha ao carregar índice de '{index_dir}': {e}", exc_info=True)
+            return None
+
+    def query(self, text, top_k=LEGAL_INDEX_TOP_K, max_terms=128):
+        start = time.perf_counter()
+        term_ids = []
+        for token in self.tokenize(text):
+            term_id = self.vocab.get(token)
+            if term_id is not None and term_id not in term_ids:
+                term_ids.append(term_id)
+                if len(term_ids) >= max_terms: break
+        if not term_ids:
+            return []
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        for term_id in term_ids:
+            begin, end = self.indptr[term_id], self.indptr[term_id + 1]
+            # Cada trecho aparece no máximo uma vez por lista invertida, então a soma indexada é segura
+            scores[self.doc_ids[begin:end]] += self.weights[begin:end]
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = [dict(self.passages[i], score=float(scores[i])) for i in top if scores[i] > 0]
+        logger.debug(f"LegalRetrievalIndex: Consulta com {len(term_ids)} termos em {(time.perf_counter() - start) * 1000:.2f}ms.")
+        return results
+
+class CitationChecker:
+    """Conferência das citações da minuta (CTB, resoluções do CONTRAN, súmulas e precedentes) contra um índice local.
+
+    O índice (CITATION_INDEX_PATH, JSON) lista os identificadores válidos de cada fonte como intervalos e itens
+    avulsos (artigos com letra, como 165-A). A minuta é percorrida uma única vez por uma expressão regular com uma
+    alternativa por tipo de citação; citações fora do índice ou com formato inválido viram avisos para conferência.
+    """
+    UFS = frozenset("AC AL AP AM BA CE DF ES GO MA MT MS MG PA PB PR PE PI RJ RN RS RO RR SC SP SE TO".split())
+    NUMBER_RE = re.compile(r"\d{1,3}(?:\.\d{3})+|\d+") # 918 ou 1.234.567 (pontos só separando milhares)
+    CTB_ITEM_RE = re.compile(r"(\d{1,3})[º°o]?(?:\s*-\s*([a-z]))?", re.I)
+    # Artigos só contam como do CTB se a referência ao código vier logo depois, sem outro artigo ou lei no meio.
+    # O lookahead inicial com as letras que abrem cada alternativa deixa o motor pular o resto do texto sem testá-las.
+    CITATION_RE = re.compile(
+        r"(?=[ARSE])(?:(?P<ctb>\barts?\.?\s*(?:n[º°o.]*\s*)?(?P<ctb_itens>\d{1,3}[º°o]?(?:\s*-\s*[a-z]\b)?(?:\s*(?:,|e|a)\s*\d{1,3}[º°o]?(?:\s*-\s*[a-z]\b)?)*)"
+        r"(?=(?:(?!\barts?\b|\bd[oa]\s+(?:CF\b|CPC\b|CC\b|Constitui|Lei\s+(?!(?:n[º°o.]*\s*)?9\.?503)))[^.;\n]){0,80}?"
+        r"\b(?:CTB\b|C[óo]digo\s+de\s+Tr[âa]nsito|Lei\s+(?:n[º°o.]*\s*)?9\.?503)))"
+        r"|(?P<res>\bResolu[çc](?:[ãa]o|[õo]es)\s+(?:do\s+)?CONTRAN\s+(?:n[º°o.]*\s*)?(?P<res_num>\d+(?:\.\d+)*)(?:\s*/\s*(?P<res_ano>\d{2,4}))?"
+        r"|\bResolu[çc][ãa]o\s+(?:n[º°o.]*\s*)?(?P<res_num2>\d+(?:\.\d+)*)(?:\s*/\s*(?P<res_ano2>\d{2,4}))?\s*,?\s*do\s+CONTRAN\b)"
+        r"|(?P<sum>\bS[úu]mula\s+(?P<sum_vinc>Vinculante\s+)?(?:n[º°o.]*\s*)?(?P<sum_num>\d+(?:\.\d+)*)"
+        r"(?:\s*(?:/|,?\s*d[oa])\s*(?P<sum_trib>STJ\b|STF\b|Superior\s+Tribunal\s+de\s+Justi[çc]a|Supremo\s+Tribunal\s+Federal))?)"
+        r"|(?P<prec>(?-i:\b(?:REsp|AREsp|EREsp|RMS|AgRg|AgInt|EDcl)\b)[^\d\n]{0,30}?(?P<prec_num>\d[\d.]*\d|\d)(?:\s*/\s*(?P<prec_uf>[A-Z]{2})\b)?))",
+        re.I)
+
+    def __init__(self, index):
+        self.sources = {}
+        for source, spec in index.items():
+            valid = {item.upper() for item in spec.get("itens", [])}
+            for start, end in spec.get("intervalos", []):
+                valid.update(str(n) for n in range(start, end + 1))
+            self.sources[source] = {"valid": valid, "description": spec.get("descricao", source), "years": spec.get("anos")}
+
+    @classmethod
+    def load_if_available(cls, path=CITATION_INDEX_PATH):
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                checker = cls(json.load(fh))
+            logger.info(f"CitationChecker: Índice de citações carregado de '{path}' ({sum(len(s['valid']) for s in checker.sources.values())} identificadores).")
+            return checker
+        except FileNotFoundError:
+            logger.info(f"CitationChecker: Nenhum índice de citações em '{path}'; conferência de citações desativada.")
+        except Exception as e:
+            logger.error(f"CitationChecker: Falha ao carregar o índice de citações '{path}': {e}", exc_info=True)
+        return None
+
+    def _known(self, source, identifier):
+        return source in self.sources and identifier in self.sources[source]["valid"]
+
+    def check(self, text):
+        # Lista de {"citacao", "motivo"}, sem repetir a mesma citação
+        issues, seen = [], set()
+        def flag(match, reason):
+            citation = " ".join(match.group(0).split())
+            if citation.lower() not in seen:
+                seen.add(citation.lower())
+                issues.append({"citacao": citation, "motivo": reason})
+
+        for match in self.CITATION_RE.finditer(text):
+            if match.group("ctb"):
+                for number, letter in self.CTB_ITEM_RE.findall(match.group("ctb_itens")):
+                    article = f"{int(number)}-{letter.upper()}" if letter else str(int(number))
+                    if not self._known("ctb", article):
+                        flag(match, f"art. {article} não consta do índice do CTB")
+            elif match.group("res"):
+                number, year = match.group("res_num") or match.group("res_num2"), match.group("res_ano") or match.group("res_ano2")
+                years = (self.sources.get("resolucao_contran") or {}).get("years") or [None, None]
+                if not self.NUMBER_RE.fullmatch(number):
+                    flag(match, "número de resolução malformado")
+                elif year and len(year) == 4 and not ((years[0] or 0) <= int(year) <= (years[1] or datetime.now().year)):
+                    flag(match, f"ano {year} fora do período das resoluções do CONTRAN")
+                elif not self._known("resolucao_contran", number.replace(".", "")):
+                    flag(match, f"resolução {number} não consta do índice do CONTRAN")
+            elif match.group("sum"):
+                number = match.group("sum_num").replace(".", "")
+                court = (match.group("sum_trib") or "").upper()
+                if match.group("sum_vinc"): candidates = ["sumula_vinculante"]
+                elif court.startswith(("STJ", "SUPERIOR")): candidates = ["sumula_stj"]
+                elif court.startswith(("STF", "SUPREMO")): candidates = ["sumula_stf"]
+                else: candidates = ["sumula_stj", "sumula_stf"] # Sem tribunal: basta existir em um deles
+                if not any(self._known(source, number) for source in candidates):
+                    flag(match, f"súmula {number} não consta do índice ({' / '.join(self.sources[s]['description'] for s in candidates if s in self.sources)})")
+            elif match.group("prec"):
+                uf = match.group("prec_uf")
+                if not self.NUMBER_RE.fullmatch(match.group("prec_num")):
+                    flag(match, "número do precedente malformado")
+                elif uf and uf not in self.UFS:
+                    flag(match, f"UF '{uf}' inválida")
+        return issues
+
+class TextFingerprint:
+    """Assinaturas MinHash (one-permutation hashing) sobre shingles de palavras do texto normalizado.
+
+    Os marcadores inseridos pelo PDFProcessor ("=== ARQUIVO ... ===", "=== PÁGINAS ADICIONAIS ... ===", "--- Pág N ---"
+    e o aviso de páginas não extraídas) são descartados, então o mesmo documento reexportado com outro nome,
+    paginação ou orçamento de páginas produz praticamente a mesma assinatura.
+    """
+    NUM_PERM = 128
+    SHINGLE_SIZE = 5
+    MARKER_RE = re.compile(r'^(===\s*(?:ARQUIVO|PÁGINAS ADICIONAIS):.*===|---\s*Pág\s*\d+\s*---|---\s*Págs\s.*não extraídas.*---)\s*$', re.MULTILINE)
+    TOKEN_RE = re.compile(r'\w+')
+    _MAX_HASH = (1 << 64) - 1
+
+    @staticmethod
+    def tokens(text):
+        text = TextFingerprint.MARKER_RE.sub(' ', text or '')
+        normalized = unicodedata.normalize('NFKD', text.lower())
+        normalized = "".join([c for c in normalized if not unicodedata.combining(c)])
+        return TextFingerprint.TOKEN_RE.findall(normalized)
+
+    @staticmethod
+    def _hash64(value):
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    @staticmethod
+    def shingle_hashes(text, shingle_size=SHINGLE_SIZE):
+        tokens = TextFingerprint.tokens(text)
+        if len(tokens) < shingle_size:
+            return {TextFingerprint._hash64(" ".join(tokens))} if tokens else set()
+        return {TextFingerprint._hash64(" ".join(tokens[i:i + shingle_size])) for i in range(len(tokens) - shingle_size + 1)}
+
+    @staticmethod
+    def minhash(text, num_perm=NUM_PERM):
+        # Um único hash por shingle: o resto da divisão escolhe o compartimento e o quociente é o valor
+        signature = [TextFingerprint._MAX_HASH] * num_perm
+        for h in TextFingerprint.shingle_hashes(text):
+            slot, value = h % num_perm, h // num_perm
+            if value < signature[slot]: signature[slot] = value
+        filled = {i for i, v in enumerate(signature) if v != TextFingerprint._MAX_HASH}
+        if not filled or len(filled) == num_perm:
+            return signature
+        # Densificação por rotação: compartimentos vazios herdam do próximo preenchido (com deslocamento)
+        step = TextFingerprint._MAX_HASH // num_perm // num_perm
+        for i in range(num_perm):
+            if i not in filled:
+                distance = next(d for d in range(1, num_perm) if (i + d) % num_perm in filled)
+                signature[i] = signature[(i + distance) % num_perm] + distance * step
+        return signature
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        if not sig_a or not sig_b or len(sig_a) != len(sig_b): return 0.0
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+    @staticmethod
+    def to_bytes(signature): return struct.pack(f'<{len(signature)}Q', *signature)
+
+    @staticmethod
+    def from_bytes(blob): return list(struct.unpack(f'<{len(blob) // 8}Q', blob))
+
+
+class MinutaDelta:
+    """Diferença entre duas versões de uma minuta, por linha (cada parágrafo da minuta é uma linha).
+
+    Formato compacto em JSON: inteiro positivo = manter N linhas, negativo = remover N linhas,
+    lista de strings = inserir essas linhas. Ex.: [12, -1, ["Novo parágrafo."], 30].
+    """
+    @staticmethod
+    def diff(old_text, new_text):
+        old_lines, new_lines = old_text.split("\n"), new_text.split("\n")
+        ops = []
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+            if tag == "equal":
+                ops.append(i2 - i1); continue
+            if i2 > i1: ops.append(-(i2 - i1))
+            if j2 > j1: ops.append(new_lines[j1:j2])
+        return ops
+
+    @staticmethod
+    def apply(old_text, ops):
+        old_lines, result, position = old_text.split("\n"), [], 0
+        for op in ops:
+            if isinstance(op, list):
+                result.extend(op); continue
+            if position + abs(op) > len(old_lines):
+                raise ValueError("Delta incompatível com a versão base.")
+            if op > 0: result.extend(old_lines[position:position + op])
+            position += abs(op)
+        if position != len(old_lines):
+            raise ValueError("Delta incompatível com a versão base.")
+        return "\n".join(result)
+
+
+class CaseMemoryStore:
+    """Histórico persistente (SQLite) de casos já processados: texto extraído + minuta final.
+
+    A busca por casos semelhantes usa LSH sobre as assinaturas MinHash (LSH_BANDS faixas de
+    LSH_ROWS linhas): só os casos que colidem em alguma faixa têm a similaridade estimada.
+    """
+    LSH_BANDS = 64
+    LSH_ROWS = TextFingerprint.NUM_PERM // LSH_BANDS
+
+    def __init__(self, db_path=CASE_MEMORY_DB):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS cases (
+                id TEXT PRIMARY KEY, created_at REAL NOT NULL, updated_at REAL NOT NULL, filenames TEXT NOT NULL,
+                texto TEXT NOT NULL, minuta TEXT NOT NULL, accepted INTEGER NOT NULL DEFAULT 0, signature BLOB NOT NULL)""")
+            conn.execute("CREATE TABLE IF NOT EXISTS case_lsh (band INTEGER NOT NULL, bucket INTEGER NOT NULL, case_id TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_case_lsh_bucket ON case_lsh (band, bucket)")
+            # Dono do caso (mesma identidade de CaseWorkspace): limita o reaproveitamento de duplicatas aos casos do próprio usuário
+            if "owner" not in {row["name"] for row in conn.execute("PRAGMA table_info(cases)")}:
+                conn.execute("ALTER TABLE cases ADD COLUMN owner TEXT")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _band_buckets(self, signature):
+        rows = self.LSH_ROWS
+        return [(band, int.from_bytes(hashlib.blake2b(TextFingerprint.to_bytes(signature[band * rows:(band + 1) * rows]), digest_size=8).digest(), 'little', signed=True))
+                for band in range(self.LSH_BANDS)]
+
+    def add_case(self, texto, minuta, filenames, signature=None, owner=None):
+        signature = signature or TextFingerprint.minhash(texto)
+        case_id, now = uuid.uuid4().hex, time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO cases (id, created_at, updated_at, owner, filenames, texto, minuta, accepted, signature) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                         (case_id, now, now, owner, json.dumps(filenames, ensure_ascii=False), texto, minuta, TextFingerprint.to_bytes(signature)))
+            conn.executemany("INSERT INTO case_lsh (band, bucket, case_id) VALUES (?, ?, ?)",
+                             [(band, bucket, case_id) for band, bucket in self._band_buckets(signature)])
+        return case_id
+
+    def update_minuta(self, case_id, minuta):
+        with self._connect() as conn:
+            conn.execute("UPDATE cases SET minuta = ?, updated_at = ?, accepted = 0 WHERE id = ?", (minuta, time.time(), case_id))
+
+    def mark_accepted(self, case_id, accepted=True):
+        with self._connect() as conn:
+            return conn.execute("UPDATE cases SET accepted = ?, updated_at = ? WHERE id = ?", (1 if accepted else 0, time.time(), case_id)).rowcount > 0
+
+    def get_case(self, case_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM cases WHERE id = ?", (case_id,)).fetchone()
+        if not row: return None
+        return {"id": row["id"], "created_at": row["created_at"], "filenames": json.loads(row["filenames"]),
+                "texto": row["texto"], "minuta": row["minuta"], "accepted": bool(row["accepted"])}
+
+    def find_similar(self, texto, limit=3, min_similarity=CASE_MEMORY_MIN_SIMILARITY, signature=None, since=None, owner=None):
+        start = time.perf_counter()
+        signature = signature or TextFingerprint.minhash(texto)
+        buckets = self._band_buckets(signature)
+        with self._connect() as conn:
+            clause = " OR ".join(["(l.band = ? AND l.bucket = ?)"] * len(buckets))
+            params = [value for pair in buckets for value in pair]
+            if since is not None:
+                clause = f"({clause}) AND c.created_at >= ?"; params.append(since)
+            if owner is not None:
+                clause = f"({clause}) AND c.owner = ?"; params.append(owner)
+            rows = conn.execute(f"SELECT DISTINCT c.id, c.created_at, c.filenames, c.accepted, c.signature FROM case_lsh l JOIN cases c ON c.id = l.case_id WHERE {clause}", params).fetchall()
+        matches = []
+        for row in rows:
+            similarity = TextFingerprint.similarity(signature, TextFingerprint.from_bytes(row["signature"]))
+            if similarity >= min_similarity:
+                matches.append({"id": row["id"], "similarity": similarity, "created_at": row["created_at"],
+                                "filenames": json.loads(row["filenames"]), "accepted": bool(row["accepted"])})
+        matches.sort(key=lambda m: (m["similarity"], m["accepted"]), reverse=True)
+        logger.info(f"CaseMemoryStore: {len(rows)} candidatos LSH, {len(matches)} semelhantes em {(time.perf_counter() - start) * 1000:.1f}ms.")
+        return matches[:limit]
+
+class DocumentDigestCache:
+    """Resumos estruturados de trechos de documentos (SQLite), pela chave de conteúdo calculada no MinutaGenerator.
+
+    A chave inclui o hash do trecho, a versão do prompt de resumo e o modelo: o mesmo PDF em outro caso,
+    um ajuste ou a versão completa depois do rascunho reaproveitam os resumos sem nova chamada ao Gemini.
+    """
+    def __init__(self, db_path=DIGEST_CACHE_DB):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS digests (key TEXT PRIMARY KEY, created_at REAL NOT NULL, source_chars INTEGER NOT NULL, digest TEXT NOT NULL)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT digest FROM digests WHERE key = ?", (key,)).fetchone()
+        return row["digest"] if row else None
+
+    def put(self, key, digest, source_chars=0):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO digests (key, created_at, source_chars, digest) VALUES (?, ?, ?, ?)",
+                         (key, time.time(), source_chars, digest))
+
+class CaseWorkspace:
+    """Casos em andamento (SQLite), endereçados pelo id: texto extraído, arquivos, status e versões da minuta.
+
+    A sessão guarda só o id do caso corrente; o estado fica aqui, então o mesmo usuário pode conduzir
+    vários processos ao mesmo tempo e qualquer instância com acesso ao banco (CASE_WORKSPACE_DB em volume
+    compartilhado) atende qualquer caso. O id é aleatório (128 bits) e funciona como credencial de acesso.
+    As versões são guardadas como MinutaDelta da anterior, com uma versão completa a cada VERSION_SNAPSHOT_INTERVAL.
+    """
+    STATUSES = ("gerando", "ajustando", "pronto", "erro")
+
+    def __init__(self, db_path=CASE_WORKSPACE_DB, files_dir=CASE_FILES_DIR):
+        self.db_path = db_path
+        self.files_dir = files_dir
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS workspace_cases (
+                id TEXT PRIMARY KEY, created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT, status TEXT NOT NULL,
+                filenames TEXT NOT NULL, texto TEXT NOT NULL, memory_case_id TEXT, error TEXT, template TEXT, prazo REAL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS workspace_versions (
+                case_id TEXT NOT NULL, version INTEGER NOT NULL, created_at REAL NOT NULL, kind TEXT NOT NULL,
+                instructions TEXT, minuta TEXT NOT NULL, duration_ms REAL, PRIMARY KEY (case_id, version))""")
+            self._migrate_files_table(conn)
+            conn.execute("""CREATE TABLE IF NOT EXISTS workspace_files (
+                case_id TEXT NOT NULL, position INTEGER NOT NULL, filename TEXT NOT NULL, tipo TEXT, pages INTEGER, omitted TEXT NOT NULL,
+                path TEXT NOT NULL, PRIMARY KEY (case_id, position))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_workspace_owner ON workspace_cases (owner, updated_at)")
+            self._add_missing_columns(conn, "workspace_cases", {"template": "TEXT", "prazo": "REAL"})
+            self._add_missing_columns(conn, "workspace_versions", {"duration_ms": "REAL", "storage": "TEXT", "chars": "INTEGER", "truncated": "INTEGER"})
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _migrate_files_table(conn):
+        # Versões anteriores identificavam os arquivos pelo nome, e uploads com o mesmo nome se sobrescreviam.
+        # A chave agora é a posição do arquivo no upload; as linhas antigas entram na ordem em que foram gravadas.
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(workspace_files)")}
+        if not existing or "position" in existing: return
+        conn.execute("ALTER TABLE workspace_files RENAME TO workspace_files_old")
+        conn.execute("""CREATE TABLE workspace_files (
+            case_id TEXT NOT NULL, position INTEGER NOT NULL, filename TEXT NOT NULL, tipo TEXT, pages INTEGER, omitted TEXT NOT NULL,
+            path TEXT NOT NULL, PRIMARY KEY (case_id, position))""")
+        conn.execute("""INSERT INTO workspace_files (case_id, position, filename, tipo, pages, omitted, path)
+            SELECT case_id, rowid, filename, tipo, pages, omitted, path FROM workspace_files_old""")
+        conn.execute("DROP TABLE workspace_files_old")
+
+    @staticmethod
+    def _add_missing_columns(conn, table, columns):
+        # Bancos criados por versões anteriores não têm as colunas acrescentadas depois
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, column_type in columns.items():
+            if name not in existing: conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def create_case(self, texto, filenames, owner=None, status="gerando", template=None, deadline=None):
+        # deadline: prazo da contestação (timestamp), usado pelo GenerationScheduler para priorizar as gerações do caso
+        case_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO workspace_cases (id, created_at, updated_at, owner, status, filenames, texto, template, prazo) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (case_id, now, now, owner, status, json.dumps(filenames, ensure_ascii=False), texto, template, deadline))
+        logger.info(f"CaseWorkspace: Caso {case_id} criado ({len(filenames)} arquivos, status '{status}').")
+        return case_id
+
+    def set_status(self, case_id, status, error=None):
+        if status not in self.STATUSES:
+            raise ValueError(f"Status de caso inválido: {status}")
+        with self._connect() as conn:
+            conn.execute("UPDATE workspace_cases SET status = ?, error = ?, updated_at = ? WHERE id = ?", (status, error, time.time(), case_id))
+
+    def link_memory_case(self, case_id, memory_case_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE workspace_cases SET memory_case_id = ? WHERE id = ?", (memory_case_id, case_id))
+
+    def find_by_memory_case(self, memory_case_id, owner):
+        # Caso mais recente do dono ligado a um caso do histórico (CaseMemoryStore)
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM workspace_cases WHERE memory_case_id = ? AND owner = ? ORDER BY created_at DESC LIMIT 1",
+                               (memory_case_id, owner)).fetchone()
+        return dict(row) if row else None
+
+    def add_version(self, case_id, minuta, kind, instructions=None, status="pronto", duration_ms=None, truncated=False):
+        # Nova versão vira a minuta atual e o caso passa a `status` ('gerando' enquanto houver versão completa pendente).
+        # truncated: a geração parou em MAX_TOKENS (MinutaGenerator.is_truncated); o texto fica sem aviso embutido
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE") # Número e delta dependem da versão anterior: serializa versões concorrentes
+            version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM workspace_versions WHERE case_id = ?", (case_id,)).fetchone()[0]
+            stored, storage = minuta, "completa"
+            if (version - 1) % VERSION_SNAPSHOT_INTERVAL:
+                delta = json.dumps(MinutaDelta.diff(self._materialize(conn, case_id, version - 1), minuta), ensure_ascii=False)
+                if len(delta) < len(minuta) * 0.8: stored, storage = delta, "delta" # Reescrita quase total: guarda inteira
+            now = time.time()
+            conn.execute("""INSERT INTO workspace_versions (case_id, version, created_at, kind, instructions, minuta, duration_ms, storage, chars, truncated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (case_id, version, now, kind, instructions, stored, duration_ms, storage, len(minuta), int(truncated)))
+            conn.execute("UPDATE workspace_cases SET status = ?, error = NULL, updated_at = ? WHERE id = ?", (status, now, case_id))
+        return version
+
+    def get_case(self, case_id):
+        if not case_id:
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM workspace_cases WHERE id = ?", (case_id,)).fetchone()
+            if not row:
+                return None
+            latest = conn.execute("SELECT version, kind, truncated FROM workspace_versions WHERE case_id = ? ORDER BY version DESC LIMIT 1", (case_id,)).fetchone()
+            minuta = self._materialize(conn, case_id, latest["version"]) if latest else None
+        case = dict(row, filenames=json.loads(row["filenames"]))
+        case["version"], case["minuta"], case["kind"] = (latest["version"], minuta, latest["kind"]) if latest else (0, None, None)
+        case["truncated"] = bool(latest and latest["truncated"])
+        return case
+
+    @staticmethod
+    def _materialize(conn, case_id, version):
+        # Texto completo de uma versão: a última versão completa até ela mais os deltas seguintes, em ordem
+        rows = conn.execute("""SELECT minuta, storage FROM workspace_versions WHERE case_id = ? AND version <= ? AND version >= (
+            SELECT MAX(version) FROM workspace_versions WHERE case_id = ? AND version <= ? AND COALESCE(storage, 'completa') = 'completa')
+            ORDER BY version""", (case_id, version, case_id, version)).fetchall()
+        text = None
+        for row in rows:
+            text = MinutaDelta.apply(text, json.loads(row["minuta"])) if row["storage"] == "delta" else row["minuta"]
+        return text
+
+    def append_text(self, case_id, extra_text):
+        with self._connect() as conn:
+            conn.execute("UPDATE workspace_cases SET texto = texto || ?, updated_at = ? WHERE id = ?", (extra_text, time.time(), case_id))
+
+    def store_deferred_files(self, case_id, deferred):
+        # Guarda os PDFs que tiveram páginas deixadas de fora na extração, para carregá-las se um ajuste pedir
+        if not deferred: return
+        case_dir = os.path.join(self.files_dir, case_id)
+        os.makedirs(case_dir, exist_ok=True)
+        with self._connect() as conn:
+            for index, item in enumerate(deferred):
+                path = os.path.join(case_dir, f"{index}.pdf")
+                with open(path, 'wb') as fh: fh.write(item["content"])
+                conn.execute("INSERT OR REPLACE INTO workspace_files (case_id, position, filename, tipo, pages, omitted, path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (case_id, index, item["filename"], item["tipo"], item["paginas"], json.dumps(item["omitidas"]), path))
+
+    def deferred_files(self, case_id):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT position, filename, tipo, pages, omitted, path FROM workspace_files WHERE case_id = ? ORDER BY position", (case_id,)).fetchall()
+        return [dict(row, omitted=json.loads(row["omitted"])) for row in rows]
+
+    def update_omitted(self, case_id, position, omitted):
+        with self._connect() as conn:
+            conn.execute("UPDATE workspace_files SET omitted = ? WHERE case_id = ? AND position = ?", (json.dumps(omitted), case_id, position))
+
+    def get_version(self, case_id, version):
+        with self._connect() as conn:
+            row = conn.execute("SELECT version, created_at, kind, instructions, duration_ms, truncated FROM workspace_versions WHERE case_id = ? AND version = ?",
+                               (case_id, version)).fetchone()
+            return dict(row, minuta=self._materialize(conn, case_id, version)) if row else None
+
+    def list_versions(self, case_id):
+        with self._connect() as conn:
+            rows = conn.execute("""SELECT version, created_at, kind, instructions, COALESCE(chars, LENGTH(minuta)) AS chars, LENGTH(minuta) AS stored_chars,
+                COALESCE(storage, 'completa') AS storage, duration_ms, truncated FROM workspace_versions WHERE case_id = ? ORDER BY version""",
+                                (case_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_cases(self, owner, limit=20):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, created_at, updated_at, status, filenames, error FROM workspace_cases WHERE owner = ? ORDER BY updated_at DESC LIMIT ?",
+                                (owner, limit)).fetchall()
+        return [dict(row, filenames=json.loads(row["filenames"])) for row in rows]
+
+class UsageLedger:
+    """Registro (SQLite) de cada chamada ao Gemini: tokens, latência, modelo, finish reason e custo estimado.
+
+    O contexto da requisição (sessão, usuário, caso) vem de usage_context_var, então chamadas feitas em
+    threads (seções paralelas, hedging) ficam associadas à mesma sessão. Com USAGE_DAILY_TOKEN_BUDGET
+    (ou USAGE_USER_BUDGETS por usuário) o orçamento diário é conferido antes de cada chamada.
+    """
+    GROUPINGS = {"dia": "date(created_at, 'unixepoch', 'localtime')", "caso": "COALESCE(case_id, '-')",
+                 "usuario": "COALESCE(user_id, '-')", "modelo": "model"}
+
+    def __init__(self, db_path=USAGE_LEDGER_DB, daily_budget=USAGE_DAILY_TOKEN_BUDGET, user_budgets=None,
+                 price_input=USAGE_PRICE_INPUT_PER_MTOK, price_output=USAGE_PRICE_OUTPUT_PER_MTOK):
+        self.db_path = db_path
+        self.daily_budget = daily_budget
+        self.user_budgets = user_budgets if user_budgets is not None else USAGE_USER_BUDGETS
+        self.price_input = price_input
+        self.price_output = price_output
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, request_id TEXT, session_id TEXT,
+                user_id TEXT, case_id TEXT, kind TEXT NOT NULL, model TEXT NOT NULL, prompt_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL, total_tokens INTEGER NOT NULL, latency_ms REAL NOT NULL,
+                finish_reason TEXT, cost_usd REAL NOT NULL, hedge INTEGER NOT NULL DEFAULT 0)""")
+            if "hedge" not in {row["name"] for row in conn.execute("PRAGMA table_info(usage)")}:
+                conn.execute("ALTER TABLE usage ADD COLUMN hedge INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_user_day ON usage (user_id, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_request ON usage (request_id)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def cost(self, prompt_tokens, output_tokens):
+        return (prompt_tokens * self.price_input + output_tokens * self.price_output) / 1_000_000
+
+    def record(self, kind, model_name, prompt_tokens, output_tokens, total_tokens, latency_ms, finish_reason, hedge=False):
+        # hedge: chamada extra do HedgedModelCaller (vencedora ou descartada), cobrada como qualquer outra
+        context = usage_context_var.get() or {}
+        with self._connect() as conn:
+            conn.execute("""INSERT INTO usage (created_at, request_id, session_id, user_id, case_id, kind, model, prompt_tokens,
+                output_tokens, total_tokens, latency_ms, finish_reason, cost_usd, hedge) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (time.time(), request_id_var.get(), context.get("sessao"), context.get("usuario"), context.get("caso"), kind,
+                 model_name, prompt_tokens, output_tokens, total_tokens, latency_ms, finish_reason, self.cost(prompt_tokens, output_tokens), int(hedge)))
+
+    def assign_case(self, request_id, case_id):
+        # No upload o caso só é criado depois da geração: associa as chamadas da requisição a ele
+        with self._connect() as conn:
+            conn.execute("UPDATE usage SET case_id = ? WHERE request_id = ? AND case_id IS NULL", (case_id, request_id))
+
+    def budget_for(self, user_id):
+        return self.user_budgets.get(user_id or "", self.daily_budget)
+
+    def tokens_today(self, user_id):
+        start_of_day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        with self._connect() as conn:
+            row = conn.execute("SELECT COALESCE(SUM(total_tokens), 0) FROM usage WHERE user_id IS ? AND created_at >= ?",
+                               (user_id, start_of_day)).fetchone()
+        return row[0]
+
+    def check_budget(self, estimated_tokens=0):
+        # Retorna None se a chamada pode seguir, ou a mensagem de erro quando o orçamento diário se esgotou
+        user_id = (usage_context_var.get() or {}).get("usuario")
+        budget = self.budget_for(user_id)
+        if not budget:
+            return None
+        used = self.tokens_today(user_id)
+        if used + estimated_tokens > budget:
+            logger.warning(f"UsageLedger: Orçamento diário de '{user_id}' esgotado ({used} + ~{estimated_tokens} > {budget} tokens).")
+            return f"Erro: Orçamento diário de tokens esgotado ({used} de {budget} tokens usados hoje). Tente novamente amanhã."
+        return None
+
+    def report(self, group_by="dia", days=30):
+        if group_by not in self.GROUPINGS:
+            raise ValueError(f"Agrupamento inválido: {group_by}. Use um de {sorted(self.GROUPINGS)}.")
+        with self._connect() as conn:
+            rows = conn.execute(f"""SELECT {self.GROUPINGS[group_by]} AS grupo, COUNT(*) AS chamadas,
+                SUM(prompt_tokens) AS tokens_entrada, SUM(output_tokens) AS tokens_saida, SUM(total_tokens) AS tokens_total,
+                ROUND(AVG(latency_ms), 1) AS latencia_media_ms, ROUND(MAX(latency_ms), 1) AS latencia_max_ms,
+                ROUND(SUM(cost_usd), 6) AS custo_usd, SUM(finish_reason != 'STOP') AS nao_finalizadas, SUM(hedge) AS hedges
+                FROM usage WHERE created_at >= ? GROUP BY grupo ORDER BY {'grupo DESC' if group_by == 'dia' else 'custo_usd DESC'}""",
+                (time.time() - days * 86400,)).fetchall()
+        return [dict(row) for row in rows]
+
+class MinutaExporter:
+    """Exportação da minuta (texto com **negrito**) para DOCX e PDF em threads de fundo.
+
+    Os arquivos ficam em cache no disco pelo hash da minuta, então downloads repetidos da mesma
+    versão são servidos direto do arquivo. A cada arquivo gravado, o cache é limpo por idade
+    (EXPORT_CACHE_TTL_HOURS) e por tamanho total (EXPORT_CACHE_MAX_MB, saindo primeiro os pedidos
+    há mais tempo). O texto é processado em blocos de linhas e gravado de forma incremental
+    (DOCX via zipfile em streaming, PDF via fitz.Story página a página).
+    """
+    FORMATS = {
+        'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'pdf': 'application/pdf',
+    }
+    LINES_PER_BLOCK = 200
+    INVALID_XML_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+    PDF_CSS = "p { font-family: serif; font-size: 12pt; text-align: justify; margin: 0 0 6pt 0; line-height: 1.4; }"
+    DOCX_CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '</Types>')
+    DOCX_RELS = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+        '</Relationships>')
+    DOCX_PARAGRAPH_PROPS = '<w:pPr><w:jc w:val="both"/><w:spacing w:after="120" w:line="360" w:lineRule="auto"/></w:pPr>'
+    DOCX_SECTION = ('<w:sectPr><w:pgSz w:w="11906" w:h="16838"/>'
+        '<w:pgMar w:top="1701" w:right="1134" w:bottom="1134" w:left="1701" w:header="709" w:footer="709" w:gutter="0"/></w:sectPr>')
+
+    def __init__(self, cache_dir=EXPORT_CACHE_DIR, max_workers=EXPORT_WORKERS, max_age_hours=EXPORT_CACHE_TTL_HOURS, max_mb=EXPORT_CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_age_hours = max_age_hours
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def minuta_hash(minuta):
+        return hashlib.sha256(minuta.encode('utf-8')).hexdigest()
+
+    def export_path(self, digest, fmt):
+        return os.path.join(self.cache_dir, f"{digest}.{fmt}")
+
+    def request_export(self, minuta, fmt):
+        # Retorna o hash da minuta e o estado ('pronto' ou 'processando'); agenda a renderização se preciso
+        digest = self.minuta_hash(minuta)
+        path = self.export_path(digest, fmt)
+        if os.path.exists(path):
+            try: os.utime(path) # A idade no cache conta a partir do último pedido
+            except OSError: pass
+            return digest, 'pronto'
+        with self._lock:
+            job = self._jobs.get((digest, fmt))
+            if job is None or job.done(): # Concluído sem arquivo: falhou ou foi removido do cache
+                self._jobs[(digest, fmt)] = self._executor.submit(self._render, minuta, digest, fmt)
+        return digest, 'processando'
+
+    def status(self, digest, fmt):
+        if os.path.exists(self.export_path(digest, fmt)):
+            return 'pronto'
+        with self._lock:
+            job = self._jobs.get((digest, fmt))
+        if job is None or (job.done() and job.exception() is None): # Nunca pedida ou já removida do cache
+            return None
+        if job.done():
+            return 'erro'
+        return 'processando'
+
+    def _render(self, minuta, digest, fmt):
+        start = time.perf_counter()
+        final_path = self.export_path(digest, fmt)
+        tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if fmt == 'docx': self.render_docx(minuta, tmp_path)
+            else: self.render_pdf(minuta, tmp_path)
+            os.replace(tmp_path, final_path) # Publicação atômica: nunca se serve um arquivo pela metade
+            logger.info(f"MinutaExporter: {fmt.upper()} {digest[:12]} gerado em {(time.perf_counter() - start) * 1000:.0f}ms.")
+        except Exception as e:
+            logger.error(f"MinutaExporter: Falha ao gerar {fmt.upper()} {digest[:12]}: {e}", exc_info=True)
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        self.cleanup(keep=final_path)
+
+    def cleanup(self, keep=None):
+        # Apaga as exportações mais antigas que max_age_hours e, se o total passar de max_bytes, as pedidas há mais tempo
+        limit = time.time() - self.max_age_hours * 3600
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try: stat = os.stat(path)
+            except OSError: continue # Removido por outra thread
+            if name.endswith('.tmp') and stat.st_mtime >= limit: continue # Renderização em andamento
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if path == keep or (mtime >= limit and total <= self.max_bytes):
+                continue
+            try: os.remove(path)
+            except OSError: continue
+            digest, _, fmt = os.path.basename(path).partition('.')
+            with self._lock: self._jobs.pop((digest, fmt), None)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"MinutaExporter: {removed} exportações removidas do cache ({total / (1024 * 1024):.1f}MB restantes).")
+
+    @classmethod
+    def _line_blocks(cls, minuta):
+        lines = minuta.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        for i in range(0, len(lines), cls.LINES_PER_BLOCK):
+            yield lines[i:i + cls.LINES_PER_BLOCK]
+
+    @staticmethod
+    def _split_bold(line):
+        # HTMLGenerator.BOLD_RE tem um grupo: o split alterna trechos normais (pares) e em negrito (ímpares)
+        return [(part, i % 2 == 1) for i, part in enumerate(HTMLGenerator.BOLD_RE.split(line)) if part]
+
+    @classmethod
+    def render_docx(cls, minuta, path):
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('[Content_Types].xml', cls.DOCX_CONTENT_TYPES)
+            zf.writestr('_rels/.rels', cls.DOCX_RELS)
+            with zf.open('word/document.xml', 'w') as doc:
+                doc.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                          b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+                for block in cls._line_blocks(minuta):
+                    paragraphs = []
+                    for line in block:
+                        runs = []
+                        for text, bold in cls._split_bold(line):
+                            text = html.escape(cls.INVALID_XML_RE.sub('', text), quote=False)
+                            props = '<w:rPr><w:rFonts w:ascii="Times New Roman" w:hAnsi="Times New Roman"/>' + ('<w:b/>' if bold else '') + '<w:sz w:val="24"/></w:rPr>'
+                            runs.append(f'<w:r>{props}<w:t xml:space="preserve">{text}</w:t></w:r>')
+                        paragraphs.append(f'<w:p>{cls.DOCX_PARAGRAPH_PROPS}{"".join(runs)}</w:p>')
+                    doc.write("".join(paragraphs).encode('utf-8'))
+                doc.write(f'{cls.DOCX_SECTION}</w:body></w:document>'.encode('utf-8'))
+
+    @classmethod
+    def render_pdf(cls, minuta, path):
+        mediabox = fitz.paper_rect("a4")
+        content_rect = mediabox + (72, 72, -72, -72) # Margens de 2,54 cm
+        writer = fitz.DocumentWriter(path)
+        device, where = None, None
+        try:
+            # Cada bloco de linhas vira uma Story própria, continuando na mesma página de onde o anterior parou
+            for block in cls._line_blocks(minuta):
+                paragraphs = "".join([
+                    "<p>" + "".join([f"<b>{html.escape(t)}</b>" if bold else html.escape(t) for t, bold in cls._split_bold(line)]) + "</p>"
+                    if line.strip() else "<p>&#160;</p>" for line in block
+                ])
+                story = fitz.Story(html=paragraphs, user_css=cls.PDF_CSS)
+                more = True
+                while more:
+                    if device is None:
+                        device, where = writer.begin_page(mediabox), content_rect
+                    more, filled = story.place(where)
+                    story.draw(device)
+                    filled = fitz.Rect(filled)
+                    if more or filled.y1 >= content_rect.y1 - 12:
+                        writer.end_page(); device = None
+                    else:
+                        where = fitz.Rect(content_rect.x0, filled.y1, content_rect.x1, content_rect.y1)
+            if device is not None:
+                writer.end_page()
+        finally:
+            writer.close()
+
+class RequestProfiler:
+    """Middleware WSGI que grava um perfil cProfile de requisições escolhidas.
+
+    Uma requisição é perfilada quando traz o cabeçalho X-Profile com o PROFILING_TOKEN (nunca pela URL,
+    que fica em logs e no histórico) ou por amostragem (PROFILING_SAMPLE_RATE). Como envolve o app
+    inteiro, o perfil inclui abertura e gravação da sessão, extração com PyMuPDF e montagem da resposta. Cada relatório é gravado em
+    PROFILE_DIR como .prof (pstats/snakeviz) e .txt (funções ordenadas por tempo acumulado).
+    Requisições não perfiladas pagam apenas a verificação do cabeçalho.
+    """
+    NAME_RE = re.compile(r'^[\w.-]+\.(prof|txt)$')
+
+    def __init__(self, wsgi_app, profile_dir=PROFILE_DIR, token=PROFILING_TOKEN, sample_rate=PROFILING_SAMPLE_RATE, max_reports=PROFILE_MAX_REPORTS):
+        self.wsgi_app = wsgi_app
+        self.profile_dir = profile_dir
+        self.token = token
+        self.sample_rate = sample_rate
+        self.max_reports = max_reports
+        self._lock = threading.Lock()
+
+    def should_profile(self, environ):
+        if self.token:
+            requested = environ.get('HTTP_X_PROFILE')
+            if requested and hmac.compare_digest(requested, self.token):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+
+        path_slug = re.sub(r'[^\w]+', '_', environ.get('PATH_INFO', '/')).strip('_') or 'raiz'
+        report_name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}-{environ.get('REQUEST_METHOD', 'GET')}-{path_slug}"
+        def start_response_with_report(status, headers, exc_info=None):
+            return start_response(status, headers + [('X-Profile-Report', f"{report_name}.txt")], exc_info)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: # Outro profiler já ativo (Python 3.12+ admite um por vez): segue sem perfil
+            return self.wsgi_app(environ, start_response)
+        started_at = time.perf_counter()
+        try:
+            # O corpo é materializado aqui para que a montagem da resposta também entre no perfil
+            body = self.wsgi_app(environ, start_response_with_report)
+            try: return list(body)
+            finally:
+                if hasattr(body, 'close'): body.close()
+        finally:
+            profiler.disable()
+            self._save(profiler, report_name, environ, time.perf_counter() - started_at)
+
+    def _save(self, profiler, report_name, environ, elapsed):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            base_path = os.path.join(self.profile_dir, report_name)
+            profiler.dump_stats(f"{base_path}.prof")
+            summary = io.StringIO()
+            summary.write(f"{environ.get('REQUEST_METHOD')} {environ.get('PATH_INFO')}?{environ.get('QUERY_STRING', '')} - {elapsed * 1000:.1f} ms\n\n")
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(60)
+            with open(f"{base_path}.txt", 'w', encoding='utf-8') as fh: fh.write(summary.getvalue())
+            logger.info(f"RequestProfiler: Perfil '{report_name}' gravado ({elapsed * 1000:.1f} ms).")
+            self._prune()
+        except Exception as e:
+            logger.error(f"RequestProfiler: Falha ao gravar perfil '{report_name}': {e}", exc_info=True)
+
+    def _prune(self):
+        with self._lock:
+            reports = sorted(name[:-5] for name in os.listdir(self.profile_dir) if name.endswith('.prof'))
+            for old_report in reports[:-self.max_reports] if len(reports) > self.max_reports else []:
+                for ext in ('prof', 'txt'):
+                    try: os.remove(os.path.join(self.profile_dir, f"{old_report}.{ext}"))
+                    except FileNotFoundError: pass
+
+    def list_reports(self):
+        if not os.path.isdir(self.profile_dir):
+            return []
+        reports = []
+        for name in sorted(os.listdir(self.profile_dir), reverse=True):
+            if name.endswith('.txt'):
+                with open(os.path.join(self.profile_dir, name), 'r', encoding='utf-8') as fh:
+                    reports.append({"nome": name[:-4], "resumo": fh.readline().strip(),
+                                    "arquivos": [name, f"{name[:-4]}.prof"]})
+        return reports
+
+    def report_path(self, filename):
+        if not self.NAME_RE.match(filename):
+            return None
+        path = os.path.join(self.profile_dir, filename)
+        return path if os.path.exists(path) else None
+
 # --- Instâncias ---
-minuta_generator_instance = MinutaGenerator(model) 
+legal_index_instance = LegalRetrievalIndex.load_if_available(LEGAL_INDEX_DIR)
+citation_checker_instance = CitationChecker.load_if_available(CITATION_INDEX_PATH)
+gemini_pool_instance = GeminiClientPool(ACTUAL_MODEL_NAME_LOADED) if GEMINI_API_KEY else None # Clientes criados sob demanda, sem rede na importação
+hedger_instance = None
+if gemini_pool_instance and HEDGING_ENABLED:
+    hedge_model = GeminiClientPool(HEDGE_MODEL_NAME) if HEDGE_MODEL_NAME else None # O modelo é criado na primeira chamada de hedge
+    hedger_instance = HedgedModelCaller(hedge_model)
+    logger.info(f"Hedging de chamadas ao Gemini ativado (modelo de hedge: '{HEDGE_MODEL_NAME or ACTUAL_MODEL_NAME_LOADED}').")
+prompt_registry_instance = PromptRegistry(PROMPTS_DIR)
+generation_scheduler_instance = GenerationScheduler(GENERATION_CONCURRENCY)
+background_generation_executor = ThreadPoolExecutor(max_workers=BACKGROUND_GENERATION_WORKERS, thread_name_prefix="geracao-completa")
+
+def warm_up_gemini_clients():
+    # Aquecimento explícito dos clientes do Gemini, em segundo plano: chamado ao subir o servidor (bloco __main__) ou,
+    # no gunicorn, em cada worker pelo hook post_worker_init. Importar o módulo nunca abre conexões.
+    if gemini_pool_instance and GEMINI_CLIENT_WARMUP:
+        gemini_pool_instance.start_warm_up()
 pdf_processor_instance = PDFProcessor() 
 minuta_parser_instance = MinutaParser() 
 html_generator_instance = HTMLGenerator() 
+tracer_instance = Tracer() 
+
+# Bancos SQLite, pastas em disco e sessões: criados por init_app com os caminhos de app.config, nunca na importação
+usage_ledger_instance = None
+digest_cache_instance = None
+minuta_generator_instance = None
+case_memory_instance = None
+case_workspace_instance = None
+minuta_exporter_instance = None
+chunked_upload_instance = None
+request_profiler_instance = None
+_init_app_lock = threading.Lock()
+
+def init_app(app, **config):
+    """Cria os bancos, as pastas e a sessão do app com os caminhos de app.config.
+
+    Os caminhos não informados em config nem já presentes em app.config vêm das variáveis de ambiente
+    (USAGE_LEDGER_DB, CASE_WORKSPACE_DB, EXPORT_CACHE_DIR...). Chamadas seguintes não fazem nada: a primeira
+    requisição chama init_app(app) se ninguém o fez antes (gunicorn importa só `app`); `python contestacao.py`
+    e os testes chamam explicitamente, estes com caminhos em tmp_path.
+    """
+    global usage_ledger_instance, digest_cache_instance, minuta_generator_instance, case_memory_instance
+    global case_workspace_instance, minuta_exporter_instance, chunked_upload_instance, request_profiler_instance
+    with _init_app_lock:
+        if "contestacao" in app.extensions:
+            return
+        app.config.update(config)
+        for key, default in {"USAGE_LEDGER_DB": USAGE_LEDGER_DB, "DIGEST_CACHE_DB": DIGEST_CACHE_DB, "CASE_MEMORY_DB": CASE_MEMORY_DB,
+                             "CASE_WORKSPACE_DB": CASE_WORKSPACE_DB, "CASE_FILES_DIR": CASE_FILES_DIR, "EXPORT_CACHE_DIR": EXPORT_CACHE_DIR,
+                             "UPLOAD_SPOOL_DIR": UPLOAD_SPOOL_DIR, "PROFILE_DIR": PROFILE_DIR}.items():
+            app.config.setdefault(key, default)
+
+        os.makedirs(app.config['SESSION_FILE_DIR'], exist_ok=True)
+        Session(app)
+        app.session_interface = TracedSessionInterface(app.session_interface)
+        logger.info(f"Flask-Session configurado para usar o sistema de arquivos em: {app.config['SESSION_FILE_DIR']}")
+
+        usage_ledger_instance = UsageLedger(app.config['USAGE_LEDGER_DB'])
+        digest_cache_instance = DocumentDigestCache(app.config['DIGEST_CACHE_DB'])
+        minuta_generator_instance = MinutaGenerator(gemini_pool_instance, prompt_registry=prompt_registry_instance, legal_index=legal_index_instance,
+                                                    hedger=hedger_instance, usage_ledger=usage_ledger_instance, digest_cache=digest_cache_instance)
+        case_memory_instance = CaseMemoryStore(app.config['CASE_MEMORY_DB'])
+        case_workspace_instance = CaseWorkspace(app.config['CASE_WORKSPACE_DB'], app.config['CASE_FILES_DIR'])
+        minuta_exporter_instance = MinutaExporter(app.config['EXPORT_CACHE_DIR'], EXPORT_WORKERS)
+        chunked_upload_instance = ChunkedUploadStore(app.config['UPLOAD_SPOOL_DIR'], UPLOAD_CHUNK_SIZE)
+
+        wsgi_app = app.wsgi_app
+        if isinstance(wsgi_app, InitOnFirstRequest):
+            wsgi_app = wsgi_app.wsgi_app
+        request_profiler_instance = RequestProfiler(wsgi_app, app.config['PROFILE_DIR'])
+        app.wsgi_app = request_profiler_instance
+        app.extensions["contestacao"] = True
+
+class InitOnFirstRequest:
+    # Middleware WSGI provisório: monta o app (init_app) na primeira requisição e depois sai do caminho
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+
+    def __call__(self, environ, start_response):
+        init_app(self.app)
+        return self.app.wsgi_app(environ, start_response)
+
+app.wsgi_app = InitOnFirstRequest(app)
 
 # --- Rotas Flask ---
+REQUEST_ID_RE = re.compile(r'^[\w.-]{1,64}$')
+
+@app.before_request
+def start_request_trace():
+    # Request id vindo do cliente/proxy (X-Request-ID) ou gerado aqui; o trace continua um traceparent W3C recebido
+    incoming_id = request.headers.get("X-Request-ID", "")
+    g.request_id = incoming_id if REQUEST_ID_RE.match(incoming_id) else uuid.uuid4().hex[:16]
+    g.request_id_token = request_id_var.set(g.request_id)
+    g.trace_span, g.trace_token = tracer_instance.start_span(
+        f"{request.method} {request.url_rule.rule if request.url_rule else request.path}", kind=2,
+        traceparent=request.headers.get("traceparent"), **{"http.method": request.method, "http.target": request.path, "request.id": g.request_id})
+
+@app.before_request
+def bind_usage_context():
+    # Usuário para os orçamentos de tokens: a mesma identidade confiável que define o dono dos casos (_case_owner).
+    # Só lê a sessão: criar o dono aqui gravaria um arquivo de sessão a cada requisição sem cookie (status, estáticos, fila)
+    g.usage_context_token = usage_context_var.set({
+        "sessao": getattr(session, "sid", None), "caso": (request.view_args or {}).get("caso_id") or session.get("caso_id"),
+        "usuario": _case_owner()})
+
+@app.after_request
+def add_request_id_headers(response):
+    if getattr(g, "trace_span", None):
+        g.trace_span["attributes"]["http.status_code"] = response.status_code
+        if response.status_code >= 500: g.trace_span["status"] = {"code": 2}
+        response.headers["X-Request-ID"] = g.request_id
+        response.headers["traceparent"] = f"00-{g.trace_span['traceId']}-{g.trace_span['spanId']}-01"
+    return response
+
+@app.teardown_request
+def end_request_trace(error=None):
+    # Roda depois da gravação da sessão, então o span da requisição cobre também o span sessao.gravacao
+    if getattr(g, "trace_span", None):
+        tracer_instance.end_span(g.trace_span, g.trace_token, error=error)
+        request_id_var.reset(g.request_id_token)
+        g.trace_span = None
+    if getattr(g, "usage_context_token", None):
+        usage_context_var.reset(g.usage_context_token)
+        g.usage_context_token = None
+
 @app.route("/", methods=["GET", "POST"])
 def api_root():
     if request.method == "POST":
@@ -441,45 +2960,92 @@ def api_root():
     # Para GET na raiz, podemos retornar uma mensagem de status da API
     logger.info(f"API GET / status check. Session ID: {session.sid if hasattr(session, 'sid') else 'N/A'}")
     return jsonify(message="API do Gerador de Contestações PGE-MS está online e pronta.",
-                   model_status=f"Modelo Gemini '{ACTUAL_MODEL_NAME_LOADED}' {'carregado' if model else 'NÃO CARREGADO'}",
-                   session_backend="Flask-Session (filesystem)"
+                   model_status=f"Modelo Gemini '{ACTUAL_MODEL_NAME_LOADED}' {'carregado' if gemini_pool_instance else 'NÃO CARREGADO'}",
+                   session_backend="Flask-Session (filesystem)",
+                   hedging=hedger_instance.snapshot() if hedger_instance else None,
+                   clientes_gemini=gemini_pool_instance.snapshot() if gemini_pool_instance else None
                    ), 200
 
+@app.route(f"{STATIC_ASSETS_URL_PREFIX}/<path:filename>", methods=["GET"])
+def static_asset(filename):
+    # CSS/JS da página HTML: servidos da memória com cache de longa duração (o nome muda quando o conteúdo muda)
+    asset = html_generator_instance.static_assets()["files"].get(filename)
+    if not asset:
+        return jsonify(success=False, error="Recurso não encontrado."), 404
+    if asset["etag"].strip('"') in _parse_if_none_match(request.headers.get("If-None-Match", "")):
+        response = make_response("", 304)
+    else:
+        response = make_response(asset["body"])
+        response.headers["Content-Type"] = asset["mimetype"]
+    response.headers["Cache-Control"] = f"public, max-age={STATIC_ASSETS_MAX_AGE}, immutable"
+    response.headers["ETag"] = asset["etag"]
+    return response
+
+def _require_model():
+    if not gemini_pool_instance: # Checagem crucial antes de qualquer ação que dependa do modelo
+        logger.error("API: Tentativa de ação POST sem modelo Gemini carregado.")
+        return jsonify({"success": False, "error": "Erro crítico: O serviço de IA não está configurado no servidor."}), 503 # Service Unavailable
+    return None
+
 def _handle_post_request_api():
     action = request.form.get("action") # O frontend React enviará 'action' no FormData ou URLSearchParams
     logger.debug(f"API POST / Action: {action}. Session ID: {session.sid if hasattr(session, 'sid') else 'N/A'}")
 
-    if not model: # Checagem crucial antes de qualquer ação que dependa do modelo
-        logger.error("API: Tentativa de ação POST sem modelo Gemini carregado.")
-        return jsonify({"success": False, "error": "Erro crítico: O serviço de IA não está configurado no servidor."}), 503 # Service Unavailable
+    unavailable = _require_model()
+    if unavailable: return unavailable
 
     if action == "upload_pdfs":
         return _handle_upload_pdfs_api()
     elif action == "ajustar_minuta":
         return _handle_ajustar_minuta_api()
+    elif action == "aceitar_minuta":
+        return _handle_aceitar_minuta_api()
     
     logger.warning(f"API: Ação POST desconhecida ou ausente: '{action}'")
     return jsonify({"success": False, "error": "Ação inválida ou não especificada."}), 400
 
 def _handle_upload_pdfs_api():
     logger.info("API: Iniciando processamento de upload de PDFs.")
-    # Limpa a sessão ANTES de processar um novo upload para evitar acúmulo de dados antigos.
-    # Mas guarda o que for preciso para o frontend se necessário (embora o frontend agora gerencie mais estado).
-    # Com Flask-Session, session.clear() limpa os dados do lado do servidor para este usuário.
-    session.clear() 
+    # Cada upload cria um novo caso no CaseWorkspace; os casos anteriores continuam acessíveis pelo id
+    owner = _case_owner(create=True)
     
+    # Arquivos enviados antes pela API de upload em partes: a extração já foi feita (ou está em andamento)
+    upload_ids = [u.strip() for u in request.form.get("upload_ids", "").split(",") if u.strip()]
+    draft_id = request.form.get("rascunho_id", "").strip()
+    if draft_id and not upload_ids:
+        upload_ids = chunked_upload_instance.draft_upload_ids(draft_id, owner=owner)
+        if not upload_ids:
+            return jsonify({"success": False, "error": "Por favor, selecione pelo menos um arquivo PDF."}), 400
+    if upload_ids:
+        if len(upload_ids) > MAX_FILES:
+            return jsonify({"success": False, "error": f"Por favor, envie no máximo {MAX_FILES} arquivos."}), 400
+        deferred = []
+        texto_pdfs, filenames, extract_errors = chunked_upload_instance.collect_extractions(upload_ids, owner=owner, deferred=deferred)
+        return _generate_minuta_response(texto_pdfs, filenames, extract_errors, deferred)
+
+    with tracer_instance.span("upload.validacao"):
+        valid_files, error_response = _validate_uploaded_pdfs()
+    if error_response:
+        return error_response
+
+    deferred = [] # Arquivos com páginas fora do orçamento de extração, carregáveis depois por um ajuste
+    texto_pdfs, filenames, extract_errors = pdf_processor_instance.extract_text_from_pdfs(valid_files, deferred=deferred)
+    return _generate_minuta_response(texto_pdfs, filenames, extract_errors, deferred)
+
+def _validate_uploaded_pdfs():
+    # Validação dos arquivos do upload multipart; retorna (arquivos válidos, None) ou (None, resposta de erro)
     if 'pdfs' not in request.files:
         logger.warning("API Upload: Nenhum arquivo PDF enviado (chave 'pdfs' ausente).")
-        return jsonify({"success": False, "error": "Nenhum arquivo PDF enviado."}), 400
+        return None, (jsonify({"success": False, "error": "Nenhum arquivo PDF enviado."}), 400)
     
     files = request.files.getlist('pdfs')
     if not files or all(f.filename == '' for f in files):
         logger.warning("API Upload: Nenhum arquivo PDF selecionado (lista vazia ou nomes vazios).")
-        return jsonify({"success": False, "error": "Nenhum arquivo PDF selecionado."}), 400
+        return None, (jsonify({"success": False, "error": "Nenhum arquivo PDF selecionado."}), 400)
     
     if len(files) > MAX_FILES:
         logger.warning(f"API Upload: Excedido o número máximo de arquivos ({len(files)} > {MAX_FILES}).")
-        return jsonify({"success": False, "error": f"Por favor, envie no máximo {MAX_FILES} arquivos."}), 400
+        return None, (jsonify({"success": False, "error": f"Por favor, envie no máximo {MAX_FILES} arquivos."}), 400)
     
     valid_files, val_errors = [], []
     for f in files:
@@ -495,18 +3061,22 @@ def _handle_upload_pdfs_api():
 
     if val_errors:
          logger.warning(f"API Upload: Erros de validação de arquivos: {val_errors}")
-         return jsonify({"success": False, "error": " ".join(val_errors), "warnings":None}), 400 # Bad Request
+         return None, (jsonify({"success": False, "error": " ".join(val_errors), "warnings":None}), 400) # Bad Request
 
     if not valid_files:
         logger.warning("API Upload: Nenhum arquivo PDF válido fornecido após a filtragem.")
-        return jsonify({"success": False, "error": "Nenhum arquivo PDF válido foi fornecido.", "warnings":None}), 400
-        
-    texto_pdfs, filenames, extract_errors = pdf_processor_instance.extract_text_from_pdfs(valid_files)
-    
+        return None, (jsonify({"success": False, "error": "Nenhum arquivo PDF válido foi fornecido.", "warnings":None}), 400)
+    return valid_files, None
+
+def _generate_minuta_response(texto_pdfs, filenames, extract_errors, deferred=None):
+    # Etapas comuns depois da extração (upload multipart ou upload em partes): sessão, duplicatas, geração
     current_warnings = [] # Inicializa lista de avisos para esta requisição
     if extract_errors: 
         current_warnings.extend(extract_errors)
         logger.warning(f"API Upload: Erros durante a extração de texto dos PDFs: {extract_errors}")
+    for item in deferred or []:
+        current_warnings.append(f"'{item['filename']}' ({item['tipo']}, {item['paginas']} págs.): {item['paginas'] - len(item['omitidas'])} páginas analisadas. "
+                                "As demais podem ser incluídas pedindo no ajuste (ex.: 'considere as páginas 40 a 45 do extrato').")
 
     if not texto_pdfs:
         error_message = "Não foi possível extrair texto dos PDFs enviados."
@@ -515,62 +3085,614 @@ def _handle_upload_pdfs_api():
         logger.error(f"API Upload: {error_message}")
         return jsonify({"success": False, "error": error_message, "warnings": current_warnings}), 400
     
-    # Salva na sessão (lado do servidor com Flask-Session)
-    session['texto_pdfs_original'] = texto_pdfs 
-    session['filenames_processados'] = filenames
-    # Warnings podem ser retornados na resposta JSON se relevante
+    # PDFs reexportados do PJe ou redigitalizados mudam os bytes, mas não o texto: compara a assinatura do texto
+    signature = TextFingerprint.minhash(texto_pdfs)
+    if request.form.get("forcar_nova_geracao") != "true":
+        duplicata = _find_recent_duplicate(texto_pdfs, signature)
+        resposta_duplicata = _reuse_duplicate_case(duplicata, filenames, current_warnings, deferred) if duplicata else None
+        if resposta_duplicata:
+            return resposta_duplicata
+
+    # Busca casos anteriores semelhantes e, se o usuário pedir, usa a minuta aprovada mais próxima como rascunho
+    casos_similares = _find_similar_cases(texto_pdfs, signature)
+    base_minuta = None
+    if request.form.get("usar_caso_similar") == "true":
+        rascunho = next((c for c in casos_similares if c["accepted"] and c["similarity"] >= CASE_MEMORY_DRAFT_MIN_SIMILARITY), None)
+        caso_base = case_memory_instance.get_case(rascunho["id"]) if rascunho else None
+        if caso_base:
+            base_minuta = caso_base["minuta"]
+            current_warnings.append(f"A minuta foi adaptada de um caso anterior semelhante ({rascunho['similarity']:.0%} de similaridade). Revise os dados específicos do caso.")
 
-    logger.info("API Upload: Texto extraído. Chamando o gerador de minutas.")
-    minuta_gerada = minuta_generator_instance.generate_minuta(texto_pdfs)
+    # Tipo de caso: escolhido pelo usuário (tipo_caso) ou pelo classificador local; define o modelo de prompt
+    template = prompt_registry_instance.templates.get(request.form.get("tipo_caso", "")) or prompt_registry_instance.classify(texto_pdfs)[0]
+    prazo = _generation_deadline(texto_pdfs)
+    caso_id = case_workspace_instance.create_case(texto_pdfs, filenames, owner=_case_owner(), template=template.id, deadline=prazo)
+    case_workspace_instance.store_deferred_files(caso_id, deferred)
+    session['caso_id'] = caso_id # Caso corrente da sessão (para clientes que não informam caso_id)
+    logger.info(f"API Upload: Texto extraído. Chamando o gerador de minutas (caso {caso_id}).")
+    modo_geracao = request.form.get("modo_geracao") # 'unica' ou 'secoes'; ausente = GENERATION_MODE
+    modo_geracao = modo_geracao if modo_geracao in ("unica", "secoes") else None
+    if request.form.get("rascunho_rapido", "true" if FAST_DRAFT_ENABLED else "false") == "true":
+        resposta_rascunho = _generate_fast_draft(caso_id, texto_pdfs, filenames, signature, template, base_minuta, modo_geracao, prazo)
+        if resposta_rascunho:
+            data, status_code = resposta_rascunho
+            return jsonify({**data, "tipoCaso": {"id": template.id, "titulo": template.title, "versao": template.version}, "prazo": _format_deadline(prazo),
+                            "filenamesProcessados": filenames, "casosSimilares": _serialize_similar_cases(casos_similares),
+                            "warnings": current_warnings + _citation_warnings(data.get("minutaGerada"))}), status_code
+    started_at = time.perf_counter()
+    minuta_gerada = generation_scheduler_instance.run(functools.partial(
+        minuta_generator_instance.generate_minuta, texto_pdfs, base_minuta=base_minuta, template_id=template.id, mode=modo_geracao),
+        deadline=prazo, case_id=caso_id, kind="completa", ticket_id=_request_ticket_id())
     
     if isinstance(minuta_gerada, str) and minuta_gerada.startswith("Erro:"):
         logger.error(f"API Upload: Erro na geração da minuta pela IA: {minuta_gerada}")
+        case_workspace_instance.set_status(caso_id, "erro", minuta_gerada)
         # Retorna o erro da IA, mas também os warnings da extração de PDF, se houverem.
-        return jsonify({"success": False, "error": minuta_gerada, "warnings": current_warnings}), 500 # Internal Server Error ou Bad Gateway (502) se for erro da IA
+        return jsonify({"success": False, "error": minuta_gerada, "casoId": caso_id, "warnings": current_warnings}), 500 # Internal Server Error ou Bad Gateway (502) se for erro da IA
     else:
-        session['minuta_gerada'] = minuta_gerada # Salva a minuta gerada na sessão
+        versao = case_workspace_instance.add_version(caso_id, minuta_gerada, "geracao", duration_ms=(time.perf_counter() - started_at) * 1000,
+                                                     truncated=MinutaGenerator.is_truncated(minuta_gerada))
+        memory_case_id = _remember_case(texto_pdfs, minuta_gerada, filenames, signature, owner=_case_owner())
+        if memory_case_id: case_workspace_instance.link_memory_case(caso_id, memory_case_id)
+        usage_ledger_instance.assign_case(g.request_id, caso_id)
         logger.info("API Upload: Minuta gerada com sucesso.")
         return jsonify({
             "success": True, 
             "message": "Minuta gerada com sucesso!",
+            "casoId": caso_id,
+            "versao": versao,
+            "tipoCaso": {"id": template.id, "titulo": template.title, "versao": template.version},
+            "prazo": _format_deadline(prazo),
             "minutaGerada": minuta_gerada, # Envia a minuta para o frontend
+            "minutaIncompleta": MinutaGenerator.is_truncated(minuta_gerada),
             "filenamesProcessados": filenames,
-            "warnings": current_warnings # Envia quaisquer warnings de extração
+            "casosSimilares": _serialize_similar_cases(casos_similares),
+            # Avisos da extração, de texto incompleto e citações a conferir
+            "warnings": current_warnings + _truncation_warnings(MinutaGenerator.is_truncated(minuta_gerada)) + _citation_warnings(minuta_gerada)
         }), 200
 
-def _handle_ajustar_minuta_api():
+def _generate_fast_draft(caso_id, texto_pdfs, filenames, signature, template, base_minuta, modo_geracao, prazo=None):
+    # Modo em duas camadas: o rascunho curto volta na resposta e a versão completa é gerada em segundo plano,
+    # entrando como nova versão do caso. Retorna None se o rascunho falhar (a geração completa segue na requisição).
+    started_at = time.perf_counter()
+    with tracer_instance.span("geracao.rascunho", caso=caso_id):
+        rascunho = generation_scheduler_instance.run(functools.partial(
+            minuta_generator_instance.generate_draft, texto_pdfs, base_minuta=base_minuta, template_id=template.id),
+            deadline=prazo, case_id=caso_id, kind="rascunho", ticket_id=_request_ticket_id())
+    duracao_ms = (time.perf_counter() - started_at) * 1000
+    if rascunho.startswith("Erro"):
+        logger.warning(f"API Upload: Rascunho rápido falhou ({rascunho}); gerando a versão completa na requisição.")
+        return None
+    versao = case_workspace_instance.add_version(caso_id, rascunho, "rascunho", status="gerando", duration_ms=duracao_ms,
+                                                 truncated=MinutaGenerator.is_truncated(rascunho))
+    usage_ledger_instance.assign_case(g.request_id, caso_id)
+    background_generation_executor.submit(Tracer.bind(functools.partial(
+        _generate_full_version, caso_id, texto_pdfs, filenames, signature, template.id, base_minuta, modo_geracao, g.request_id, prazo)))
+    logger.info(f"API Upload: Rascunho do caso {caso_id} gerado em {duracao_ms:.0f} ms; versão completa em segundo plano.")
+    return {"success": True, "message": "Rascunho gerado. A versão completa está sendo redigida e substituirá este texto quando ficar pronta.",
+            "casoId": caso_id, "versao": versao, "minutaGerada": rascunho, "minutaIncompleta": MinutaGenerator.is_truncated(rascunho),
+            "rascunho": True, "versaoCompletaPendente": True}, 200
+
+def _generate_full_version(caso_id, texto_pdfs, filenames, signature, template_id, base_minuta, modo_geracao, request_id, prazo=None):
+    # Executada no background_generation_executor, com o contexto (request id, usuário) da requisição do upload
+    usage_context_var.set({**(usage_context_var.get() or {}), "caso": caso_id})
+    started_at = time.perf_counter()
+    try:
+        with tracer_instance.span("geracao.completa", caso=caso_id):
+            minuta = generation_scheduler_instance.run(functools.partial(
+                minuta_generator_instance.generate_minuta, texto_pdfs, base_minuta=base_minuta, template_id=template_id, mode=modo_geracao),
+                deadline=prazo, case_id=caso_id, kind="completa")
+    except Exception as e:
+        logger.error(f"API Upload: Falha na versão completa do caso {caso_id}: {e}", exc_info=True)
+        minuta = f"Erro: {e}"
+    duracao_ms = (time.perf_counter() - started_at) * 1000
+    usage_ledger_instance.assign_case(request_id, caso_id)
+    if minuta.startswith("Erro"):
+        # O rascunho continua como minuta atual; o erro fica registrado no caso para o frontend avisar
+        case_workspace_instance.set_status(caso_id, "pronto", f"A versão completa não pôde ser gerada: {minuta}")
+        return
+    case_workspace_instance.add_version(caso_id, minuta, "completa", duration_ms=duracao_ms, truncated=MinutaGenerator.is_truncated(minuta))
+    caso = case_workspace_instance.get_case(caso_id) # Sem contexto de requisição aqui: o dono vem do caso
+    memory_case_id = _remember_case(texto_pdfs, minuta, filenames, signature, owner=caso["owner"] if caso else None)
+    if memory_case_id: case_workspace_instance.link_memory_case(caso_id, memory_case_id)
+    logger.info(f"API Upload: Versão completa do caso {caso_id} gerada em {duracao_ms:.0f} ms.")
+
+PEDIDO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+def _request_ticket_id():
+    # Id do pedido escolhido pelo cliente (pedido_id) para acompanhar a posição na fila em GET /fila/<pedido_id>
+    pedido_id = request.form.get("pedido_id", "")
+    return pedido_id if PEDIDO_ID_RE.match(pedido_id) else None
+
+def _generation_deadline(texto_pdfs):
+    # Prazo que ordena a fila de geração: urgente (prioridade=urgente), informado (prazo=AAAA-MM-DD ou DD/MM/AAAA) ou lido da citação
+    if request.form.get("prioridade") == "urgente":
+        return time.time()
+    prazo = request.form.get("prazo", "").strip()
+    for formato in ("%Y-%m-%d", "%d/%m/%Y"):
+        try: return datetime.strptime(prazo, formato).replace(hour=23, minute=59).timestamp()
+        except ValueError: pass
+    return GenerationScheduler.deadline_from_text(texto_pdfs)
+
+def _truncation_warnings(truncated):
+    # Aviso de texto incompleto (MAX_TOKENS): fica nos avisos da resposta, não no texto da minuta
+    return [MinutaGenerator.TRUNCATION_WARNING] if truncated else []
+
+def _citation_warnings(minuta):
+    # Citações fora do índice local ou malformadas (CitationChecker) viram avisos para conferência manual
+    if not citation_checker_instance or not minuta:
+        return []
+    with tracer_instance.span("citacoes.verificacao", caracteres=len(minuta)) as span:
+        problemas = citation_checker_instance.check(minuta)
+        span["attributes"]["problemas"] = len(problemas)
+    avisos = [f"Citação a conferir: \"{p['citacao']}\" ({p['motivo']})." for p in problemas[:CITATION_WARNINGS_MAX]]
+    if len(problemas) > CITATION_WARNINGS_MAX:
+        avisos.append(f"Há mais {len(problemas) - CITATION_WARNINGS_MAX} citações a conferir na minuta.")
+    return avisos
+
+def _format_deadline(prazo):
+    return datetime.fromtimestamp(prazo).isoformat(timespec='minutes') if prazo else None
+
+def _find_similar_cases(texto_pdfs, signature):
+    # O histórico de casos é auxiliar: uma falha aqui nunca deve impedir a geração da minuta
+    try:
+        return case_memory_instance.find_similar(texto_pdfs, signature=signature)
+    except Exception as e:
+        logger.error(f"API: Falha ao buscar casos semelhantes: {e}", exc_info=True)
+        return []
+
+def _find_recent_duplicate(texto_pdfs, signature):
+    # Só casos do próprio usuário: reaproveitar a minuta de outro dono revelaria o conteúdo do caso dele
+    since = time.time() - DUPLICATE_UPLOAD_WINDOW_HOURS * 3600
+    try:
+        matches = case_memory_instance.find_similar(texto_pdfs, limit=1, min_similarity=DUPLICATE_UPLOAD_MIN_SIMILARITY, signature=signature,
+                                                    since=since, owner=_case_owner())
+    except Exception as e:
+        logger.error(f"API: Falha ao verificar uploads duplicados: {e}", exc_info=True)
+        return None
+    return matches[0] if matches else None
+
+def _reuse_duplicate_case(duplicata, filenames, current_warnings, deferred=None):
+    caso = case_memory_instance.get_case(duplicata["id"])
+    if not caso:
+        return None
+    # Reaproveita a extração, a minuta, o tipo de caso e o prazo do caso anterior em vez de chamar a IA novamente
+    original = case_workspace_instance.find_by_memory_case(caso["id"], _case_owner()) or {}
+    caso_id = case_workspace_instance.create_case(caso["texto"], filenames, owner=_case_owner(),
+                                                  template=original.get("template"), deadline=original.get("prazo"))
+    case_workspace_instance.store_deferred_files(caso_id, deferred)
+    versao = case_workspace_instance.add_version(caso_id, caso["minuta"], "reaproveitada")
+    case_workspace_instance.link_memory_case(caso_id, caso["id"])
+    session['caso_id'] = caso_id
+    data_caso = datetime.fromtimestamp(duplicata["created_at"]).strftime('%d/%m/%Y %H:%M')
+    current_warnings.append(
+        f"Estes documentos correspondem a um caso já processado em {data_caso} ({duplicata['similarity']:.0%} de similaridade). "
+        "A minuta anterior foi reaproveitada sem nova geração; use 'Solicitar Ajustes' para gerar uma nova versão."
+    )
+    logger.info(f"API Upload: Upload quase idêntico ao caso {caso['id']} ({duplicata['similarity']:.2f}); minuta reaproveitada.")
+    return jsonify({
+        "success": True,
+        "message": "Minuta recuperada de um caso idêntico processado recentemente.",
+        "casoId": caso_id,
+        "versao": versao,
+        "minutaGerada": caso["minuta"],
+        "filenamesProcessados": filenames,
+        "casosSimilares": _serialize_similar_cases([duplicata]),
+        "duplicataDe": caso["id"],
+        "warnings": current_warnings
+    }), 200
+
+def _remember_case(texto_pdfs, minuta, filenames, signature=None, owner=None):
+    try:
+        return case_memory_instance.add_case(texto_pdfs, minuta, filenames, signature=signature, owner=owner)
+    except Exception as e:
+        logger.error(f"API: Falha ao gravar caso no histórico: {e}", exc_info=True)
+        return None
+
+def _serialize_similar_cases(casos):
+    return [{
+        "id": c["id"],
+        "similaridade": round(c["similarity"], 2),
+        "data": datetime.fromtimestamp(c["created_at"]).isoformat(timespec='seconds'),
+        "arquivos": c["filenames"],
+        "aceita": c["accepted"],
+    } for c in casos]
+
+def _case_owner(create=False):
+    # Dono dos casos: usuário autenticado pelo proxy (TRUSTED_USER_HEADER, se configurado) ou um id aleatório
+    # guardado na sessão do servidor. Cabeçalhos enviados pelo cliente nunca definem o dono. O id da sessão só
+    # é criado (create=True) pelas rotas que criam casos ou uploads; nas demais, sem id não há dono (None).
+    if TRUSTED_USER_HEADER and request.headers.get(TRUSTED_USER_HEADER):
+        return request.headers[TRUSTED_USER_HEADER]
+    if create and "usuario" not in session:
+        session["usuario"] = uuid.uuid4().hex
+        context = usage_context_var.get()
+        if context is not None: context["usuario"] = session["usuario"] # As chamadas ao Gemini desta requisição já contam para ele
+    return session.get("usuario")
+
+def _owned_case(caso_id):
+    # Caso de outro dono é tratado como inexistente (404), sem revelar que o id existe
+    caso = case_workspace_instance.get_case(caso_id)
+    owner = _case_owner()
+    return caso if caso and owner and caso["owner"] == owner else None
+
+def _resolve_case(caso_id=None):
+    # Caso informado na URL/formulário/query ou, na falta dele, o caso corrente da sessão
+    caso_id = caso_id or request.form.get("caso_id") or request.args.get("caso_id") or session.get("caso_id")
+    return _owned_case(caso_id)
+
+def _handle_ajustar_minuta_api(caso_id=None):
     logger.info("API: Iniciando ajuste de minuta.")
     instrucoes = request.form.get("instrucoes_ajuste", "").strip()
     
-    # Com Flask-Session, 'texto_pdfs_original' é lido da sessão do servidor.
-    texto_original_final = session.get("texto_pdfs_original")
-
-    if not texto_original_final:
-        logger.warning("API Ajuste: Texto original para ajuste não encontrado na sessão.")
-        return jsonify({"success": False, "error": "Sessão expirada ou texto original não encontrado. Faça um novo upload."}), 400
+    caso = _resolve_case(caso_id)
+    if not caso:
+        logger.warning("API Ajuste: Caso para ajuste não encontrado.")
+        return jsonify({"success": False, "error": "Caso não encontrado ou expirado. Faça um novo upload."}), 400
+    if caso["status"] == "gerando" and caso["kind"] == "rascunho":
+        return jsonify({"success": False, "error": "A versão completa desta minuta ainda está sendo gerada. Aguarde para solicitar ajustes.", "casoId": caso["id"]}), 409
+    texto_original_final, paginas_carregadas = _load_deferred_pages(caso, instrucoes)
 
     if not instrucoes:
         logger.warning("API Ajuste: Tentativa de ajuste sem instruções.")
         return jsonify({"success": False, "error": "Por favor, forneça instruções para o ajuste."}), 400
     
-    # A checagem 'if not model:' já foi feita em _handle_post_request_api
+    # A checagem do modelo (_require_model) já foi feita em _handle_post_request_api
     
-    logger.info(f"API Ajuste: Ajustando minuta com instruções: '{instrucoes[:100]}...'")
-    nova_minuta = minuta_generator_instance.generate_minuta(texto_original_final, instructions=instrucoes)
+    logger.info(f"API Ajuste: Ajustando minuta do caso {caso['id']} com instruções: '{instrucoes[:100]}...'")
+    case_workspace_instance.set_status(caso["id"], "ajustando")
+    nova_minuta = generation_scheduler_instance.run(functools.partial(
+        minuta_generator_instance.generate_minuta, texto_original_final, instructions=instrucoes, template_id=caso["template"]),
+        deadline=caso["prazo"], case_id=caso["id"], kind="ajuste", ticket_id=_request_ticket_id())
+    usage_ledger_instance.assign_case(g.request_id, caso["id"])
     
     if isinstance(nova_minuta, str) and nova_minuta.startswith("Erro:"):
         logger.error(f"API Ajuste: Erro no ajuste da minuta pela IA: {nova_minuta}")
-        return jsonify({"success": False, "error": f"Falha no ajuste: {nova_minuta}"}), 500
+        case_workspace_instance.set_status(caso["id"], "pronto" if caso["minuta"] else "erro", nova_minuta) # A versão anterior continua válida
+        return jsonify({"success": False, "error": f"Falha no ajuste: {nova_minuta}", "casoId": caso["id"]}), 500
     else:
-        session['minuta_gerada'] = nova_minuta # Atualiza a minuta na sessão do servidor
+        versao = case_workspace_instance.add_version(caso["id"], nova_minuta, "ajuste", instructions=instrucoes,
+                                                     truncated=MinutaGenerator.is_truncated(nova_minuta))
+        session['caso_id'] = caso["id"]
+        conteudo = _minuta_payload(caso["id"], nova_minuta, request.form.get("versao_base", ""))
+        if caso["memory_case_id"]:
+            try: case_memory_instance.update_minuta(caso["memory_case_id"], nova_minuta)
+            except Exception as e: logger.error(f"API Ajuste: Falha ao atualizar caso no histórico: {e}", exc_info=True)
         logger.info("API Ajuste: Minuta ajustada com sucesso.")
         return jsonify({
             "success": True, 
             "message": "Minuta ajustada com sucesso!",
-            "minutaGerada": nova_minuta, # Envia a nova minuta para o frontend
-            "filenamesProcessados": session.get('filenames_processados', []) # Reenvia os nomes dos arquivos
+            "casoId": caso["id"],
+            "versao": versao,
+            **conteudo, # Nova minuta completa (minutaGerada) ou só o delta sobre a versão que o cliente já tem
+            "minutaIncompleta": MinutaGenerator.is_truncated(nova_minuta),
+            "filenamesProcessados": caso["filenames"], # Reenvia os nomes dos arquivos
+            "warnings": [f"Incluídas as páginas {p['paginas']} de '{p['arquivo']}' a pedido do ajuste." for p in paginas_carregadas]
+                        + _truncation_warnings(MinutaGenerator.is_truncated(nova_minuta)) + _citation_warnings(nova_minuta)
         }), 200
 
+# Pedidos de ajuste que indicam a necessidade das páginas não extraídas no upload
+DEFERRED_PAGES_RE = re.compile(r"anexos?\b|extratos?\b|prontu[áa]rios?\b|[íi]ntegra\b|documentos? completos?|todas as p[áa]ginas|\b(?:p[áa]g(?:ina)?s?|fls?)\.?\s*\d", re.I)
+PAGE_REFERENCE_RE = re.compile(r"\b(?:p[áa]g(?:ina)?s?|fls?)\.?\s*(\d+)(?:\s*(?:a|-|até)\s*(\d+))?", re.I)
+
+def _requested_pages(instrucoes, deferred):
+    # Páginas (0-based) citadas no ajuste, por posição do arquivo; None se o ajuste não cita páginas.
+    # A referência vale para o arquivo nomeado no trecho seguinte (ou, se nenhum, no anterior) e, sem arquivo
+    # citado, para todos. Intervalos inválidos (início < 1, fim < início) são ignorados e cada intervalo é
+    # limitado às páginas do arquivo, então "fls. 1 a 999999999" não gera um conjunto gigante.
+    matches = list(PAGE_REFERENCE_RE.finditer(instrucoes))
+    if not matches:
+        return None
+    normalize = lambda text: re.sub(r"[_\-\s]+", " ", text.lower())
+    stems = {item["position"]: normalize(item["filename"].rsplit(".", 1)[0]) for item in deferred}
+    requested = {item["position"]: set() for item in deferred}
+    for n, match in enumerate(matches):
+        start, end = int(match.group(1)), int(match.group(2) or match.group(1))
+        if start < 1 or end < start: continue
+        after = normalize(instrucoes[match.end():matches[n + 1].start() if n + 1 < len(matches) else len(instrucoes)])
+        before = normalize(instrucoes[matches[n - 1].end() if n else 0:match.start()])
+        named = [pos for pos, stem in stems.items() if stem and stem in after] or [pos for pos, stem in stems.items() if stem and stem in before]
+        for item in deferred:
+            if named and item["position"] not in named: continue
+            requested[item["position"]].update(range(start - 1, min(end, max(item["omitted"]) + 1)))
+    return requested
+
+def _load_deferred_pages(caso, instrucoes):
+    # Extrai sob demanda as páginas deixadas de fora no upload quando o ajuste as pede (explicitamente com
+    # carregar_paginas=true ou citando anexos/páginas). Páginas citadas são carregadas só elas; senão, todas
+    # as omitidas até EXTRACTION_CHAR_BUDGET. Retorna (texto do caso atualizado, páginas carregadas por arquivo).
+    deferred = [f for f in case_workspace_instance.deferred_files(caso["id"]) if f["omitted"]]
+    if not deferred or not (request.form.get("carregar_paginas") == "true" or DEFERRED_PAGES_RE.search(instrucoes)):
+        return caso["texto"], []
+    requested = _requested_pages(instrucoes, deferred)
+    extra_text, loaded, char_budget = "", [], EXTRACTION_CHAR_BUDGET
+    for item in deferred:
+        pages = [i for i in item["omitted"] if requested is None or i in requested.get(item["position"], ())]
+        if not pages or char_budget <= 0: continue
+        with open(item["path"], 'rb') as fh:
+            block, error, still_omitted = PDFProcessor.extract_pages(item["filename"], fh.read(), pages=pages, char_budget=char_budget, header="PÁGINAS ADICIONAIS")
+        extracted = [i for i in pages if i not in still_omitted]
+        case_workspace_instance.update_omitted(caso["id"], item["position"], [i for i in item["omitted"] if i not in extracted])
+        if block:
+            extra_text += block; char_budget -= len(block)
+            loaded.append({"arquivo": item["filename"], "paginas": PDFProcessor.page_ranges(extracted)})
+        elif error: logger.warning(f"API Ajuste: {error}")
+    if extra_text:
+        case_workspace_instance.append_text(caso["id"], extra_text)
+        logger.info(f"API Ajuste: Páginas carregadas sob demanda no caso {caso['id']}: {loaded}")
+    return caso["texto"] + extra_text, loaded
+
+def _handle_aceitar_minuta_api(caso_id=None):
+    # Marca a minuta atual como aprovada, tornando-a elegível como rascunho para casos semelhantes
+    caso = _resolve_case(caso_id)
+    memory_case_id = caso["memory_case_id"] if caso else None
+    if not memory_case_id or not case_memory_instance.mark_accepted(memory_case_id):
+        logger.warning("API Aceite: Nenhum caso do histórico associado ao caso informado.")
+        return jsonify({"success": False, "error": "Nenhuma minuta gerada para este caso para aprovar."}), 400
+    logger.info(f"API Aceite: Minuta do caso {caso['id']} (histórico {memory_case_id}) marcada como aprovada.")
+    return jsonify({"success": True, "message": "Minuta aprovada e registrada no histórico de casos.", "casoId": caso["id"]}), 200
+
+@app.route("/casos", methods=["GET", "POST"])
+def api_casos():
+    # POST cria um caso a partir de PDFs (mesmos campos da ação upload_pdfs); GET lista os casos do usuário
+    if request.method == "POST":
+        unavailable = _require_model()
+        return unavailable or _handle_upload_pdfs_api()
+    casos = case_workspace_instance.list_cases(_case_owner())
+    return jsonify({"success": True, "casos": [{
+        "casoId": c["id"], "status": c["status"], "arquivos": c["filenames"], "erro": c["error"],
+        "criadoEm": datetime.fromtimestamp(c["created_at"]).isoformat(timespec='seconds'),
+        "atualizadoEm": datetime.fromtimestamp(c["updated_at"]).isoformat(timespec='seconds'),
+    } for c in casos]}), 200
+
+@app.route("/casos/<caso_id>", methods=["GET"])
+def api_caso(caso_id):
+    caso = _owned_case(caso_id)
+    if not caso:
+        return jsonify({"success": False, "error": "Caso não encontrado."}), 404
+    return jsonify({
+        "success": True, "casoId": caso["id"], "status": caso["status"], "erro": caso["error"], "tipoCaso": caso["template"],
+        "prazo": _format_deadline(caso["prazo"]), "fila": generation_scheduler_instance.status(case_id=caso["id"]),
+        "filenamesProcessados": caso["filenames"], "versao": caso["version"], "minutaGerada": caso["minuta"],
+        "minutaIncompleta": caso["truncated"], "avisos": _truncation_warnings(caso["truncated"]),
+        "avisosCitacoes": _citation_warnings(caso["minuta"]),
+        "rascunho": caso["kind"] == "rascunho", "versaoCompletaPendente": caso["status"] == "gerando" and caso["kind"] == "rascunho",
+        "versoes": [{"versao": v["version"], "tipo": v["kind"], "instrucoes": v["instructions"], "caracteres": v["chars"],
+                     "armazenamento": v["storage"], "caracteresArmazenados": v["stored_chars"],
+                     "duracaoMs": round(v["duration_ms"]) if v["duration_ms"] is not None else None, "incompleta": bool(v["truncated"]),
+                     "data": datetime.fromtimestamp(v["created_at"]).isoformat(timespec='seconds')}
+                    for v in case_workspace_instance.list_versions(caso_id)],
+    }), 200
+
+@app.route("/casos/<caso_id>/versoes/<int:versao>", methods=["GET"])
+def api_versao_caso(caso_id, versao):
+    # Texto completo da versão ou, com ?desde=<versão que o cliente já tem>, apenas o delta (MinutaDelta) até ela
+    version = case_workspace_instance.get_version(caso_id, versao) if _owned_case(caso_id) else None
+    if not version:
+        return jsonify({"success": False, "error": "Versão não encontrada."}), 404
+    return jsonify({"success": True, "casoId": caso_id, "versao": versao, "tipo": version["kind"], "instrucoes": version["instructions"],
+                    "minutaIncompleta": bool(version["truncated"]),
+                    **_minuta_payload(caso_id, version["minuta"], request.args.get("desde", ""))}), 200
+
+def _minuta_payload(caso_id, minuta, versao_base):
+    # {"minutaGerada": texto} ou, se a versão base existir e o delta for menor que o texto, {"delta", "versaoBase", "caracteres"}
+    base = case_workspace_instance.get_version(caso_id, int(versao_base)) if versao_base.isdigit() else None
+    if base:
+        delta = MinutaDelta.diff(base["minuta"], minuta)
+        if len(json.dumps(delta, ensure_ascii=False)) < len(minuta):
+            return {"delta": delta, "versaoBase": base["version"], "caracteres": len(minuta)}
+    return {"minutaGerada": minuta}
+
+@app.route("/casos/<caso_id>/ajustar", methods=["POST"])
+def api_ajustar_caso(caso_id):
+    unavailable = _require_model()
+    return unavailable or _handle_ajustar_minuta_api(caso_id)
+
+@app.route("/casos/<caso_id>/aceitar", methods=["POST"])
+def api_aceitar_caso(caso_id):
+    return _handle_aceitar_minuta_api(caso_id)
+
+@app.route("/fila/<pedido_id>", methods=["GET"])
+def api_posicao_fila(pedido_id):
+    # Posição e espera estimada de um pedido de geração (pedido_id enviado no upload ou no ajuste)
+    situacao = generation_scheduler_instance.status(ticket_id=pedido_id)
+    if not situacao:
+        return jsonify({"success": False, "error": "Pedido não está na fila (concluído ou inexistente)."}), 404
+    return jsonify({"success": True, **situacao}), 200
+
+@app.route("/uploads", methods=["POST"])
+def api_iniciar_upload():
+    # Inicia um upload retomável: o cliente envia as partes em PUT /uploads/<id>/partes/<indice>
+    try: size = int(request.form.get("tamanho", "0"))
+    except ValueError: size = 0
+    upload_id, meta = chunked_upload_instance.init_upload(request.form.get("nome_arquivo"), size, request.form.get("sha256"),
+                                                          draft_id=request.form.get("rascunho_id") or None, owner=_case_owner(create=True))
+    return jsonify({"success": True, "uploadId": upload_id, "tamanhoParte": meta["chunk_size"], "totalPartes": meta["total_chunks"], "partesRecebidas": []}), 201
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def api_status_upload(upload_id):
+    # Permite retomar: o cliente reenvia apenas as partes que não constam em partesRecebidas
+    status = chunked_upload_instance.status(upload_id, owner=_case_owner())
+    return jsonify({"success": True, "uploadId": upload_id, "status": status["status"], "tamanhoParte": status["chunk_size"],
+                    "totalPartes": status["total_chunks"], "partesRecebidas": status["received"]}), 200
+
+@app.route("/uploads/<upload_id>/partes/<int:index>", methods=["PUT"])
+def api_enviar_parte(upload_id, index):
+    chunked_upload_instance.put_chunk(upload_id, index, request.get_data(cache=False), _case_owner(), request.headers.get("X-Chunk-Sha256"))
+    return jsonify({"success": True, "parte": index}), 200
+
+@app.route("/uploads/<upload_id>/concluir", methods=["POST"])
+def api_concluir_upload(upload_id):
+    meta = chunked_upload_instance.complete(upload_id, owner=_case_owner())
+    return jsonify({"success": True, "uploadId": upload_id, "status": meta["status"], "sha256": meta["sha256"]}), 200
+
+@app.route("/rascunhos", methods=["POST"])
+def api_criar_rascunho():
+    # Rascunho do caso: a tela de upload envia cada PDF assim que selecionado, e a extração corre em segundo plano
+    return jsonify({"success": True, "rascunhoId": chunked_upload_instance.create_draft(owner=_case_owner(create=True))}), 201
+
+@app.route("/rascunhos/<draft_id>", methods=["GET"])
+def api_status_rascunho(draft_id):
+    return jsonify({"success": True, "rascunhoId": draft_id, "arquivos": chunked_upload_instance.draft_status(draft_id, owner=_case_owner())}), 200
+
+@app.route("/rascunhos/<draft_id>/arquivos/<upload_id>", methods=["DELETE"])
+def api_remover_arquivo_rascunho(draft_id, upload_id):
+    owner = _case_owner()
+    chunked_upload_instance.remove_from_draft(draft_id, upload_id, owner=owner)
+    return jsonify({"success": True, "arquivos": chunked_upload_instance.draft_status(draft_id, owner=owner)}), 200
+
+@app.route("/minuta", methods=["GET"])
+def api_minuta_atual():
+    # Recurso da minuta atual do caso (?caso_id= ou o caso corrente da sessão), com ETag forte derivado do
+    # hash do texto: o frontend pode revalidar (If-None-Match) a qualquer momento e só recebe o texto quando ele mudou
+    caso = _resolve_case()
+    minuta = caso["minuta"] if caso else None
+    if not minuta:
+        return jsonify({"success": False, "error": "Nenhuma minuta gerada nesta sessão."}), 404
+    digest = hashlib.sha256(minuta.encode('utf-8')).hexdigest()[:32]
+    if digest in _parse_if_none_match(request.headers.get("If-None-Match", "")):
+        response = make_response("", 304)
+        # O 304 repete o ETag da representação que o cliente já tem (possivelmente a comprimida)
+        encoding = _choose_content_encoding(request.headers.get("Accept-Encoding", ""))
+        response.headers["ETag"] = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+    else:
+        response = make_response(jsonify({
+            "success": True,
+            "casoId": caso["id"],
+            "minutaGerada": minuta,
+            "filenamesProcessados": caso["filenames"],
+            "hash": digest,
+        }))
+        response.headers["ETag"] = f'"{digest}"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+@app.route("/minuta/exportar", methods=["POST"])
+def api_exportar_minuta():
+    # Agenda a renderização da minuta atual em DOCX/PDF; o cliente consulta a URL retornada até ficar pronta
+    formato = (request.form.get("formato") or "").lower()
+    caso = _resolve_case()
+    minuta = caso["minuta"] if caso else None
+    if formato not in MinutaExporter.FORMATS:
+        return jsonify({"success": False, "error": "Formato de exportação inválido. Use 'docx' ou 'pdf'."}), 400
+    if not minuta:
+        return jsonify({"success": False, "error": "Nenhuma minuta gerada nesta sessão."}), 404
+    digest, status = minuta_exporter_instance.request_export(minuta, formato)
+    logger.info(f"API Exportação: {formato.upper()} da minuta {digest[:12]} - {status}.")
+    return jsonify({"success": True, "status": status, "hash": digest, "url": f"/minuta/exportar/{digest}.{formato}?caso_id={caso['id']}"}), (200 if status == 'pronto' else 202)
+
+@app.route("/minuta/exportar/<digest>.<formato>", methods=["GET"])
+def api_baixar_minuta_exportada(digest, formato):
+    caso = _resolve_case()
+    minuta = caso["minuta"] if caso else None
+    # Só libera exportações da minuta atual do caso
+    if formato not in MinutaExporter.FORMATS or not minuta or MinutaExporter.minuta_hash(minuta) != digest:
+        return jsonify({"success": False, "error": "Exportação não encontrada."}), 404
+    status = minuta_exporter_instance.status(digest, formato)
+    if status == 'pronto':
+        response = send_file(minuta_exporter_instance.export_path(digest, formato), mimetype=MinutaExporter.FORMATS[formato],
+                             as_attachment=True, download_name=f"contestacao.{formato}", etag=digest)
+        response.headers["Cache-Control"] = f"private, max-age={STATIC_ASSETS_MAX_AGE}, immutable" # O hash identifica o conteúdo
+        return response
+    if status == 'erro':
+        return jsonify({"success": False, "status": status, "error": "Falha ao gerar o arquivo. Solicite a exportação novamente."}), 500
+    if status is None:
+        return jsonify({"success": False, "error": "Exportação não solicitada para esta minuta."}), 404
+    return jsonify({"success": True, "status": status}), 202
+
+def _parse_if_none_match(header_value):
+    # Aceita tanto o ETag original quanto as variantes comprimidas ("<hash>-gzip"/"<hash>-br")
+    tags = set()
+    for tag in header_value.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"): tag = tag[2:]
+        tag = tag.strip('"')
+        for suffix in ("-gzip", "-br"):
+            if tag.endswith(suffix): tag = tag[:-len(suffix)]
+        if tag: tags.add(tag)
+    return tags
+
+def _choose_content_encoding(accept_encoding):
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try: quality = float(params.strip()[2:])
+            except ValueError: quality = 0.0
+        if name: accepted[name] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+def _require_admin():
+    # Só pelo cabeçalho: tokens na URL ficam em logs de acesso, no histórico do navegador e no Referer
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return jsonify({"success": False, "error": "Acesso negado à área administrativa."}), 403
+    return None
+
+@app.route("/admin/uso", methods=["GET"])
+def api_relatorio_uso():
+    # Tokens, latência e custo agregados por dia, caso, usuário ou modelo (?agrupar=...&dias=...)
+    denied = _require_admin()
+    if denied: return denied
+    try:
+        relatorio = usage_ledger_instance.report(request.args.get("agrupar", "dia"), int(request.args.get("dias", "30")))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify({"success": True, "relatorio": relatorio}), 200
+
+@app.route("/admin/prompts", methods=["GET"])
+def api_modelos_prompt():
+    # Modelos de prompt carregados (versão em uso, tamanho do prefixo) com latência e tokens por modelo desde o início
+    denied = _require_admin()
+    if denied: return denied
+    return jsonify({"success": True, "padrao": prompt_registry_instance.default.id, "modelos": prompt_registry_instance.snapshot()}), 200
+
+@app.route("/admin/fila", methods=["GET"])
+def api_fila_geracao():
+    denied = _require_admin()
+    if denied: return denied
+    return jsonify({"success": True, **generation_scheduler_instance.snapshot()}), 200
+
+@app.route("/admin/perfis", methods=["GET"])
+def api_listar_perfis():
+    denied = _require_admin()
+    if denied: return denied
+    return jsonify({"success": True, "perfis": request_profiler_instance.list_reports()}), 200
+
+@app.route("/admin/perfis/<filename>", methods=["GET"])
+def api_baixar_perfil(filename):
+    denied = _require_admin()
+    if denied: return denied
+    path = request_profiler_instance.report_path(filename)
+    if not path:
+        return jsonify({"success": False, "error": "Perfil não encontrado."}), 404
+    mimetype = "text/plain; charset=utf-8" if filename.endswith(".txt") else "application/octet-stream"
+    return send_file(path, mimetype=mimetype, as_attachment=filename.endswith(".prof"), download_name=filename)
+
+@app.after_request
+def compress_response(response):
+    # Negociação de gzip/brotli para as respostas da API (a minuta pode ter dezenas de KB)
+    response.headers.add("Vary", "Accept-Encoding")
+    if (response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    encoding = _choose_content_encoding(request.headers.get("Accept-Encoding", ""))
+    body = response.get_data()
+    if not encoding or len(body) < COMPRESSION_MIN_BYTES:
+        return response
+    compressed = brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, compresslevel=6)
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    etag = response.headers.get("ETag")
+    if etag and etag.endswith('"'): # ETag forte identifica a representação: difere por codificação
+        response.headers["ETag"] = f'{etag[:-1]}-{encoding}"'
+    return response
+
 # --- Tratamento de Erros HTTP (adaptados para retornar JSON) ---
 @app.errorhandler(404)
 def not_found_error_api(error): 
@@ -582,23 +3704,42 @@ def internal_error_api(error):
     logger.error(f"API 500: {error}", exc_info=True)
     return jsonify(success=False, error="Erro interno do servidor.", message="Ocorreu um erro inesperado no servidor. Tente novamente mais tarde."), 500
 
+@app.errorhandler(UploadRejected)
+def upload_rejected_api(error):
+    logger.warning(f"API Upload: Upload recusado durante o recebimento: {error.message}")
+    return jsonify({"success": False, "error": error.message, "warnings": None}), error.status_code
+
 @app.errorhandler(413) # Payload Too Large (ex: se o upload de arquivos for muito grande)
 def too_large_error_api(error): 
     logger.warning(f"API 413: Payload muito grande. Content length: {request.content_length} - {error}")
-    # A configuração de MAX_CONTENT_LENGTH do Flask pode ser usada para limitar uploads
-    # app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # Ex: 16MB
+    # MAX_CONTENT_LENGTH (definido nas constantes) faz o Werkzeug recusar o corpo antes de lê-lo
     max_mb = app.config.get('MAX_CONTENT_LENGTH', MAX_FILES * MAX_FILE_SIZE) / (1024*1024) 
     return jsonify(success=False, error=f"Conteúdo da requisição muito grande. Limite aproximado: {max_mb:.1f} MB."), 413
 
 # --- Execução da Aplicação ---
 # (O bloco if __name__ == "__main__": permanece o mesmo)
 if __name__ == "__main__":
-    if not model: 
+    if len(sys.argv) >= 2 and sys.argv[1] == "uso":
+        init_app(app)
+        # Uso: python contestacao.py uso [dia|caso|usuario|modelo] [dias]
+        relatorio = usage_ledger_instance.report(sys.argv[2] if len(sys.argv) > 2 else "dia", int(sys.argv[3]) if len(sys.argv) > 3 else 30)
+        print(f"{'GRUPO':<36} {'CHAMADAS':>8} {'ENTRADA':>10} {'SAÍDA':>10} {'LAT.MÉDIA ms':>12} {'CUSTO US$':>10} {'NÃO FINAL.':>10}")
+        for linha in relatorio:
+            print(f"{str(linha['grupo']):<36} {linha['chamadas']:>8} {linha['tokens_entrada']:>10} {linha['tokens_saida']:>10} "
+                  f"{linha['latencia_media_ms']:>12} {linha['custo_usd']:>10.4f} {linha['nao_finalizadas']:>10}")
+        sys.exit(0)
+    if len(sys.argv) >= 3 and sys.argv[1] == "ingest":
+        # Uso: python contestacao.py ingest <pasta_com_textos_juridicos> [diretorio_do_indice]
+        LegalRetrievalIndex.build(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else LEGAL_INDEX_DIR)
+        sys.exit(0)
+    if not gemini_pool_instance: 
         print("*"*80 + "\nATENÇÃO: MODELO GEMINI NÃO CARREGADO. VERIFIQUE 'GEMINI_API_KEY' E LOGS.\n" + "*"*80)
     else:
         print(f"Modelo Gemini '{ACTUAL_MODEL_NAME_LOADED}' carregado. Aplicação pronta.")
         print(f"Sessões serão armazenadas em: {app.config['SESSION_FILE_DIR']}")
         print(f"Servidor Flask em http://127.0.0.1:{os.environ.get('PORT', 5000)}")
         print(f"Debug mode: {app.debug}. CTRL+C para sair.")
+    init_app(app)
+    warm_up_gemini_clients()
     app.run(debug=(os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'), host="0.0.0.0", port=int(os.environ.get('PORT', 5000)))
 
@@ -11,6 +11,9 @@ import re
 import html
 from markupsafe import escape
 import uuid
+import hashlib
+import threading
+from collections import OrderedDict
 
 # --- Configuração de Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -75,6 +78,8 @@ else: logger.critical("Configuração final: Modelo Gemini NÃO CARREGADO. Gera
 MAX_FILES = 5
 MAX_FILE_SIZE = 10 * 1024 * 1024
 ALLOWED_EXTENSIONS = {'pdf'}
+STATIC_ASSETS_URL_PREFIX = '/assets'
+STATIC_ASSETS_MAX_AGE = 365 * 24 * 3600 # Assets versionados pelo hash podem ficar um ano em cache
 # COOKIE_SAFE_LIMIT_BYTES não é mais necessário para os dados principais da sessão
 
 # --- Classes (MinutaGenerator, PDFProcessor, MinutaParser, HTMLGenerator) ---
@@ -309,7 +314,12 @@ class MinutaParser: # Mantida
             return {"CONTESTAÇÃO COMPLETA": minuta_text if minuta_text else "Nenhuma minuta ou erro."}
         return {"CONTESTAÇÃO COMPLETA": minuta_text}
 
-class HTMLGenerator: # Mantida
+class HTMLGenerator:
+    BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+    FORMAT_CACHE_SIZE = 64 # Minutas formatadas mantidas em memória (LRU)
+    _format_cache = OrderedDict()
+    _format_cache_lock = threading.Lock()
+    _static_assets = None
     @staticmethod
     def _escape_html_attribute(value):
         if not value: return ""
@@ -319,40 +329,68 @@ class HTMLGenerator: # Mantida
         if not text_content:
             return ""
 
+        # A mesma minuta é reexibida a cada GET/ajuste: o HTML formatado fica em cache pelo hash do conteúdo
+        digest = hashlib.sha256(text_content.encode('utf-8')).hexdigest()
+        with HTMLGenerator._format_cache_lock:
+            cached = HTMLGenerator._format_cache.get(digest)
+            if cached is not None:
+                HTMLGenerator._format_cache.move_to_end(digest)
+                return cached
+
         # Normaliza quebras de linha universais para \n primeiro
         processed_text = text_content.replace('\r\n', '\n').replace('\r', '\n')
-        
-        lines = processed_text.split('\n')
-        processed_lines = []
-
-        for line in lines:
-            # 1. Escapa a linha individualmente para neutralizar qualquer HTML
-            #    que a IA possa ter gerado naquela linha.
-            line_escaped = escape(line) # Usa escape de markupsafe
-
-            # 2. Converte **texto** para <strong>texto</strong> na linha já escapada.
-            #    Os asteriscos não são alterados por escape(), então re.sub os encontrará.
-            #    O conteúdo DENTRO dos ** (grupo \1) já foi escapado se continha HTML.
-            line_with_strong = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', line_escaped)
-            
-            processed_lines.append(line_with_strong)
-        
+
+        # 1. Escapa o texto inteiro de uma vez para neutralizar qualquer HTML que a IA possa ter gerado.
+        # 2. Converte **texto** para <strong>texto</strong> no texto já escapado. Como '.' não casa com
+        #    quebra de linha, o negrito continua restrito a uma linha, exatamente como no processamento linha a linha.
+        formatted = HTMLGenerator.BOLD_RE.sub(r'<strong>\1</strong>', str(escape(processed_text)))
+
         # Junta as linhas processadas com <br>\n
-        return "<br>\n".join(processed_lines)
+        formatted = formatted.replace('\n', '<br>\n')
+        with HTMLGenerator._format_cache_lock:
+            HTMLGenerator._format_cache[digest] = formatted
+            while len(HTMLGenerator._format_cache) > HTMLGenerator.FORMAT_CACHE_SIZE:
+                HTMLGenerator._format_cache.popitem(last=False)
+        return formatted
     @staticmethod
     def generate_page(minuta_data=None, erro_msg="", sucesso_msg="", filenames_processados=None, warnings=None): # Removido temp_text_file_id
         warnings = warnings or []; filenames_processados = filenames_processados or []
-        html_output_content = f"""
+        # CSS e JS não são mais embutidos: a página referencia os assets estáticos versionados pelo hash
+        assets = HTMLGenerator.static_assets()
+        html_output_content = "".join([
+            HTMLGenerator._page_head(assets["css_url"]),
+            HTMLGenerator._generate_messages(erro_msg, sucesso_msg, warnings),
+            HTMLGenerator._generate_upload_form(),
+            HTMLGenerator._generate_processed_files(filenames_processados),
+            HTMLGenerator._generate_minuta_display(minuta_data),
+            HTMLGenerator._page_footer(assets["js_url"]),
+        ])
+        return make_response(html_output_content)
+    @staticmethod
+    def _page_head(css_url):
+        return f"""
 <!DOCTYPE html><html lang="pt-BR"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>Gerador de Minutas de Contestação - PGE</title><style>{HTMLGenerator._get_css()}</style></head><body><div class="container">
+<title>Gerador de Minutas de Contestação - PGE</title><link rel="stylesheet" href="{css_url}"></head><body><div class="container">
 <header><h1>📋 Gerador de Minutas de Contestação</h1><p class="subtitle">PGE-MS - Automação Jurídica com IA</p></header>
-{HTMLGenerator._generate_messages(erro_msg, sucesso_msg, warnings)}
-{HTMLGenerator._generate_upload_form()}
-{HTMLGenerator._generate_processed_files(filenames_processados)}
-{HTMLGenerator._generate_minuta_display(minuta_data)} 
+"""
+    @staticmethod
+    def _page_footer(js_url):
+        return f"""
 <footer><p>LAB-PGE • Inovação e Tecnologia • {datetime.now().strftime('%Y')} Versão: FlaskSession</p></footer>
-</div><script>{HTMLGenerator._get_javascript()}</script></body></html>"""
-        return make_response(html_output_content)
+</div><script src="{js_url}"></script></body></html>"""
+    @classmethod
+    def static_assets(cls):
+        # Montados uma única vez por processo; o hash no nome permite cache "immutable" no navegador
+        if cls._static_assets is None:
+            assets = {"css_url": None, "js_url": None, "files": {}}
+            for kind, content, mimetype in (("css", cls._get_css(), "text/css"), ("js", cls._get_javascript(), "application/javascript")):
+                body = content.encode('utf-8')
+                digest = hashlib.sha256(body).hexdigest()[:16]
+                filename = f"minuta.{digest}.{kind}"
+                assets["files"][filename] = {"body": body, "mimetype": f"{mimetype}; charset=utf-8", "etag": f'"{digest}"'}
+                assets[f"{kind}_url"] = f"{STATIC_ASSETS_URL_PREFIX}/{filename}"
+            cls._static_assets = assets
+        return cls._static_assets
     @staticmethod
     def _get_css(): return """* { margin: 0; padding: 0; box-sizing: border-box; } /* ... seu CSS ... */ body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; line-height: 1.6; color: #333; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; } .container { max-width: 1200px; margin: 20px auto; padding: 20px; background: white; border-radius: 15px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); } header { text-align: center; margin-bottom: 30px; border-bottom: 3px solid #667eea; padding-bottom: 20px; } header h1 { color: #2c3e50; font-size: 2.5em; margin-bottom: 10px; } .subtitle { color: #7f8c8d; font-size: 1.1em; } .section { margin: 30px 0; padding: 25px; border-radius: 10px; } .upload-section { background: #f8f9fa; border-left: 5px solid #28a745; } .minuta-content-display { white-space: pre-wrap; font-family: 'Courier New', monospace; padding: 20px; border: 2px solid #dee2e6; border-radius: 8px; background-color: #f8f9fa; min-height: 250px; max-height: 600px; overflow-y: auto; line-height: 1.5; text-align: justify; } .minuta-content-display strong { font-weight: bold; }  .minuta-section { background: #e9ecef; border-left: 5px solid #007bff; }  .adjust-section { background: #fff3cd; border-left: 5px solid #ffc107; }  h2 { color: #2c3e50; margin-bottom: 20px; font-size: 1.8em; } h3 { color: #495057; margin-bottom: 15px; font-size: 1.3em; } label { display: block; margin: 15px 0 8px 0; font-weight: 600; color: #495057; } input[type="file"], textarea { width: 100%; padding: 12px; border: 2px solid #dee2e6; border-radius: 8px; font-size: 14px; transition: border-color 0.3s ease; margin-bottom: 10px; } input[type="file"]:focus, textarea:focus { outline: none; border-color: #667eea; box-shadow: 0 0 0 3px rgba(102, 126, 234, 0.1); } .btn { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 12px 25px; border: none; border-radius: 8px; cursor: pointer; font-size: 16px; font-weight: 600; transition: transform 0.2s ease, box-shadow 0.2s ease; } .btn:hover { transform: translateY(-2px); box-shadow: 0 5px 15px rgba(0,0,0,0.2); } .btn:active { transform: translateY(0); } .alert { padding: 15px; margin: 20px 0; border-radius: 8px; font-weight: 500; word-wrap: break-word; } .alert-error { background: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; } .alert-success { background: #d4edda; color: #155724; border: 1px solid #c3e6cb; } .alert-warning { background: #fff3cd; color: #856404; border: 1px solid #ffeaa7; } .file-list { list-style: none; padding: 0; } .file-item { background: #e9ecef; padding: 10px 15px; margin: 8px 0; border-radius: 6px; border-left: 4px solid #28a745; display: flex; align-items: center; } .file-item::before { content: '📄'; margin-right: 10px; font-size: 1.2em; } .minuta-block { margin: 25px 0; border: none; border-radius: 10px; overflow: hidden; box-shadow: none; } .minuta-block h3 { background: linear-gradient(135deg, #007bff 0%, #0056b3 100%); color: white; padding: 15px 20px; margin: 0; font-size: 1.4em; border-top-left-radius: 8px; border-top-right-radius: 8px;} footer { text-align: center; margin-top: 50px; padding-top: 20px; border-top: 2px solid #dee2e6; color: #6c757d; } .loading { display: none; text-align: center; margin: 20px 0; } .spinner { border: 4px solid #f3f3f3; border-top: 4px solid #667eea; border-radius: 50%; width: 50px; height: 50px; animation: spin 1s linear infinite; margin: 0 auto; } @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } } @media (max-width: 768px) { .container { margin: 10px; padding: 15px; border-radius: 10px; } header h1 { font-size: 2em; } .section { padding: 20px; } }"""
     @staticmethod
@@ -430,6 +468,21 @@ def index():
         logger.error(f"Erro rota principal {request.url}: {e}", exc_info=True)
         return html_generator_instance.generate_page(erro_msg="Erro interno. Logs consultados.")
 
+@app.route(f"{STATIC_ASSETS_URL_PREFIX}/<path:filename>", methods=["GET"])
+def static_asset(filename):
+    # CSS/JS da página HTML: servidos da memória com cache de longa duração (o nome muda quando o conteúdo muda)
+    asset = html_generator_instance.static_assets()["files"].get(filename)
+    if not asset:
+        return html_generator_instance.generate_page(erro_msg="Página não encontrada (404)."), 404
+    if request.headers.get("If-None-Match") == asset["etag"]:
+        response = make_response("", 304)
+    else:
+        response = make_response(asset["body"])
+        response.headers["Content-Type"] = asset["mimetype"]
+    response.headers["Cache-Control"] = f"public, max-age={STATIC_ASSETS_MAX_AGE}, immutable"
+    response.headers["ETag"] = asset["etag"]
+    return response
+
 def _handle_get_request():
     logger.debug(f"GET {request.path}, Session ID: {session.sid if session.sid else 'N/A'}")
     minuta_disp_data = None
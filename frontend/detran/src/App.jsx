@@ -1,5 +1,6 @@
 // src/App.jsx
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
+import axios from 'axios';
 import Layout from './components/Layout';
 import UploadScreen from './components/UploadScreen';
 import ResultScreen from './components/ResultScreen';
@@ -7,12 +8,41 @@ import ResultScreen from './components/ResultScreen';
 // Caso contrário, se o index.css com Tailwind for suficiente, pode remover ou deixar vazio.
 // import './App.css'; 
 
+const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:5000';
+const INTERVALO_VERSAO_COMPLETA_MS = 5000; // Consulta do caso enquanto a versão completa é gerada
+
 function App() {
   const [minutaResult, setMinutaResult] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState('');
   const [processedFiles, setProcessedFiles] = useState([]);
   const [warnings, setWarnings] = useState([]); // Para avisos da API ou da aplicação
+  const [similarCases, setSimilarCases] = useState([]); // Casos anteriores semelhantes (histórico do backend)
+  const [casoId, setCasoId] = useState(null); // Caso no backend: ajustes, aprovação e exportação o referenciam explicitamente
+  const [versao, setVersao] = useState(null); // Versão da minuta exibida (base dos deltas enviados pelo backend)
+  const [versaoCompletaPendente, setVersaoCompletaPendente] = useState(false); // Rascunho exibido; versão completa em geração
+
+  // No modo de rascunho rápido, consulta o caso até a versão completa ficar pronta e a troca pelo rascunho
+  useEffect(() => {
+    if (!versaoCompletaPendente || !casoId) return undefined;
+    const timer = setInterval(async () => {
+      try {
+        const { data } = await axios.get(`${API_BASE_URL}/casos/${casoId}`, { withCredentials: true });
+        if (data.versaoCompletaPendente) return;
+        setVersaoCompletaPendente(false);
+        if (data.erro) {
+          setWarnings(prev => [...prev, `${data.erro} O rascunho continua disponível.`]);
+        } else {
+          setMinutaResult(data.minutaGerada);
+          setVersao(data.versao);
+          setWarnings(prev => [...prev, 'A versão completa da minuta substituiu o rascunho.', ...(data.avisos || []), ...(data.avisosCitacoes || [])]);
+        }
+      } catch (err) {
+        console.error("Erro ao consultar a versão completa:", err);
+      }
+    }, INTERVALO_VERSAO_COMPLETA_MS);
+    return () => clearInterval(timer);
+  }, [versaoCompletaPendente, casoId]);
 
   // Chamado quando o backend retorna uma minuta (ou erro), tanto na geração inicial quanto no ajuste
   const handleMinutaResponse = (data) => {
@@ -20,6 +50,10 @@ function App() {
     if (data && data.success) { // Verifica se data e data.success existem
       setMinutaResult(data.minutaGerada);
       setProcessedFiles(data.filenamesProcessados || []);
+      if (data.casoId) setCasoId(data.casoId);
+      if (data.versao) setVersao(data.versao);
+      setVersaoCompletaPendente(Boolean(data.versaoCompletaPendente));
+      if (data.casosSimilares) setSimilarCases(data.casosSimilares); // O ajuste não reenvia esta lista
       setError(''); // Limpa erros anteriores
       setWarnings(data.warnings || []);
       // Scroll para o topo para ver a mensagem de sucesso/aviso
@@ -40,6 +74,10 @@ function App() {
     setError('');
     setProcessedFiles([]);
     setWarnings([]);
+    setSimilarCases([]);
+    setCasoId(null);
+    setVersao(null);
+    setVersaoCompletaPendente(false);
     setIsLoading(false); 
     // Aqui você poderia adicionar lógica para resetar o estado interno do UploadScreen,
     // por exemplo, limpando a lista de arquivos selecionados nele, se ele mantiver esse estado.
@@ -77,6 +115,10 @@ function App() {
         <ResultScreen 
           initialMinuta={minutaResult} 
           filenames={processedFiles}
+          similarCases={similarCases}
+          casoId={casoId}
+          versao={versao}
+          versaoCompletaPendente={versaoCompletaPendente}
           setIsLoading={setIsLoading}
           isLoading={isLoading}
           onNewAnalysis={handleNewAnalysis} // Para o botão "Gerar Nova Minuta" dentro de ResultScreen
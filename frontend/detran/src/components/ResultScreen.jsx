@@ -18,9 +18,27 @@ function simpleEscape(text) {
     .replace(/'/g, '&#39;');
 }
 
+// Aplica o delta de versões do backend (MinutaDelta): n > 0 mantém n linhas, n < 0 remove n linhas, lista insere linhas
+function aplicarDelta(textoBase, delta) {
+  const linhas = textoBase.split('\n');
+  const resultado = [];
+  let posicao = 0;
+  for (const op of delta) {
+    if (Array.isArray(op)) { resultado.push(...op); continue; }
+    if (op > 0) resultado.push(...linhas.slice(posicao, posicao + op));
+    posicao += Math.abs(op);
+  }
+  if (posicao !== linhas.length) throw new Error('Delta incompatível com a versão local.');
+  return resultado.join('\n');
+}
+
 const ResultScreen = ({ 
   initialMinuta, 
   filenames, 
+  similarCases,
+  casoId,
+  versao,
+  versaoCompletaPendente,
   setIsLoading, 
   isLoading, 
   onNewAnalysis, 
@@ -30,11 +48,63 @@ const ResultScreen = ({
 }) => {
   const [ajusteInstrucoes, setAjusteInstrucoes] = useState('');
   const [minutaAtual, setMinutaAtual] = useState(initialMinuta);
+  const [minutaAprovada, setMinutaAprovada] = useState(false);
+  const [exportando, setExportando] = useState(''); // Formato em exportação ('docx' | 'pdf')
 
   useEffect(() => {
     setMinutaAtual(initialMinuta); 
+    setMinutaAprovada(false); // Uma nova versão (ex.: após ajuste) precisa ser aprovada novamente
   }, [initialMinuta]);
 
+  // Marca a minuta atual como aprovada no histórico de casos do backend
+  const handleAprovarMinuta = async () => {
+    try {
+      const params = new URLSearchParams();
+      params.append('action', 'aceitar_minuta');
+      if (casoId) params.append('caso_id', casoId);
+      await axios.post(`${API_BASE_URL}/`, params, {
+        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+        withCredentials: true
+      });
+      setMinutaAprovada(true);
+    } catch (err) {
+      console.error("Erro ao aprovar minuta:", err);
+      setError(err.response?.data?.error || "Falha ao registrar a aprovação da minuta.");
+    }
+  };
+
+  // Solicita a exportação ao backend (gerada em segundo plano) e baixa o arquivo quando estiver pronto
+  const handleExportar = async (formato) => {
+    setExportando(formato);
+    try {
+      const params = new URLSearchParams();
+      params.append('formato', formato);
+      if (casoId) params.append('caso_id', casoId);
+      const { data } = await axios.post(`${API_BASE_URL}/minuta/exportar`, params, {
+        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+        withCredentials: true
+      });
+      let response;
+      for (let tentativa = 0; tentativa < 120; tentativa++) {
+        response = await axios.get(`${API_BASE_URL}${data.url}`, { responseType: 'blob', withCredentials: true });
+        if (response.status !== 202) break;
+        await new Promise(resolve => setTimeout(resolve, 1000));
+      }
+      if (!response || response.status !== 200) throw new Error('Tempo esgotado aguardando a exportação.');
+      const link = document.createElement('a');
+      link.href = URL.createObjectURL(response.data);
+      link.download = `contestacao.${formato}`;
+      document.body.appendChild(link);
+      link.click();
+      document.body.removeChild(link);
+      URL.revokeObjectURL(link.href);
+    } catch (err) {
+      console.error(`Erro ao exportar minuta (${formato}):`, err);
+      setError(err.message || `Falha ao exportar a minuta em ${formato.toUpperCase()}.`);
+    }
+    setExportando('');
+  };
+
   const handleCopyToClipboard = () => {
     const contentElement = document.getElementById('minuta-content-display-actual');
     if (!contentElement) {
@@ -100,6 +170,8 @@ const ResultScreen = ({
       const params = new URLSearchParams();
       params.append('action', 'ajustar_minuta');
       params.append('instrucoes_ajuste', ajusteInstrucoes);
+      if (casoId) params.append('caso_id', casoId);
+      if (casoId && versao) params.append('versao_base', versao); // O backend responde só com o delta sobre esta versão
 
       const response = await axios.post(
         `${API_BASE_URL}/`,
@@ -110,7 +182,18 @@ const ResultScreen = ({
         }
       );
 
-      onMinutaAdjusted(response.data);
+      const data = response.data;
+      if (data.success && data.delta) {
+        try {
+          data.minutaGerada = aplicarDelta(minutaAtual, data.delta);
+          if (Array.from(data.minutaGerada).length !== data.caracteres) throw new Error('Tamanho divergente após aplicar o delta.');
+        } catch (deltaErr) {
+          console.warn("Delta não aplicável; buscando a versão completa:", deltaErr);
+          const { data: completa } = await axios.get(`${API_BASE_URL}/casos/${casoId}/versoes/${data.versao}`, { withCredentials: true });
+          data.minutaGerada = completa.minutaGerada;
+        }
+      }
+      onMinutaAdjusted(data);
       if (response.data.success) {
         setAjusteInstrucoes('');
       }
@@ -157,6 +240,25 @@ const ResultScreen = ({
             </div>
         )}
         
+        {similarCases && similarCases.length > 0 && (
+            <div className="mb-6 p-4 bg-dark-bg rounded-lg shadow">
+                <h3 className="text-lg font-medium text-dark-text-primary">Casos anteriores semelhantes:</h3>
+                <ul className="list-disc list-inside text-dark-text-secondary ml-4 mt-1">
+                    {similarCases.map(caso => (
+                      <li key={caso.id}>
+                        {(caso.arquivos || []).join(', ')} — {Math.round(caso.similaridade * 100)}% ({new Date(caso.data).toLocaleDateString('pt-BR')}){caso.aceita ? ' • minuta aprovada' : ''}
+                      </li>
+                    ))}
+                </ul>
+            </div>
+        )}
+
+        {versaoCompletaPendente && (
+            <div className="mb-4 p-4 bg-dark-bg border border-pge-ciano rounded-lg text-dark-text-secondary animate-pulse">
+                Rascunho rápido. A versão completa está sendo redigida e substituirá este texto automaticamente.
+            </div>
+        )}
+
         <div 
             id="minuta-content-display-actual" 
             className="prose prose-sm sm:prose-base prose-invert max-w-none p-4 sm:p-6 bg-dark-bg border border-gray-700 rounded-md min-h-[400px] max-h-[70vh] overflow-y-auto text-justify shadow-inner"
@@ -173,6 +275,25 @@ const ResultScreen = ({
           >
             Copiar Texto da Minuta
           </button>
+          <button
+            onClick={handleAprovarMinuta}
+            type="button"
+            disabled={minutaAprovada || versaoCompletaPendente}
+            className="ml-4 px-8 py-2.5 border border-pge-laranja text-pge-laranja font-semibold rounded-lg hover:bg-pge-laranja hover:text-dark-bg-secondary disabled:opacity-60 disabled:cursor-not-allowed transition-all duration-150 ease-in-out"
+          >
+            {minutaAprovada ? 'Minuta Aprovada' : 'Aprovar Minuta'}
+          </button>
+          {['docx', 'pdf'].map(formato => (
+            <button
+              key={formato}
+              onClick={() => handleExportar(formato)}
+              type="button"
+              disabled={exportando !== ''}
+              className="ml-4 px-6 py-2.5 border border-pge-ciano text-pge-ciano font-semibold rounded-lg hover:bg-pge-ciano hover:text-white disabled:opacity-60 disabled:cursor-not-allowed transition-all duration-150 ease-in-out"
+            >
+              {exportando === formato ? 'Exportando...' : `Baixar ${formato.toUpperCase()}`}
+            </button>
+          ))}
         </div>
 
         <div className="mt-12 pt-8 border-t border-gray-700">
@@ -195,7 +316,7 @@ const ResultScreen = ({
             <div className="mt-8 text-center">
               <button
                 type="submit"
-                disabled={isLoading}
+                disabled={isLoading || versaoCompletaPendente}
                 className="w-full sm:w-auto inline-flex justify-center items-center px-10 py-3 border border-transparent text-base font-semibold rounded-lg shadow-sm text-white 
                            bg-gradient-to-r from-pge-azul via-pge-ciano to-pge-azul hover:from-pge-azul hover:to-pge-ciano 
                            focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-offset-dark-bg focus:ring-pge-laranja 
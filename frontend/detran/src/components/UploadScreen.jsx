@@ -1,5 +1,5 @@
 // src/components/UploadScreen.jsx
-import React, { useState, useCallback } from 'react';
+import React, { useState, useCallback, useRef } from 'react';
 import { useDropzone } from 'react-dropzone';
 import axios from 'axios'; // Para chamadas HTTP
 
@@ -13,8 +13,74 @@ const UploadIcon = () => (
   </svg>
 );
 
+// Checksum SHA-256 em hexadecimal (crypto.subtle só existe em contexto seguro; sem ele o backend não confere o arquivo inteiro)
+const sha256Hex = async (buffer) => {
+  if (!window.crypto?.subtle) return null;
+  const digest = await window.crypto.subtle.digest('SHA-256', buffer);
+  return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
+// Envia um arquivo em partes (upload retomável). Retorna o uploadId; a extração do texto começa no backend
+// assim que o arquivo é concluído, enquanto os demais ainda estão sendo enviados.
+const enviarEmPartes = async (file, rascunhoId = null, tentativas = 3) => {
+  const opcoes = { withCredentials: true };
+  const initData = new FormData();
+  initData.append('nome_arquivo', file.name);
+  if (rascunhoId) initData.append('rascunho_id', rascunhoId); // O arquivo passa a fazer parte do rascunho do caso
+  initData.append('tamanho', String(file.size));
+  const checksum = await sha256Hex(await file.arrayBuffer());
+  if (checksum) initData.append('sha256', checksum);
+  const { data: upload } = await axios.post(`${API_BASE_URL}/uploads`, initData, opcoes);
+
+  for (let indice = 0; indice < upload.totalPartes; indice++) {
+    const parte = await file.slice(indice * upload.tamanhoParte, (indice + 1) * upload.tamanhoParte).arrayBuffer();
+    const parteChecksum = await sha256Hex(parte);
+    for (let tentativa = 1; ; tentativa++) {
+      try {
+        await axios.put(`${API_BASE_URL}/uploads/${upload.uploadId}/partes/${indice}`, parte, {
+          ...opcoes,
+          headers: { 'Content-Type': 'application/octet-stream', ...(parteChecksum ? { 'X-Chunk-Sha256': parteChecksum } : {}) },
+        });
+        break;
+      } catch (err) {
+        // Erros 4xx (exceto checksum divergente) não se resolvem reenviando a mesma parte
+        const status = err.response?.status;
+        if (tentativa >= tentativas || (status && status < 500 && status !== 422)) throw err;
+      }
+    }
+  }
+  await axios.post(`${API_BASE_URL}/uploads/${upload.uploadId}/concluir`, null, opcoes);
+  return upload.uploadId;
+};
+
+const INTERVALO_FILA_MS = 3000; // Consulta da posição na fila de geração enquanto a minuta não começa
+
 const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) => {
   const [files, setFiles] = useState([]);
+  const [usarCasoSimilar, setUsarCasoSimilar] = useState(false);
+  const [prazo, setPrazo] = useState(''); // Prazo da contestação (AAAA-MM-DD); vazio = lido da citação pelo backend
+  const [fila, setFila] = useState(null); // Posição e espera estimada na fila de geração do backend
+  const [statusEnvio, setStatusEnvio] = useState({}); // nome do arquivo -> 'enviando' | 'enviado' | 'erro'
+  const rascunhoRef = useRef(null); // Promise do id do rascunho do caso (criado na primeira seleção)
+  const uploadsRef = useRef({}); // nome do arquivo -> Promise do uploadId
+
+  // Cada PDF é enviado assim que selecionado; o backend extrai o texto enquanto o usuário escolhe os demais
+  const iniciarEnvio = useCallback((file) => {
+    if (!rascunhoRef.current) {
+      rascunhoRef.current = axios.post(`${API_BASE_URL}/rascunhos`, null, { withCredentials: true })
+        .then(({ data }) => data.rascunhoId)
+        .catch(err => { rascunhoRef.current = null; throw err; });
+    }
+    setStatusEnvio(prev => ({ ...prev, [file.name]: 'enviando' }));
+    const envio = rascunhoRef.current.then(rascunhoId => enviarEmPartes(file, rascunhoId));
+    uploadsRef.current[file.name] = envio;
+    envio
+      .then(() => setStatusEnvio(prev => ({ ...prev, [file.name]: 'enviado' })))
+      .catch(err => {
+        console.error(`Erro ao enviar ${file.name}:`, err);
+        setStatusEnvio(prev => ({ ...prev, [file.name]: 'erro' }));
+      });
+  }, []);
 
   const onDrop = useCallback(acceptedFiles => {
     const currentFileCount = files.length;
@@ -32,8 +98,12 @@ const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) =
         setError("Você pode enviar no máximo 5 arquivos no total. Alguns arquivos foram ignorados.");
     }
     // Adiciona os novos arquivos válidos, garantindo que não exceda 5
-    setFiles(prevFiles => [...prevFiles, ...pdfFiles].slice(0, 5));
-  }, [files, setError]); // Adicionado setError às dependências do useCallback
+    const novosArquivos = pdfFiles
+      .filter(file => !files.some(f => f.name === file.name))
+      .slice(0, 5 - currentFileCount);
+    setFiles(prevFiles => [...prevFiles, ...novosArquivos].slice(0, 5));
+    novosArquivos.forEach(iniciarEnvio);
+  }, [files, setError, iniciarEnvio]); // Adicionado setError às dependências do useCallback
 
   const { getRootProps, getInputProps, isDragActive, open } = useDropzone({
     onDrop,
@@ -46,6 +116,15 @@ const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) =
 
   const removeFile = (fileName) => {
     setFiles(prevFiles => prevFiles.filter(file => file.name !== fileName));
+    const envio = uploadsRef.current[fileName];
+    delete uploadsRef.current[fileName];
+    setStatusEnvio(prev => { const { [fileName]: _, ...resto } = prev; return resto; });
+    if (envio && rascunhoRef.current) {
+      // Retira o arquivo do rascunho para que não entre na geração
+      Promise.all([rascunhoRef.current, envio])
+        .then(([rascunhoId, uploadId]) => axios.delete(`${API_BASE_URL}/rascunhos/${rascunhoId}/arquivos/${uploadId}`, { withCredentials: true }))
+        .catch(err => console.error(`Erro ao remover ${fileName} do rascunho:`, err));
+    }
   };
 
   const handleSubmit = async (event) => {
@@ -56,14 +135,31 @@ const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) =
     }
     setIsLoading(true);
     setError(''); 
-
-    const formData = new FormData();
-    files.forEach(file => {
-      formData.append('pdfs', file); 
-    });
-    formData.append('action', 'upload_pdfs'); // O backend espera esta ação
+    // Id do pedido para acompanhar a posição na fila enquanto a requisição de geração aguarda
+    const pedidoId = window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    const consultaFila = setInterval(() => {
+      axios.get(`${API_BASE_URL}/fila/${pedidoId}`, { withCredentials: true })
+        .then(({ data }) => setFila(data))
+        .catch(() => setFila(null)); // 404: o pedido já saiu da fila
+    }, INTERVALO_FILA_MS);
 
     try {
+      // Os envios começaram na seleção; aqui só aguarda os que ainda não terminaram (reenviando os que falharam)
+      const uploadIds = await Promise.all(files.map(file => {
+        if (statusEnvio[file.name] === 'erro' || !uploadsRef.current[file.name]) iniciarEnvio(file);
+        return uploadsRef.current[file.name];
+      }));
+      const formData = new FormData();
+      formData.append('rascunho_id', await rascunhoRef.current);
+      formData.append('upload_ids', uploadIds.join(','));
+      formData.append('action', 'upload_pdfs'); // O backend espera esta ação
+      formData.append('rascunho_rapido', 'true'); // Rascunho curto na resposta; a versão completa chega depois
+      formData.append('pedido_id', pedidoId);
+      if (prazo) formData.append('prazo', prazo); // Casos com prazo mais próximo são gerados primeiro
+      if (usarCasoSimilar) {
+        formData.append('usar_caso_similar', 'true'); // Adapta a minuta aprovada de um caso anterior semelhante
+      }
+
       const response = await axios.post(
         `${API_BASE_URL}/`,
         formData,
@@ -87,6 +183,9 @@ const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) =
         error: errorMessage, 
         warnings: err.response?.data?.warnings 
       });
+    } finally {
+      clearInterval(consultaFila);
+      setFila(null);
     }
     // setIsLoading(false); // Movido para dentro de handleMinutaResponse em App.jsx
   };
@@ -138,7 +237,7 @@ const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) =
                     <svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 20 20" fill="currentColor" className="w-5 h-5 text-pge-laranja mr-2 flex-shrink-0">
                       <path fillRule="evenodd" d="M15.994 4.503a.75.75 0 00-.75-.75h-7.5a.75.75 0 000 1.5h7.5a.75.75 0 00.75-.75zM8.244 8.25a.75.75 0 000 1.5h7.5a.75.75 0 000-1.5h-7.5zM4.5 6.375a.75.75 0 01.75-.75h.008a.75.75 0 01.75.75v1.886c0 .48-.13.94-.372 1.342l-.243.405a.75.75 0 01-1.274-.764l.243-.405c.05-.083.076-.17.076-.26V6.375zm1.5 0A.75.75 0 004.5 5.625H3.75a.75.75 0 00-.75.75v10.5c0 .414.336.75.75.75h12.5a.75.75 0 00.75-.75V6.375a.75.75 0 00-.75-.75H6z" clipRule="evenodd" />
                     </svg>
-                    <span className="ml-1 flex-1 w-0 truncate text-dark-text-secondary">{file.name} <span className="text-xs text-gray-500">({(file.size / 1024).toFixed(1)} KB)</span></span>
+                    <span className="ml-1 flex-1 w-0 truncate text-dark-text-secondary">{file.name} <span className="text-xs text-gray-500">({(file.size / 1024).toFixed(1)} KB{statusEnvio[file.name] === 'enviando' ? ' · enviando...' : statusEnvio[file.name] === 'erro' ? ' · falha no envio' : ''})</span></span>
                   </div>
                   <div className="ml-4 flex-shrink-0">
                     <button 
@@ -155,6 +254,26 @@ const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) =
           </div>
         )}
 
+        <label className="mt-8 flex items-center text-sm text-dark-text-secondary">
+          <input
+            type="checkbox"
+            className="mr-2 rounded border-gray-600 bg-dark-bg text-pge-ciano focus:ring-pge-ciano"
+            checked={usarCasoSimilar}
+            onChange={(e) => setUsarCasoSimilar(e.target.checked)}
+          />
+          Usar como base a minuta aprovada de um caso anterior semelhante, se houver
+        </label>
+
+        <label className="mt-4 flex items-center text-sm text-dark-text-secondary">
+          Prazo da contestação (opcional):
+          <input
+            type="date"
+            className="ml-2 rounded border-gray-600 bg-dark-bg text-dark-text-primary focus:ring-pge-ciano"
+            value={prazo}
+            onChange={(e) => setPrazo(e.target.value)}
+          />
+        </label>
+
         <div className="mt-10 text-center">
           <button
             type="submit"
@@ -177,6 +296,11 @@ const UploadScreen = ({ onMinutaResponse, setIsLoading, isLoading, setError }) =
               'Analisar e Gerar Minuta'
             )}
           </button>
+          {isLoading && fila?.status === 'na_fila' && (
+            <p className="mt-3 text-sm text-dark-text-secondary">
+              Aguardando na fila de geração: posição {fila.posicao}, espera estimada de {Math.max(1, Math.round(fila.esperaEstimadaSegundos / 60))} min.
+            </p>
+          )}
         </div>
       </form>
     </div>
@@ -0,0 +1,42 @@
+import importlib.util
+import os
+import sys
+from contextlib import contextmanager
+
+from tests.test_pdfprocessor import import_backend_module
+
+# Os demais testes importam o backend com stubs de flask/werkzeug em sys.modules. Estes testes de rota usam o
+# Flask de verdade: os stubs saem de sys.modules enquanto o app real é carregado e usado, e voltam no final.
+STUBBED_PACKAGES = ("flask", "flask_session", "flask_cors", "werkzeug", "markupsafe", "cachelib")
+BACKEND_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend", "contestacao.py")
+_real_modules = {}
+
+
+def _stubbed(name):
+    return name.split(".")[0] in STUBBED_PACKAGES
+
+
+@contextmanager
+def real_flask_app(tmp_path, monkeypatch, **env):
+    import_backend_module() # Garante os stubs do google.generativeai: nenhuma chamada real ao Gemini
+    for key, value in {"TRACE_FILE": tmp_path / "traces.jsonl", "FLASK_SECRET_KEY": "teste", **env}.items():
+        monkeypatch.setenv(key, str(value))
+    saved = {name: module for name, module in sys.modules.items() if _stubbed(name)}
+    for name in saved:
+        del sys.modules[name]
+    sys.modules.update(_real_modules)
+    try:
+        spec = importlib.util.spec_from_file_location("contestacao_http", BACKEND_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.app.config["TESTING"] = True
+        # Bancos, pastas e sessões em tmp_path: nada é gravado em backend/
+        module.init_app(module.app, **{key: str(tmp_path / name) for key, name in {
+            "CASE_WORKSPACE_DB": "casos.sqlite3", "CASE_MEMORY_DB": "memoria.sqlite3", "USAGE_LEDGER_DB": "uso.sqlite3",
+            "DIGEST_CACHE_DB": "resumos.sqlite3", "UPLOAD_SPOOL_DIR": "spool", "EXPORT_CACHE_DIR": "exportacoes",
+            "CASE_FILES_DIR": "arquivos", "SESSION_FILE_DIR": "sessoes", "PROFILE_DIR": "perfis"}.items()})
+        yield module
+    finally:
+        for name in [name for name in sys.modules if _stubbed(name)]:
+            _real_modules[name] = sys.modules.pop(name)
+        sys.modules.update(saved)
@@ -0,0 +1,77 @@
+from tests.test_pdfprocessor import import_backend_module
+
+PETICAO = (
+    "O autor alega que não conduzia o veículo de placa ABC1234 na data da infração e que o verdadeiro "
+    "condutor era seu irmão, conforme declaração anexa. Requer a transferência dos pontos lançados em seu "
+    "prontuário, uma vez que perdeu o prazo administrativo para indicação do condutor previsto no art. 257 do CTB. "
+) * 3
+
+
+def test_fingerprint_ignores_extraction_markers():
+    module = import_backend_module()
+    original = f"=== ARQUIVO: inicial.pdf ===\n--- Pág 1 ---\n{PETICAO}"
+    quebra = PETICAO.index("Requer")
+    reexportado = f"=== ARQUIVO: inicial_pje.pdf ===\n--- Pág 1 ---\n{PETICAO[:quebra]}\n\n--- Pág 2 ---\n{PETICAO[quebra:]}"
+
+    similarity = module.TextFingerprint.similarity(
+        module.TextFingerprint.minhash(original), module.TextFingerprint.minhash(reexportado)
+    )
+
+    assert similarity > 0.9
+
+
+def test_find_similar_returns_closest_case(tmp_path):
+    module = import_backend_module()
+    store = module.CaseMemoryStore(str(tmp_path / "casos.sqlite3"))
+    similar_id = store.add_case(PETICAO, "minuta do caso semelhante", ["inicial.pdf"])
+    store.add_case("Ação de anulação de multa por estacionamento irregular em vaga de idoso. " * 5, "outra minuta", ["outro.pdf"])
+    store.mark_accepted(similar_id)
+
+    matches = store.find_similar(PETICAO.replace("ABC1234", "XYZ9876"))
+
+    assert [m["id"] for m in matches] == [similar_id]
+    assert matches[0]["accepted"] is True
+    assert store.get_case(similar_id)["minuta"] == "minuta do caso semelhante"
+
+
+def test_find_similar_respects_recency_window(tmp_path):
+    module = import_backend_module()
+    store = module.CaseMemoryStore(str(tmp_path / "casos.sqlite3"))
+    store.add_case(PETICAO, "minuta anterior", ["inicial.pdf"])
+
+    recentes = store.find_similar(PETICAO, min_similarity=module.DUPLICATE_UPLOAD_MIN_SIMILARITY, since=0)
+    futuros = store.find_similar(PETICAO, min_similarity=module.DUPLICATE_UPLOAD_MIN_SIMILARITY, since=module.time.time() + 60)
+
+    assert len(recentes) == 1 and recentes[0]["similarity"] == 1.0
+    assert futuros == []
+
+
+def test_fingerprint_ignores_additional_and_omitted_page_markers():
+    module = import_backend_module()
+    original = f"=== ARQUIVO: inicial.pdf ===\n--- Pág 1 ---\n{PETICAO}"
+    com_avisos = (f"=== ARQUIVO: inicial.pdf ===\n--- Pág 1 ---\n{PETICAO}\n"
+                  "--- Págs 2-40, 45 não extraídas (fora do orçamento de páginas) ---\n\n"
+                  "=== PÁGINAS ADICIONAIS: inicial.pdf ===\n--- Pág 41 ---\n")
+
+    assert module.TextFingerprint.tokens(com_avisos) == module.TextFingerprint.tokens(original)
+
+
+def test_duplicates_are_only_reused_from_the_owners_cases(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        memory_id = module.case_memory_instance.add_case(PETICAO, "MINUTA DA ANA", ["inicial.pdf"], owner="ana")
+        original_id = module.case_workspace_instance.create_case(PETICAO, ["inicial.pdf"], owner="ana", template="transferencia_pontos", deadline=1.8e9)
+        module.case_workspace_instance.link_memory_case(original_id, memory_id)
+        signature = module.TextFingerprint.minhash(PETICAO)
+
+        with module.app.test_request_context("/"):
+            module.session["usuario"] = "bruno"
+            assert module._find_recent_duplicate(PETICAO, signature) is None
+
+        with module.app.test_request_context("/"):
+            module.session["usuario"] = "ana"
+            duplicata = module._find_recent_duplicate(PETICAO, signature)
+            response, status = module._reuse_duplicate_case(duplicata, ["inicial_pje.pdf"], [])
+        caso = module.case_workspace_instance.get_case(response.get_json()["casoId"])
+        assert status == 200 and caso["minuta"] == "MINUTA DA ANA" and caso["owner"] == "ana"
+        assert (caso["template"], caso["prazo"]) == ("transferencia_pontos", 1.8e9)
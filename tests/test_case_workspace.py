@@ -0,0 +1,150 @@
+import os
+import types
+
+import pytest
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+def test_versions_are_kept_per_case_and_latest_is_current(tmp_path):
+    module = import_backend_module()
+    workspace = module.CaseWorkspace(str(tmp_path / "casos.sqlite3"))
+
+    case_a = workspace.create_case("PETIÇÃO A", ["a.pdf"], owner="ana")
+    case_b = workspace.create_case("PETIÇÃO B", ["b.pdf"], owner="ana")
+    assert workspace.get_case(case_a)["status"] == "gerando"
+    assert workspace.get_case(case_a)["minuta"] is None
+
+    assert workspace.add_version(case_a, "MINUTA A1", "geracao") == 1
+    assert workspace.add_version(case_b, "MINUTA B1", "geracao") == 1
+    assert workspace.add_version(case_a, "MINUTA A2", "ajuste", instructions="Mais curta") == 2
+
+    case = workspace.get_case(case_a)
+    assert (case["status"], case["version"], case["minuta"], case["texto"]) == ("pronto", 2, "MINUTA A2", "PETIÇÃO A")
+    assert workspace.get_version(case_a, 1)["minuta"] == "MINUTA A1"
+    assert [v["kind"] for v in workspace.list_versions(case_a)] == ["geracao", "ajuste"]
+    assert workspace.get_case(case_b)["minuta"] == "MINUTA B1"
+
+
+def test_status_and_listing_by_owner(tmp_path):
+    module = import_backend_module()
+    workspace = module.CaseWorkspace(str(tmp_path / "casos.sqlite3"))
+
+    case_id = workspace.create_case("PETIÇÃO", ["a.pdf"], owner="ana")
+    workspace.create_case("OUTRA", ["b.pdf"], owner="bruno")
+    workspace.set_status(case_id, "erro", "Erro: cota esgotada")
+
+    listed = workspace.list_cases("ana")
+    assert [c["id"] for c in listed] == [case_id]
+    assert (listed[0]["status"], listed[0]["error"], listed[0]["filenames"]) == ("erro", "Erro: cota esgotada", ["a.pdf"])
+    assert workspace.get_case("inexistente") is None
+
+
+def test_versions_are_stored_as_deltas_with_periodic_snapshots(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module, "VERSION_SNAPSHOT_INTERVAL", 3)
+    workspace = module.CaseWorkspace(str(tmp_path / "casos.sqlite3"))
+    case_id = workspace.create_case("PETIÇÃO", ["a.pdf"])
+
+    paragraphs = [f"Parágrafo {i} da fundamentação, com texto suficiente para pesar no armazenamento." for i in range(40)]
+    texts = []
+    for version in range(1, 6):
+        paragraphs[version * 3] = f"Parágrafo reescrito no ajuste {version}."
+        texts.append("\n".join(paragraphs))
+        workspace.add_version(case_id, texts[-1], "ajuste")
+
+    stored = workspace.list_versions(case_id)
+    assert [v["storage"] for v in stored] == ["completa", "delta", "delta", "completa", "delta"]
+    assert all(v["stored_chars"] < v["chars"] / 5 for v in stored if v["storage"] == "delta")
+    assert [workspace.get_version(case_id, v)["minuta"] for v in range(1, 6)] == texts
+    assert workspace.get_case(case_id)["minuta"] == texts[-1]
+
+
+def test_minuta_delta_roundtrip_and_base_mismatch():
+    module = import_backend_module()
+    old = "TÍTULO\nParágrafo A\nParágrafo B\nParágrafo C"
+    new = "TÍTULO\nParágrafo A\nParágrafo B revisto\nParágrafo C\nParágrafo D"
+
+    delta = module.MinutaDelta.diff(old, new)
+    assert delta == [2, -1, ["Parágrafo B revisto"], 1, ["Parágrafo D"]]
+    assert module.MinutaDelta.apply(old, delta) == new
+    with pytest.raises(ValueError):
+        module.MinutaDelta.apply("outra versão", delta)
+
+
+def test_cases_are_only_visible_to_their_owner_session(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        ana, bruno = module.app.test_client(), module.app.test_client()
+        assert ana.get("/casos").get_json()["casos"] == []
+        with ana.session_transaction() as sess:
+            sess["usuario"] = "ana"
+        case_id = module.case_workspace_instance.create_case("PETIÇÃO", ["a.pdf"], owner="ana")
+        module.case_workspace_instance.add_version(case_id, "MINUTA DA ANA", "geracao")
+
+        assert [c["casoId"] for c in ana.get("/casos").get_json()["casos"]] == [case_id]
+        assert ana.get(f"/casos/{case_id}").get_json()["minutaGerada"] == "MINUTA DA ANA"
+        assert ana.get(f"/minuta?caso_id={case_id}").status_code == 200
+
+        # Outro usuário, mesmo forjando o cabeçalho de usuário ou conhecendo o id, não vê o caso
+        assert bruno.get("/casos", headers={"X-Usuario": "ana"}).get_json()["casos"] == []
+        for url in (f"/casos/{case_id}", f"/casos/{case_id}/versoes/1", f"/minuta?caso_id={case_id}"):
+            response = bruno.get(url, headers={"X-Usuario": "ana"})
+            assert response.status_code == 404 and "MINUTA DA ANA" not in response.get_data(as_text=True)
+        response = bruno.post(f"/casos/{case_id}/aceitar")
+        assert response.status_code == 400 and response.get_json()["success"] is False
+
+
+def test_versions_are_served_as_deltas_over_http(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        client = module.app.test_client()
+        with client.session_transaction() as sess:
+            sess["usuario"] = "ana"
+        case_id = module.case_workspace_instance.create_case("PETIÇÃO", ["a.pdf"], owner="ana")
+        v1 = "\n".join(f"Parágrafo {n} da contestação, com a fundamentação correspondente." for n in range(40))
+        v2 = v1.replace("Parágrafo 7 da", "Parágrafo 7 revisto da")
+        module.case_workspace_instance.add_version(case_id, v1, "geracao")
+        module.case_workspace_instance.add_version(case_id, v2, "ajuste", instructions="Revise o parágrafo 7")
+
+        # O cliente já tem a versão 1: recebe só o delta, que aplicado sobre ela reconstrói a versão 2
+        parcial = client.get(f"/casos/{case_id}/versoes/2?desde=1").get_json()
+        assert "minutaGerada" not in parcial and parcial["versaoBase"] == 1 and parcial["caracteres"] == len(v2)
+        assert module.MinutaDelta.apply(v1, parcial["delta"]) == v2
+
+        # Versão base desconhecida ou inválida: texto completo
+        for desde in ("9", "abc", ""):
+            completa = client.get(f"/casos/{case_id}/versoes/2?desde={desde}").get_json()
+            assert completa["minutaGerada"] == v2 and "delta" not in completa
+
+        class AdjustModel:
+            def generate_content(self, contents, generation_config=None):
+                part = types.SimpleNamespace(text=v2 + "\nTermos em que pede deferimento.")
+                candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[part]))
+                return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate])
+        monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+        monkeypatch.setattr(module, "gemini_pool_instance", object())
+        monkeypatch.setattr(module, "minuta_generator_instance", module.MinutaGenerator(AdjustModel()))
+        v3 = v2 + "\nTermos em que pede deferimento."
+
+        ajuste = client.post(f"/casos/{case_id}/ajustar", data={"instrucoes_ajuste": "Inclua o fecho", "versao_base": "2"}).get_json()
+        assert ajuste["versao"] == 3 and ajuste["versaoBase"] == 2 and module.MinutaDelta.apply(v2, ajuste["delta"]) == v3
+        ajuste = client.post(f"/casos/{case_id}/ajustar", data={"instrucoes_ajuste": "Inclua o fecho", "versao_base": "99"}).get_json()
+        assert ajuste["versao"] == 4 and ajuste["minutaGerada"] == v3 and "delta" not in ajuste
+
+
+def test_stores_are_built_by_init_app_with_paths_from_config(tmp_path, monkeypatch):
+    from tests.real_flask import BACKEND_PATH, real_flask_app
+    backend_dir = os.path.dirname(BACKEND_PATH)
+    before = set(os.listdir(backend_dir))
+    module = import_backend_module()
+    assert module.case_workspace_instance is None and module.usage_ledger_instance is None
+
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        workspace = module.case_workspace_instance
+        assert workspace.db_path == str(tmp_path / "casos.sqlite3")
+        assert module.usage_ledger_instance.db_path == str(tmp_path / "uso.sqlite3")
+        module.init_app(module.app, CASE_WORKSPACE_DB=str(tmp_path / "outro.sqlite3")) # Já montado: não recria nada
+        assert module.case_workspace_instance is workspace
+        assert module.app.test_client().get("/casos").status_code == 200
+    assert set(os.listdir(backend_dir)) - before <= {"__pycache__"}
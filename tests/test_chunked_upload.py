@@ -0,0 +1,121 @@
+import hashlib
+
+import pytest
+
+from tests.test_pdfprocessor import import_backend_module
+
+PDF = b"%PDF-1.7\n" + b"conteudo do processo " * 40
+
+
+def test_chunks_are_assembled_in_order_and_extracted_on_complete(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.PDFProcessor, "extract_text_from_bytes",
+                        staticmethod(lambda name, content: (f"=== ARQUIVO: {name} ===\n{len(content)}\n", None)))
+    store = module.ChunkedUploadStore(str(tmp_path), chunk_size=256)
+    upload_id, meta = store.init_upload("peticao.pdf", len(PDF), hashlib.sha256(PDF).hexdigest(), owner="ana")
+
+    for index in reversed(range(meta["total_chunks"])):
+        if index == 1:
+            continue
+        store.put_chunk(upload_id, index, PDF[index * 256:(index + 1) * 256], "ana")
+    with pytest.raises(module.UploadRejected):
+        store.complete(upload_id, "ana")
+    assert 1 not in store.received_chunks(upload_id)
+
+    store.put_chunk(upload_id, 1, PDF[256:512], "ana")
+    assert store.complete(upload_id, "ana")["status"] == "concluido"
+    assert (tmp_path / upload_id / "file.pdf").read_bytes() == PDF
+
+    texto, filenames, errors = store.collect_extractions([upload_id], "ana")
+    assert texto == f"=== ARQUIVO: peticao.pdf ===\n{len(PDF)}\n"
+    assert filenames == ["peticao.pdf"] and errors == []
+
+
+def test_checksum_mismatch_and_bad_header_are_rejected(tmp_path):
+    module = import_backend_module()
+    store = module.ChunkedUploadStore(str(tmp_path), chunk_size=len(PDF))
+    upload_id, _ = store.init_upload("peticao.pdf", len(PDF), "0" * 64, owner="ana")
+
+    with pytest.raises(module.UploadRejected):
+        store.put_chunk(upload_id, 0, b"X" * len(PDF), "ana")
+    with pytest.raises(module.UploadRejected) as chunk_error:
+        store.put_chunk(upload_id, 0, PDF, "ana", chunk_sha256="0" * 64)
+    assert chunk_error.value.status_code == 422
+
+    store.put_chunk(upload_id, 0, PDF, "ana")
+    with pytest.raises(module.UploadRejected) as file_error:
+        store.complete(upload_id, "ana")
+    assert file_error.value.status_code == 422
+
+
+def test_draft_keeps_selection_order_and_drops_removed_files(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.PDFProcessor, "extract_text_from_bytes",
+                        staticmethod(lambda name, content: (f"=== ARQUIVO: {name} ===\n", None)))
+    store = module.ChunkedUploadStore(str(tmp_path), chunk_size=len(PDF))
+    draft_id = store.create_draft(owner="ana")
+
+    upload_ids = []
+    for name in ("peticao.pdf", "procuracao.pdf", "auto_infracao.pdf"):
+        upload_id, _ = store.init_upload(name, len(PDF), draft_id=draft_id, owner="ana")
+        upload_ids.append(upload_id)
+    for upload_id in reversed(upload_ids):
+        store.put_chunk(upload_id, 0, PDF, "ana")
+        store.complete(upload_id, "ana")
+    store.remove_from_draft(draft_id, upload_ids[1], "ana")
+
+    texto, filenames, errors = store.collect_extractions(store.draft_upload_ids(draft_id, "ana"), "ana")
+    assert filenames == ["peticao.pdf", "auto_infracao.pdf"] and errors == []
+    assert [f["status"] for f in store.draft_status(draft_id, "ana")] == ["pronto", "pronto"]
+    assert not (tmp_path / upload_ids[1]).exists()
+
+
+def test_uploads_and_drafts_are_only_visible_to_their_owner(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.PDFProcessor, "extract_text_from_bytes",
+                        staticmethod(lambda name, content: (f"=== ARQUIVO: {name} ===\n", None)))
+    store = module.ChunkedUploadStore(str(tmp_path), chunk_size=len(PDF))
+    draft_id = store.create_draft(owner="ana")
+    upload_id, _ = store.init_upload("peticao.pdf", len(PDF), draft_id=draft_id, owner="ana")
+
+    for owner in ("bruno", None):
+        for attempt in (lambda: store.status(upload_id, owner), lambda: store.put_chunk(upload_id, 0, PDF, owner),
+                        lambda: store.complete(upload_id, owner), lambda: store.draft_upload_ids(draft_id, owner),
+                        lambda: store.draft_status(draft_id, owner), lambda: store.remove_from_draft(draft_id, upload_id, owner),
+                        lambda: store.init_upload("outro.pdf", len(PDF), draft_id=draft_id, owner=owner)):
+            with pytest.raises(module.UploadRejected) as error:
+                attempt()
+            assert error.value.status_code == 404
+    store.put_chunk(upload_id, 0, PDF, "ana")
+    store.complete(upload_id, "ana")
+    texto, filenames, errors = store.collect_extractions([upload_id], "bruno")
+    assert texto == "" and filenames == [] and errors == ["Upload não encontrado ou expirado."]
+
+    # Remover de um rascunho só apaga uploads que pertencem a ele
+    other_draft = store.create_draft(owner="ana")
+    with pytest.raises(module.UploadRejected):
+        store.remove_from_draft(other_draft, upload_id, "ana")
+    assert store.status(upload_id, "ana")["status"] == "concluido"
+    assert store.draft_upload_ids(draft_id, "ana") == [upload_id]
+
+
+def test_upload_routes_check_the_session_owner(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        ana, bruno = module.app.test_client(), module.app.test_client()
+        draft_id = ana.post("/rascunhos").get_json()["rascunhoId"]
+        upload_id = ana.post("/uploads", data={"nome_arquivo": "peticao.pdf", "tamanho": len(PDF), "rascunho_id": draft_id}).get_json()["uploadId"]
+        assert ana.get(f"/uploads/{upload_id}").get_json()["partesRecebidas"] == []
+
+        assert bruno.get(f"/uploads/{upload_id}").status_code == 404
+        assert bruno.put(f"/uploads/{upload_id}/partes/0", data=PDF).status_code == 404
+        assert bruno.post(f"/uploads/{upload_id}/concluir").status_code == 404
+        assert bruno.get(f"/rascunhos/{draft_id}").status_code == 404
+        assert bruno.delete(f"/rascunhos/{draft_id}/arquivos/{upload_id}").status_code == 404
+        assert bruno.post("/uploads", data={"nome_arquivo": "outro.pdf", "tamanho": len(PDF), "rascunho_id": draft_id}).status_code == 404
+        gerado = bruno.post("/", data={"action": "upload_pdfs", "upload_ids": upload_id})
+        assert gerado.status_code == 400 and gerado.get_json()["warnings"] == ["Upload não encontrado ou expirado."]
+
+        assert ana.put(f"/uploads/{upload_id}/partes/0", data=PDF).status_code == 200
+        assert ana.post(f"/uploads/{upload_id}/concluir").get_json()["status"] == "concluido"
+        assert [f["uploadId"] for f in ana.get(f"/rascunhos/{draft_id}").get_json()["arquivos"]] == [upload_id]
@@ -0,0 +1,35 @@
+from tests.test_pdfprocessor import import_backend_module
+
+
+def test_unknown_and_malformed_citations_are_flagged():
+    module = import_backend_module()
+    checker = module.CitationChecker.load_if_available(module.CITATION_INDEX_PATH)
+    minuta = (
+        "Nos termos do art. 257, § 7º, do CTB e dos arts. 280 e 281 do Código de Trânsito Brasileiro, "
+        "bem como do art. 489 do CPC e do art. 165-A do CTB. O art. 400 do CTB afasta a autuação. "
+        "Resolução CONTRAN nº 918/2022; Resolução nº 1.918/2022 do CONTRAN; Resolução CONTRAN 619/2116. "
+        "Súmula 312 do STJ; Súmula 999/STJ; Súmula Vinculante 70. "
+        "REsp 1.234.567/MS; AgInt no AREsp 12.34.567/SP; REsp 123456/XX. Reitera-se o art. 400 do CTB."
+    )
+
+    issues = checker.check(minuta)
+
+    assert [issue["citacao"] for issue in issues] == [
+        "art. 400", "Resolução nº 1.918/2022 do CONTRAN", "Resolução CONTRAN 619/2116",
+        "Súmula 999/STJ", "Súmula Vinculante 70", "AgInt no AREsp 12.34.567/SP", "REsp 123456/XX",
+    ]
+    assert "não consta do índice do CTB" in issues[0]["motivo"]
+    assert "malformado" in issues[5]["motivo"]
+
+
+def test_citation_warnings_are_capped(monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module, "citation_checker_instance", module.CitationChecker({"ctb": {"intervalos": [[1, 10]]}}))
+    minuta = " ".join(f"Art. {n} do CTB." for n in range(11, 11 + module.CITATION_WARNINGS_MAX + 3))
+
+    warnings = module._citation_warnings(minuta)
+
+    assert len(warnings) == module.CITATION_WARNINGS_MAX + 1
+    assert warnings[0].startswith('Citação a conferir: "Art. 11"')
+    assert "mais 3 citações" in warnings[-1]
+    assert module._citation_warnings("Art. 5 do CTB.") == []
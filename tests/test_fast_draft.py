@@ -0,0 +1,87 @@
+import types
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+class TierModel:
+    def __init__(self, fail_full=False):
+        self.calls = []
+        self.fail_full = fail_full
+
+    def generate_content(self, contents, generation_config=None):
+        draft = "RASCUNHO RÁPIDO" in contents[0]
+        self.calls.append(("rascunho" if draft else "completa", generation_config["max_output_tokens"]))
+        if self.fail_full and not draft:
+            raise RuntimeError("timeout")
+        part = types.SimpleNamespace(text="RASCUNHO" if draft else "MINUTA COMPLETA")
+        candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[part]))
+        return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate])
+
+
+def setup(module, tmp_path, monkeypatch, model):
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    monkeypatch.setattr(module, "case_workspace_instance", module.CaseWorkspace(str(tmp_path / "casos.sqlite3"), str(tmp_path / "arquivos")))
+    monkeypatch.setattr(module, "usage_ledger_instance", module.UsageLedger(str(tmp_path / "uso.sqlite3")))
+    monkeypatch.setattr(module, "minuta_generator_instance", module.MinutaGenerator(model))
+    monkeypatch.setattr(module, "_remember_case", lambda *args, **kwargs: "memoria-1")
+    return module.case_workspace_instance
+
+
+def test_draft_uses_low_token_cap_and_full_version_replaces_it(tmp_path, monkeypatch):
+    module = import_backend_module()
+    model = TierModel()
+    workspace = setup(module, tmp_path, monkeypatch, model)
+    case_id = workspace.create_case("PETIÇÃO", ["a.pdf"])
+
+    draft = module.minuta_generator_instance.generate_draft("PETIÇÃO")
+    workspace.add_version(case_id, draft, "rascunho", status="gerando", duration_ms=150)
+    assert (workspace.get_case(case_id)["status"], workspace.get_case(case_id)["kind"]) == ("gerando", "rascunho")
+
+    module._generate_full_version(case_id, "PETIÇÃO", ["a.pdf"], None, None, None, None, "req-1")
+
+    case = workspace.get_case(case_id)
+    assert (case["status"], case["kind"], case["minuta"], case["memory_case_id"]) == ("pronto", "completa", "MINUTA COMPLETA", "memoria-1")
+    assert model.calls == [("rascunho", module.DRAFT_MAX_OUTPUT_TOKENS), ("completa", 60000)]
+    versions = workspace.list_versions(case_id)
+    assert [v["kind"] for v in versions] == ["rascunho", "completa"]
+    assert versions[0]["duration_ms"] == 150 and versions[1]["duration_ms"] is not None
+
+
+def test_failed_full_version_keeps_the_draft(tmp_path, monkeypatch):
+    module = import_backend_module()
+    workspace = setup(module, tmp_path, monkeypatch, TierModel(fail_full=True))
+    case_id = workspace.create_case("PETIÇÃO", ["a.pdf"])
+    workspace.add_version(case_id, "RASCUNHO", "rascunho", status="gerando")
+
+    module._generate_full_version(case_id, "PETIÇÃO", ["a.pdf"], None, None, None, None, "req-1")
+
+    case = workspace.get_case(case_id)
+    assert (case["status"], case["minuta"]) == ("pronto", "RASCUNHO")
+    assert "versão completa" in case["error"]
+
+
+def test_adjust_waits_for_the_full_version_over_http(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+        monkeypatch.setattr(module, "gemini_pool_instance", object()) # _require_model: o TierModel faz as chamadas
+        monkeypatch.setattr(module, "minuta_generator_instance", module.MinutaGenerator(TierModel()))
+        client = module.app.test_client()
+        with client.session_transaction() as sess:
+            sess["usuario"] = "ana"
+        case_id = module.case_workspace_instance.create_case("PETIÇÃO", ["a.pdf"], owner="ana")
+        module.case_workspace_instance.add_version(case_id, "RASCUNHO", "rascunho", status="gerando")
+
+        caso = client.get(f"/casos/{case_id}").get_json()
+        assert (caso["minutaGerada"], caso["rascunho"], caso["versaoCompletaPendente"]) == ("RASCUNHO", True, True)
+        ajuste = client.post(f"/casos/{case_id}/ajustar", data={"instrucoes_ajuste": "Mais curta"})
+        assert ajuste.status_code == 409
+        assert ajuste.get_json() == {"success": False, "casoId": case_id,
+                                     "error": "A versão completa desta minuta ainda está sendo gerada. Aguarde para solicitar ajustes."}
+
+        module._generate_full_version(case_id, "PETIÇÃO", ["a.pdf"], None, None, None, None, "req-1")
+
+        caso = client.get(f"/casos/{case_id}").get_json()
+        assert (caso["minutaGerada"], caso["rascunho"], caso["versaoCompletaPendente"], caso["versao"]) == ("MINUTA COMPLETA", False, False, 2)
+        ajuste = client.post(f"/casos/{case_id}/ajustar", data={"instrucoes_ajuste": "Mais curta"})
+        assert ajuste.status_code == 200 and ajuste.get_json()["versao"] == 3
@@ -0,0 +1,132 @@
+import threading
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+class FakeClientModel:
+    def __init__(self, name, gate=None, fail_with=None):
+        self.name = name
+        self.gate = gate
+        self.fail_with = fail_with
+        self.calls = 0
+        self.token_counts = 0
+
+    def generate_content(self, contents, generation_config=None):
+        self.calls += 1
+        if self.gate: self.gate.wait(5)
+        if self.fail_with: raise self.fail_with
+        return f"resposta de {self.name}"
+
+    def count_tokens(self, contents):
+        self.token_counts += 1
+
+
+def test_concurrent_calls_spread_over_clients_and_reuse_connections():
+    module = import_backend_module()
+    gate, created = threading.Event(), []
+    def factory(name):
+        created.append(FakeClientModel(name, gate))
+        return created[-1]
+    pool = module.GeminiClientPool("modelo", size=2, model_factory=factory)
+
+    threads = [threading.Thread(target=pool.generate_content, args=(["prompt"],)) for _ in range(3)]
+    for thread in threads: thread.start()
+    while pool.snapshot()["emUso"] < 3: pass
+    gate.set()
+    for thread in threads: thread.join(5)
+    assert pool.generate_content(["prompt"]) == "resposta de modelo"
+
+    snapshot = pool.snapshot()
+    assert len(created) == 2 and sorted(c.calls for c in created) == [2, 2]
+    assert snapshot["conexoesNovas"] == 2 and snapshot["conexoesReaproveitadas"] == 2
+    assert snapshot["chamadasCompartilhadas"] == 1 and snapshot["taxaReaproveitamento"] == 0.5
+
+
+def test_warm_up_connects_every_client_before_the_first_call():
+    module = import_backend_module()
+    created = []
+    pool = module.GeminiClientPool("modelo", size=3, model_factory=lambda name: created.append(FakeClientModel(name)) or created[-1])
+
+    pool.warm_up()
+    pool.generate_content(["prompt"])
+
+    assert [c.token_counts for c in created] == [1, 1, 1]
+    snapshot = pool.snapshot()
+    assert snapshot["aquecimentos"] == 3 and snapshot["conectados"] == 3
+    assert snapshot["conexoesNovas"] == 0 and snapshot["conexoesReaproveitadas"] == 1
+
+
+def test_broken_clients_are_replaced_and_fork_recreates_clients(monkeypatch):
+    module = import_backend_module()
+    class ServiceUnavailable(Exception): pass # Mesmo nome da exceção do google.api_core
+    created = []
+    def factory(name):
+        created.append(FakeClientModel(name, fail_with=ServiceUnavailable("503 UNAVAILABLE") if len(created) == 0 else None))
+        return created[-1]
+    pool = module.GeminiClientPool("modelo", size=1, model_factory=factory)
+
+    try:
+        pool.generate_content(["prompt"])
+        raise AssertionError("a falha deveria ser propagada")
+    except ServiceUnavailable:
+        pass
+    assert pool.generate_content(["prompt"]) == "resposta de modelo"
+    assert len(created) == 2 and pool.snapshot()["clientesDescartados"] == 1
+
+    monkeypatch.setattr(module.os, "getpid", lambda: -1) # Processo filho após fork
+    pool.generate_content(["prompt"])
+    assert len(created) == 3 and pool.snapshot()["clientesCriados"] == 3
+
+
+def test_import_does_not_connect_and_warm_up_is_explicit(monkeypatch):
+    module = import_backend_module()
+    pool = module.gemini_pool_instance
+    assert pool is not None and pool.snapshot()["clientesCriados"] == 0
+    assert not any(thread.name == "gemini-aquecimento" for thread in threading.enumerate())
+
+    started = []
+    monkeypatch.setattr(pool, "start_warm_up", lambda: started.append(True))
+    monkeypatch.setattr(module, "GEMINI_CLIENT_WARMUP", False)
+    module.warm_up_gemini_clients()
+    monkeypatch.setattr(module, "GEMINI_CLIENT_WARMUP", True)
+    module.warm_up_gemini_clients()
+    assert started == [True]
+
+
+def test_default_factory_falls_back_when_the_sdk_hides_its_client_config(monkeypatch, caplog):
+    import sys
+    import types
+    module = import_backend_module()
+    class SdkModel:
+        def __init__(self, name):
+            self._client = None
+    monkeypatch.setattr(module.genai, "GenerativeModel", SdkModel)
+    monkeypatch.setitem(sys.modules, "google.ai", types.ModuleType("google.ai"))
+    monkeypatch.setitem(sys.modules, "google.ai.generativelanguage", types.ModuleType("google.ai.generativelanguage"))
+    monkeypatch.setattr(module.genai, "client", types.ModuleType("google.generativeai.client"), raising=False) # Sem _client_manager
+    monkeypatch.setattr(module.GeminiClientPool, "_dedicated_client_warned", False)
+
+    pool = module.GeminiClientPool("modelo", size=2)
+    models = [pool.model_factory("modelo") for _ in range(2)]
+
+    assert all(isinstance(m, SdkModel) and m._client is None for m in models)
+    assert [r.message for r in caplog.records if "Cliente dedicado indisponível" in r.message] == [
+        "GeminiClientPool: Cliente dedicado indisponível (esta versão do SDK não expõe a configuração do cliente); usando o cliente padrão do SDK."]
+
+
+def test_the_pool_is_the_only_model_and_follows_the_api_key(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    constructed = []
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai, "GenerativeModel", lambda *args, **kwargs: constructed.append(args))
+
+    with real_flask_app(tmp_path, monkeypatch, GEMINI_API_KEY="") as app_module:
+        assert not hasattr(app_module, "model") and app_module.gemini_pool_instance is None
+        client = app_module.app.test_client()
+        assert "NÃO CARREGADO" in client.get("/").get_json()["model_status"]
+        assert client.post("/", data={"action": "upload_pdfs"}).status_code == 503
+
+    with real_flask_app(tmp_path, monkeypatch, GEMINI_API_KEY="chave") as app_module:
+        assert app_module.gemini_pool_instance.model_name == app_module.TARGET_MODEL_NAME_BASE
+        assert app_module.app.test_client().get("/").get_json()["model_status"].endswith("carregado")
+    assert constructed == [] # Nenhum GenerativeModel é criado na importação
@@ -0,0 +1,85 @@
+import types
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+class ScriptedModel:
+    # Devolve as respostas (texto, finish_reason) na ordem; None simula falha da chamada
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    def generate_content(self, contents, generation_config=None):
+        self.prompts.append(contents[0])
+        text, finish_reason = self.responses.pop(0)
+        if text is None:
+            raise RuntimeError("timeout")
+        parts = [types.SimpleNamespace(text=text)] if text else []
+        candidate = types.SimpleNamespace(finish_reason=finish_reason, content=types.SimpleNamespace(parts=parts))
+        return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate])
+
+
+def _generator(module, monkeypatch, responses):
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    model = ScriptedModel(responses)
+    return module.MinutaGenerator(model), model
+
+
+def test_truncated_output_is_continued_and_stitched(monkeypatch):
+    module = import_backend_module()
+    generator, model = _generator(module, monkeypatch, [
+        ("1. DOS FATOS\nO autor foi notificado da autuação em", 2),
+        ("notificado da autuação em 10/01/2024 e não indicou o condutor.\n2. DO DIREITO\nArt. 257", 2),
+        (" do CTB.\n3. DOS PEDIDOS", 1),
+    ])
+
+    minuta = generator._generate("PROMPT ORIGINAL", kind="geracao")
+
+    assert minuta == ("1. DOS FATOS\nO autor foi notificado da autuação em 10/01/2024 e não indicou o condutor.\n"
+                      "2. DO DIREITO\nArt. 257 do CTB.\n3. DOS PEDIDOS")
+    assert len(model.prompts) == 3
+    assert model.prompts[1].startswith("PROMPT ORIGINAL") and "O autor foi notificado da autuação em\n" in model.prompts[1]
+
+
+def test_partial_text_is_kept_when_continuation_stops(monkeypatch):
+    module = import_backend_module()
+    # O texto volta limpo; o corte é uma marca (is_truncated), não um aviso embutido na peça
+    generator, model = _generator(module, monkeypatch, [("Parte 1", 2), ("Parte 2", 2)])
+    minuta = generator._generate("PROMPT", continuations=1)
+    assert minuta == "Parte 1Parte 2" and module.MinutaGenerator.is_truncated(minuta)
+
+    generator, model = _generator(module, monkeypatch, [("Parte 1", 2), (None, None)])
+    minuta = generator._generate("PROMPT")
+    assert minuta == "Parte 1" and module.MinutaGenerator.is_truncated(minuta)
+
+    generator, model = _generator(module, monkeypatch, [("Rascunho", 2)])
+    minuta = generator._generate("PROMPT", continuations=0)
+    assert minuta == "Rascunho" and module.MinutaGenerator.is_truncated(minuta)
+    assert len(model.prompts) == 1
+
+    generator, model = _generator(module, monkeypatch, [("Completa", 1)])
+    assert not module.MinutaGenerator.is_truncated(generator._generate("PROMPT"))
+
+
+def test_truncation_without_text_is_still_an_error(monkeypatch):
+    module = import_backend_module()
+    generator, model = _generator(module, monkeypatch, [("", 2)])
+    assert generator._generate("PROMPT").startswith("Erro: Geração não concluída (Razão: MAX_TOKENS)")
+    assert len(model.prompts) == 1
+
+
+def test_truncation_is_stored_as_version_metadata(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        client = module.app.test_client()
+        with client.session_transaction() as sess:
+            sess["usuario"] = "ana"
+        case_id = module.case_workspace_instance.create_case("PETIÇÃO", ["a.pdf"], owner="ana")
+        minuta = module.MinutaGenerator.mark_truncated("1. DOS FATOS\nO autor")
+        module.case_workspace_instance.add_version(case_id, minuta, "geracao", truncated=module.MinutaGenerator.is_truncated(minuta))
+
+        caso = client.get(f"/casos/{case_id}").get_json()
+        assert caso["minutaGerada"] == "1. DOS FATOS\nO autor" and caso["minutaIncompleta"] is True
+        assert caso["avisos"] == [module.MinutaGenerator.TRUNCATION_WARNING] and caso["versoes"][0]["incompleta"] is True
+        versao = client.get(f"/casos/{case_id}/versoes/1").get_json()
+        assert versao["minutaGerada"] == "1. DOS FATOS\nO autor" and versao["minutaIncompleta"] is True
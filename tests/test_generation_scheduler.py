@@ -0,0 +1,71 @@
+import threading
+import time
+from datetime import datetime
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+def _wait_until(condition, timeout=5):
+    limit = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < limit
+        time.sleep(0.01)
+
+
+def test_pending_generations_run_earliest_deadline_first():
+    module = import_backend_module()
+    scheduler = module.GenerationScheduler(concurrency=1, initial_estimate=30)
+    release, order = threading.Event(), []
+    blocker = threading.Thread(target=scheduler.run, args=(release.wait,), kwargs={"case_id": "rotina"})
+    blocker.start()
+    _wait_until(lambda: scheduler.snapshot()["emExecucao"] == 1)
+
+    now = time.time()
+    threads = []
+    for case_id, deadline in (("sem_prazo", None), ("vence_amanha", now + 86400), ("vence_hoje", now + 3600)):
+        thread = threading.Thread(target=scheduler.run, args=(lambda c=case_id: order.append(c),),
+                                  kwargs={"deadline": deadline, "case_id": case_id, "ticket_id": f"pedido-{case_id}"})
+        thread.start()
+        threads.append(thread)
+    _wait_until(lambda: scheduler.snapshot()["naFila"] == 3)
+
+    urgente = scheduler.status(ticket_id="pedido-vence_hoje")
+    assert urgente["status"] == "na_fila" and urgente["posicao"] == 1 and 0 < urgente["esperaEstimadaSegundos"] <= 30
+    assert scheduler.status(case_id="sem_prazo")["posicao"] == 3
+    assert scheduler.status(case_id="sem_prazo")["esperaEstimadaSegundos"] > urgente["esperaEstimadaSegundos"]
+
+    release.set()
+    for thread in [blocker, *threads]:
+        thread.join(5)
+    assert order == ["vence_hoje", "vence_amanha", "sem_prazo"]
+    assert scheduler.status(ticket_id="pedido-vence_hoje") is None
+    assert "completa" in scheduler.snapshot()["duracaoMediaSegundos"]
+
+
+def test_queue_timeout_returns_error_without_running():
+    module = import_backend_module()
+    scheduler = module.GenerationScheduler(concurrency=1, queue_timeout=0.05)
+    release = threading.Event()
+    blocker = threading.Thread(target=scheduler.run, args=(release.wait,))
+    blocker.start()
+    _wait_until(lambda: scheduler.snapshot()["emExecucao"] == 1)
+
+    result = scheduler.run(lambda: "minuta")
+    release.set()
+    blocker.join(5)
+    assert result.startswith("Erro:")
+    assert scheduler.snapshot()["naFila"] == 0
+    assert scheduler.run(lambda: "minuta") == "minuta"
+
+
+def test_deadline_is_read_from_citation():
+    module = import_backend_module()
+    # Citação numa sexta-feira: 15 dias úteis contados a partir da segunda seguinte
+    texto = "Certifico que o DETRAN/MS foi citado em 06/09/2024, para contestar no prazo de 15 (quinze) dias."
+    assert datetime.fromtimestamp(module.GenerationScheduler.deadline_from_text(texto)).date().isoformat() == "2024-09-27"
+    # Sem prazo no mandado vale CONTESTACAO_PRAZO_DIAS_UTEIS
+    prazo = module.GenerationScheduler.deadline_from_text("Intimação realizada em 06/09/2024.", business_days=30)
+    assert datetime.fromtimestamp(prazo).date().isoformat() == "2024-10-18"
+    assert datetime.fromtimestamp(module.GenerationScheduler.deadline_from_text(
+        "Prazo final para contestação: 10/10/2024.")).date().isoformat() == "2024-10-10"
+    assert module.GenerationScheduler.deadline_from_text("Petição inicial sem datas.") is None
@@ -0,0 +1,102 @@
+import threading
+import time
+import types
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+class SlowModel:
+    def __init__(self, text, release=None):
+        self.text = text
+        self.release = release
+        self.calls = 0
+
+    def generate_content(self, **kwargs):
+        self.calls += 1
+        if self.release:
+            self.release.wait(5)
+        return self.text
+
+
+def test_hedge_wins_when_primary_is_stuck():
+    module = import_backend_module()
+    release = threading.Event()
+    hedger = module.HedgedModelCaller(SlowModel("hedge"), initial_delay=0.05, budget_ratio=1.0)
+
+    assert hedger.call(SlowModel("principal", release), contents=["prompt"]) == "hedge"
+    release.set()
+    metrics = hedger.snapshot()
+    assert (metrics["hedges"], metrics["vitoriasHedge"], metrics["taxaVitoriaHedge"]) == (1, 1, 1.0)
+
+
+def test_budget_cap_blocks_extra_calls():
+    module = import_backend_module()
+    release = threading.Event()
+    backup = SlowModel("hedge")
+    hedger = module.HedgedModelCaller(backup, initial_delay=0.01, budget_ratio=0.0)
+
+    threading.Timer(0.1, release.set).start()
+    assert hedger.call(SlowModel("principal", release), contents=["prompt"]) == "principal"
+    assert backup.calls == 0
+    assert hedger.snapshot()["hedgesNegadosOrcamento"] == 1
+
+
+def test_delay_follows_recent_latency_percentile():
+    module = import_backend_module()
+    hedger = module.HedgedModelCaller(initial_delay=30, min_delay=0.5, percentile=0.9, min_samples=5)
+
+    assert hedger.hedge_delay() == 30
+    hedger._latencies.extend([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+    assert hedger.hedge_delay() == 10
+
+
+class UsageSlowModel(SlowModel):
+    def generate_content(self, **kwargs):
+        text = super().generate_content(**kwargs)
+        candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[types.SimpleNamespace(text=text)]))
+        usage = types.SimpleNamespace(prompt_token_count=1000, candidates_token_count=200, total_token_count=1200)
+        return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate], usage_metadata=usage)
+
+
+def test_first_hedge_is_allowed_and_budget_uses_a_sliding_window():
+    module = import_backend_module()
+    hedger = module.HedgedModelCaller(SlowModel("hedge"), initial_delay=0.01, budget_ratio=0.1, window=20, min_samples=1000)
+    def stuck_call():
+        release = threading.Event()
+        threading.Timer(0.1, release.set).start()
+        return hedger.call(SlowModel("principal", release), contents=["prompt"])
+
+    assert stuck_call() == "hedge" # Com orçamento contado desde o início, a 1ª chamada nunca teria hedge
+    assert stuck_call() == "principal"
+    assert (hedger.snapshot()["hedges"], hedger.snapshot()["hedgesNegadosOrcamento"]) == (1, 1)
+
+    # Quando o hedge sai da janela das últimas chamadas, há orçamento de novo
+    for _ in range(20):
+        hedger.call(SlowModel("principal"), contents=["prompt"])
+    assert stuck_call() == "hedge"
+    assert hedger.snapshot()["hedges"] == 2
+
+
+def test_every_attempt_is_recorded_and_hedges_are_tagged(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    ledger = module.UsageLedger(str(tmp_path / "uso.sqlite3"), daily_budget=0)
+    registry = module.prompt_registry_instance
+    release = threading.Event()
+    hedger = module.HedgedModelCaller(UsageSlowModel("hedge"), initial_delay=0.05, budget_ratio=1.0)
+    generator = module.MinutaGenerator(UsageSlowModel("principal", release), hedger=hedger, usage_ledger=ledger, prompt_registry=registry)
+    before = {entry["id"]: entry for entry in registry.snapshot()}["auto_infracao"]
+
+    assert generator.generate_minuta("PETIÇÃO", template_id="auto_infracao") == "hedge"
+    release.set() # A principal termina depois e é descartada, mas os tokens dela também foram cobrados
+    for _ in range(100):
+        with ledger._connect() as conn:
+            rows = conn.execute("SELECT hedge, total_tokens FROM usage ORDER BY hedge").fetchall()
+        if len(rows) == 2: break
+        time.sleep(0.02)
+
+    assert [tuple(row) for row in rows] == [(0, 1200), (1, 1200)]
+    [por_dia] = ledger.report("dia")
+    assert (por_dia["chamadas"], por_dia["tokens_total"], por_dia["hedges"]) == (2, 2400, 1)
+    after = {entry["id"]: entry for entry in registry.snapshot()}["auto_infracao"]
+    assert after["chamadas"] - before["chamadas"] == 2 and after["hedges"] - before.get("hedges", 0) == 1
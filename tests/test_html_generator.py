@@ -0,0 +1,28 @@
+from tests.test_pdfprocessor import import_backend_module
+
+
+def test_format_text_for_html_converts_bold_per_line():
+    module = import_backend_module()
+    html = module.HTMLGenerator.format_text_for_html("**DOS FATOS**\r\nLinha com **negrito** e\n**sem fechamento")
+
+    assert html == "<strong>DOS FATOS</strong><br>\nLinha com <strong>negrito</strong> e<br>\n**sem fechamento"
+
+
+def test_format_text_for_html_memoises_by_content():
+    module = import_backend_module()
+    generator = module.HTMLGenerator
+    generator._format_cache.clear()
+
+    first = generator.format_text_for_html("**CONTESTAÇÃO**")
+    second = generator.format_text_for_html("**CONTESTAÇÃO**")
+
+    assert first is second
+    assert len(generator._format_cache) == 1
+
+
+def test_static_assets_are_versioned_by_hash():
+    module = import_backend_module()
+    assets = module.HTMLGenerator.static_assets()
+
+    assert assets["css_url"].startswith("/assets/minuta.") and assets["css_url"].endswith(".css")
+    assert set(assets["files"]) == {assets["css_url"].rsplit("/", 1)[1], assets["js_url"].rsplit("/", 1)[1]}
@@ -0,0 +1,73 @@
+from tests.test_pdfprocessor import import_backend_module
+
+
+def test_choose_content_encoding_respects_quality():
+    module = import_backend_module()
+    assert module._choose_content_encoding("gzip, deflate") == "gzip"
+    assert module._choose_content_encoding("gzip;q=0, identity") is None
+    assert module._choose_content_encoding("") is None
+
+
+def test_if_none_match_accepts_compressed_variants():
+    module = import_backend_module()
+    tags = module._parse_if_none_match('W/"abc123-gzip", "def456-br", "789"')
+    assert tags == {"abc123", "def456", "789"}
+
+
+def _client_with_case(module, minuta):
+    client = module.app.test_client()
+    with client.session_transaction() as sess:
+        sess["usuario"] = "ana"
+    case_id = module.case_workspace_instance.create_case("PETIÇÃO", ["a.pdf"], owner="ana")
+    module.case_workspace_instance.add_version(case_id, minuta, "geracao")
+    return client, case_id
+
+
+def test_minuta_revalidation_and_compression_over_http(tmp_path, monkeypatch):
+    import gzip
+
+    import brotli
+
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        minuta = "CONTESTAÇÃO\n" + "O autor não comprovou a alegação. " * 200
+        client, case_id = _client_with_case(module, minuta)
+        url = f"/minuta?caso_id={case_id}"
+
+        plain = client.get(url, headers={"Accept-Encoding": "identity"})
+        assert plain.status_code == 200 and "Content-Encoding" not in plain.headers
+        assert plain.get_json()["minutaGerada"] == minuta and "Accept-Encoding" in plain.headers["Vary"]
+
+        gzipped = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert gzipped.headers["Content-Encoding"] == "gzip" and gzipped.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+        assert module.json.loads(gzip.decompress(gzipped.get_data()))["minutaGerada"] == minuta
+
+        brotlied = client.get(url, headers={"Accept-Encoding": "gzip, br"})
+        assert brotlied.headers["Content-Encoding"] == "br" and brotlied.headers["ETag"].endswith('-br"')
+        assert module.json.loads(brotli.decompress(brotlied.get_data()))["minutaGerada"] == minuta
+
+        # Revalidação com o ETag comprimido: 304 sem corpo, com o mesmo ETag e o mesmo Vary da resposta 200
+        not_modified = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["ETag"]})
+        assert not_modified.status_code == 304 and not_modified.get_data() == b""
+        assert not_modified.headers["ETag"] == gzipped.headers["ETag"] and not_modified.headers["Vary"] == gzipped.headers["Vary"]
+        assert "Content-Encoding" not in not_modified.headers
+
+        module.case_workspace_instance.add_version(case_id, minuta + "Termos em que pede deferimento.", "ajuste")
+        assert client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["ETag"]}).status_code == 200
+
+
+def test_passthrough_and_error_responses_are_not_compressed(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch, ADMIN_TOKEN="segredo") as module:
+        client = module.app.test_client()
+        (tmp_path / "perfis").mkdir(exist_ok=True)
+        (tmp_path / "perfis" / "upload.txt").write_text("ncalls tottime\n" * 500)
+
+        arquivo = client.get("/admin/perfis/upload.txt", headers={"Accept-Encoding": "gzip", "X-Admin-Token": "segredo"})
+        assert arquivo.status_code == 200 and "Content-Encoding" not in arquivo.headers
+        assert arquivo.get_data(as_text=True) == "ncalls tottime\n" * 500
+
+        monkeypatch.setattr(module, "COMPRESSION_MIN_BYTES", 1) # Mesmo um JSON de erro curto seria comprimido se fosse 200
+        erro = client.get("/casos/inexistente", headers={"Accept-Encoding": "gzip"})
+        assert erro.status_code == 404 and "Content-Encoding" not in erro.headers
+        assert erro.get_json()["success"] is False and "Accept-Encoding" in erro.headers["Vary"]
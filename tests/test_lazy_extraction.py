@@ -0,0 +1,75 @@
+from tests.test_pdfprocessor import import_backend_module
+
+
+def scan(filename, pages, tipo, chars_per_page=2000):
+    return {"filename": filename, "paginas": pages, "tipo": tipo, "metadados": {}, "caracteresPorPagina": chars_per_page}
+
+
+def test_preflight_sample_classifies_files():
+    module = import_backend_module()
+    classify = module.PDFProcessor.classify
+    assert classify("inicial.pdf", "EXCELENTÍSSIMO SENHOR JUIZ... DOS FATOS... DOS PEDIDOS", 12) == "peticao"
+    assert classify("doc3.pdf", "DECISÃO. Defiro a tutela. Intime-se.", 3) == "decisao"
+    assert classify("doc4.pdf", "EXTRATO DE PONTUAÇÃO - RENACH - histórico de infrações", 200) == "anexo"
+    assert classify("doc5.pdf", "", 200) == "anexo"
+    assert classify("doc6.pdf", "", 4) == "documento"
+
+
+def test_page_plan_prioritises_petition_and_limits_annexes(monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module, "PREFLIGHT_SAMPLE_PAGES", 3)
+    monkeypatch.setattr(module, "ANNEX_HEAD_PAGES", 5)
+    scans = [scan("extrato.pdf", 200, "anexo"), scan("inicial.pdf", 30, "peticao"), scan("decisao.pdf", 40, "decisao")]
+
+    extrato, inicial, decisao = module.PDFProcessor.plan_pages(scans, page_budget=60, char_budget=10**9)
+    assert inicial == list(range(30))
+    assert extrato == list(range(3)) # Amostra garantida; o orçamento acabou antes dos anexos
+    assert len(decisao) == 60 - 30 - 3
+
+    plan = module.PDFProcessor.plan_pages(scans, page_budget=1000, char_budget=50 * 2000)
+    assert len(plan[1]) == 30 and len(plan[0]) == 3
+    assert sum(len(pages) for pages in plan) == 50 # Limitado pelos caracteres estimados na amostra
+    assert module.PDFProcessor.page_ranges([5, 6, 7, 10]) == "6-8, 11"
+
+
+def test_files_with_the_same_name_keep_their_own_plan_and_deferred_pages(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module, "PREFLIGHT_SAMPLE_PAGES", 3)
+    monkeypatch.setattr(module, "ANNEX_HEAD_PAGES", 5)
+    scans = [scan("documento.pdf", 10, "peticao"), None, scan("documento.pdf", 200, "anexo")]
+    assert module.PDFProcessor.plan_pages(scans, page_budget=1000, char_budget=10**9) == [list(range(10)), None, list(range(5))]
+
+    workspace = module.CaseWorkspace(str(tmp_path / "casos.sqlite3"), str(tmp_path / "arquivos"))
+    case_id = workspace.create_case("PETIÇÃO", ["documento.pdf", "documento.pdf"])
+    workspace.store_deferred_files(case_id, [
+        {"filename": "documento.pdf", "tipo": "peticao", "paginas": 40, "omitidas": [30, 31], "content": b"%PDF-1"},
+        {"filename": "documento.pdf", "tipo": "anexo", "paginas": 200, "omitidas": [5, 6, 7], "content": b"%PDF-2"}])
+    workspace.update_omitted(case_id, 1, [7])
+
+    files = workspace.deferred_files(case_id)
+    assert [(f["position"], f["omitted"]) for f in files] == [(0, [30, 31]), (1, [7])]
+    assert [open(f["path"], "rb").read() for f in files] == [b"%PDF-1", b"%PDF-2"]
+
+
+def test_adjustment_requests_for_deferred_pages_are_detected():
+    module = import_backend_module()
+    assert module.DEFERRED_PAGES_RE.search("Considere as páginas 40 a 45 do extrato")
+    assert module.DEFERRED_PAGES_RE.search("use a fls. 12")
+    assert not module.DEFERRED_PAGES_RE.search("Deixe a conclusão mais objetiva")
+    assert module.PAGE_REFERENCE_RE.findall("págs. 40 a 45 e fl. 7") == [("40", "45"), ("7", "")]
+
+
+def test_page_references_are_bounded_and_scoped_to_the_named_file():
+    module = import_backend_module()
+    deferred = [{"position": 0, "filename": "extrato_renach.pdf", "omitted": list(range(3, 200))},
+                {"position": 1, "filename": "processo_adm.pdf", "omitted": list(range(5, 40))}]
+
+    pedidas = module._requested_pages("Considere as fls. 1 a 999999999 do extrato renach", deferred)
+    assert pedidas == {0: set(range(0, 200)), 1: set()}
+
+    pedidas = module._requested_pages("págs. 40 a 45 do extrato_renach e fl. 7 do processo adm", deferred)
+    assert pedidas == {0: set(range(39, 45)), 1: {6}}
+
+    assert module._requested_pages("págs. 10 a 12", deferred) == {0: {9, 10, 11}, 1: {9, 10, 11}}
+    assert module._requested_pages("fls. 0 e págs. 9 a 3", deferred) == {0: set(), 1: set()}
+    assert module._requested_pages("inclua os anexos", deferred) is None
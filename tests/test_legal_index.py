@@ -0,0 +1,44 @@
+import pytest
+
+from tests.test_pdfprocessor import import_backend_module
+
+pytest.importorskip("numpy")
+
+
+def build_index(module, tmp_path):
+    sources = tmp_path / "fontes"
+    sources.mkdir()
+    (sources / "ctb.txt").write_text(
+        "Art. 257, § 7º Não sendo imediata a identificação do infrator, o proprietário do veículo "
+        "terá quinze dias de prazo para apresentar o condutor infrator.",
+        encoding="utf-8",
+    )
+    (sources / "sumula.txt").write_text(
+        "Súmula 312 do STJ: no processo administrativo para imposição de multa de trânsito, "
+        "são necessárias as notificações da autuação e da aplicação da pena.",
+        encoding="utf-8",
+    )
+    (sources / "imagem.png").write_bytes(b"ignorado")
+    return module.LegalRetrievalIndex.build(str(sources), str(tmp_path / "indice"))
+
+
+def test_query_ranks_relevant_passage_first(tmp_path):
+    module = import_backend_module()
+    build_index(module, tmp_path)
+    index = module.LegalRetrievalIndex.load(str(tmp_path / "indice"))
+
+    results = index.query("perda do prazo para identificação do condutor infrator", top_k=2)
+
+    assert results[0]["source"] == "ctb.txt"
+    assert len(index.passages) == 2
+
+
+def test_prompt_includes_retrieved_passages(tmp_path):
+    module = import_backend_module()
+    generator = module.MinutaGenerator(None, legal_index=build_index(module, tmp_path))
+
+    passages = generator._retrieve_references("Notificação da autuação não recebida. Súmula do STJ.")
+    prompt = generator._build_prompt("texto da petição", passages=passages)
+
+    assert "Súmula 312" in prompt
+    assert "REFERÊNCIAS NORMATIVAS" in prompt
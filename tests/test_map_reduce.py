@@ -0,0 +1,70 @@
+import threading
+import types
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+class DigestModel:
+    def __init__(self, fail_on=None):
+        self.prompts = []
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+
+    def generate_content(self, contents, generation_config=None):
+        prompt = contents[0]
+        with self.lock:
+            self.prompts.append(prompt)
+        if "RESUMO ESTRUTURADO" in prompt:
+            if self.fail_on and self.fail_on in prompt:
+                raise RuntimeError("timeout")
+            text = "FATOS E DATAS: notificação em 10/01/2024."
+        else:
+            text = "**CONTESTAÇÃO**"
+        part = types.SimpleNamespace(text=text)
+        candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[part]))
+        return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate])
+
+
+def _processo(paginas=12, caracteres_por_pagina=1000):
+    anexo = "".join(f"--- Pág {i + 1} ---\n{'x' * caracteres_por_pagina}\n\n" for i in range(paginas))
+    return f"=== ARQUIVO: peticao.pdf ===\nDOS FATOS curtos.\n\n=== ARQUIVO: extrato.pdf ===\n{anexo}\n"
+
+
+def test_long_documents_are_split_between_pages():
+    module = import_backend_module()
+    blocks = module.MinutaGenerator.split_documents(_processo(), chunk_chars=5000, verbatim_chars=2000)
+
+    assert blocks[0] == {"label": "peticao.pdf", "text": "=== ARQUIVO: peticao.pdf ===\nDOS FATOS curtos.\n\n", "verbatim": True}
+    assert [b["label"] for b in blocks[1:]] == ["extrato.pdf, págs. 1-4", "extrato.pdf, págs. 5-8", "extrato.pdf, págs. 9-12"]
+    assert "".join(b["text"] for b in blocks) == _processo()
+
+
+def test_generation_uses_cached_digests(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    monkeypatch.setattr(module, "MAP_REDUCE_CHUNK_CHARS", 5000)
+    monkeypatch.setattr(module, "MAP_REDUCE_VERBATIM_CHARS", 2000)
+    model = DigestModel()
+    generator = module.MinutaGenerator(model, digest_cache=module.DocumentDigestCache(str(tmp_path / "resumos.sqlite3")))
+
+    assert generator.generate_minuta(_processo(), map_reduce=True) == "**CONTESTAÇÃO**"
+    digest_calls = [p for p in model.prompts if "RESUMO ESTRUTURADO" in p]
+    final_prompt = model.prompts[-1]
+    assert len(digest_calls) == 3
+    assert "=== RESUMO: extrato.pdf, págs. 5-8 ===\nFATOS E DATAS" in final_prompt
+    assert "DOS FATOS curtos." in final_prompt and "x" * 1000 not in final_prompt
+
+    model.prompts.clear()
+    generator.generate_minuta(_processo(), instructions="Mais curta", map_reduce=True)
+    assert len(model.prompts) == 1 # Ajuste sobre o mesmo processo: resumos vêm do cache
+
+
+def test_failed_digest_keeps_the_start_of_the_chunk(monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    monkeypatch.setattr(module, "MAP_REDUCE_VERBATIM_CHARS", 2000)
+    generator = module.MinutaGenerator(DigestModel(fail_on="extrato.pdf"))
+
+    reduced = generator.summarize_documents(_processo(paginas=3))
+
+    assert "=== TRECHO (sem resumo): extrato.pdf, págs. 1-3 ===\n=== ARQUIVO: extrato.pdf ===\n--- Pág 1 ---" in reduced
@@ -0,0 +1,56 @@
+import zipfile
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+def test_render_docx_marks_bold_runs(tmp_path):
+    module = import_backend_module()
+    path = tmp_path / "minuta.docx"
+
+    module.MinutaExporter.render_docx("**CONTESTAÇÃO**\nO autor <alega> que **não** conduzia.", str(path))
+
+    with zipfile.ZipFile(path) as zf:
+        document = zf.read("word/document.xml").decode("utf-8")
+        assert {"[Content_Types].xml", "_rels/.rels"} <= set(zf.namelist())
+    assert document.count("<w:p>") == 2
+    assert '<w:b/><w:sz w:val="24"/></w:rPr><w:t xml:space="preserve">CONTESTAÇÃO</w:t>' in document
+    assert "&lt;alega&gt;" in document
+
+
+def test_request_export_is_cached_by_minuta_hash(tmp_path):
+    module = import_backend_module()
+    exporter = module.MinutaExporter(str(tmp_path), max_workers=1)
+
+    digest, status = exporter.request_export("**MINUTA**", "docx")
+    exporter._jobs[(digest, "docx")].result(timeout=10)
+
+    assert status == "processando"
+    assert exporter.request_export("**MINUTA**", "docx") == (digest, "pronto")
+    assert exporter.status(digest, "docx") == "pronto"
+
+
+def test_cache_is_evicted_by_age_and_size_on_write(tmp_path):
+    import os
+    import time
+    module = import_backend_module()
+    exporter = module.MinutaExporter(str(tmp_path), max_workers=1, max_age_hours=1, max_mb=0.0003) # ~315 bytes
+    antigo = tmp_path / ("a" * 64 + ".pdf")
+    antigo.write_bytes(b"x" * 10)
+    os.utime(antigo, (time.time() - 7200, time.time() - 7200))
+    recente = tmp_path / ("b" * 64 + ".docx")
+    recente.write_bytes(b"x" * 300)
+    os.utime(recente, (time.time() - 60, time.time() - 60))
+
+    digest, _ = exporter.request_export("**MINUTA**", "docx")
+    exporter._jobs[(digest, "docx")].result(timeout=10)
+
+    # O arquivo recém-gravado fica; o vencido sai pela idade e o outro pelo tamanho total
+    assert sorted(os.listdir(tmp_path)) == [f"{digest}.docx"]
+    assert exporter.status("b" * 64, "docx") is None
+
+    # Removida do cache, a exportação volta a ser gerada no próximo pedido
+    os.remove(tmp_path / f"{digest}.docx")
+    assert exporter.status(digest, "docx") is None
+    assert exporter.request_export("**MINUTA**", "docx") == (digest, "processando")
+    exporter._jobs[(digest, "docx")].result(timeout=10)
+    assert exporter.status(digest, "docx") == "pronto"
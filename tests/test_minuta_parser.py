@@ -10,6 +10,8 @@ def prepare_stubs():
         def __init__(self, *a, **k):
             self.config = {}
             self.secret_key = None
+            self.wsgi_app = None
+            self.session_interface = None
         def route(self, *a, **k):
             def decorator(f):
                 return f
@@ -18,6 +20,12 @@ def prepare_stubs():
             def decorator(f):
                 return f
             return decorator
+        def after_request(self, f):
+            return f
+        def before_request(self, f):
+            return f
+        def teardown_request(self, f):
+            return f
     flask_stub.Flask = DummyFlask
     flask_stub.request = types.SimpleNamespace()
     flask_stub.jsonify = lambda *a, **k: None
@@ -25,6 +33,8 @@ def prepare_stubs():
     flask_stub.redirect = lambda *a, **k: None
     flask_stub.url_for = lambda *a, **k: ""
     flask_stub.make_response = lambda x: x
+    flask_stub.send_file = lambda *a, **k: None
+    flask_stub.Request = object
     flask_stub.g = types.SimpleNamespace()
     sys.modules.setdefault("flask", flask_stub)
 
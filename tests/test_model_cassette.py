@@ -0,0 +1,98 @@
+import os
+import sys
+import types
+
+import pytest
+
+from backend import benchmarks
+from tests.test_pdfprocessor import import_backend_module
+
+
+class EchoModel:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, contents, generation_config=None):
+        self.calls += 1
+        prompt = contents[0]
+        text = "**1. SÍNTESE DA DEMANDA**\n**2. FUNDAMENTAÇÃO JURÍDICA**\n**3. PEDIDOS**\nTermos em que pede deferimento."
+        candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[types.SimpleNamespace(text=text)]))
+        usage = types.SimpleNamespace(prompt_token_count=len(prompt) // 4, candidates_token_count=30)
+        return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate], usage_metadata=usage)
+
+
+def test_recorded_calls_are_replayed_offline(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    path = str(tmp_path / "cassetes" / "modelo.jsonl")
+    model = EchoModel()
+    recorder = module.ModelCassette(path, model=model, model_name="modelo")
+    recorder.case_id = "caso1"
+    recorded = module.MinutaGenerator(recorder).generate_minuta("Petição sobre radar.", mode="unica", template_id="auto_infracao")
+
+    player = module.ModelCassette(path, prefill_ms_per_1k_tokens=1000)
+    player.case_id = "caso1"
+    generator = module.MinutaGenerator(player)
+    assert generator.generate_minuta("Petição sobre radar.", mode="unica", template_id="auto_infracao") == recorded
+    assert model.calls == 1
+    assert player.calls[0]["reproducao"] == "exata" and player.calls[0]["etapa"] == "minuta"
+
+    # Variante com prompt maior: mesma resposta, tokens de entrada reestimados e latência com a leitura extra
+    player.reset()
+    assert generator.generate_minuta("Petição sobre radar. " + "x" * 4000, mode="unica", template_id="auto_infracao") == recorded
+    call, entry = player.calls[0], player.entries[0]
+    assert call["reproducao"] == "aproximada"
+    assert abs(call["tokensEntrada"] - entry["tokensEntrada"] - 1000) <= 2
+    assert abs(call["latenciaMs"] - entry["latenciaMs"] - 1000) <= 3
+
+
+def test_missing_recording_is_reported_as_error(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    player = module.ModelCassette(str(tmp_path / "vazio.jsonl"))
+    player.case_id = "caso1"
+
+    minuta = module.MinutaGenerator(player).generate_minuta("Petição.", mode="unica", template_id="auto_infracao")
+
+    assert minuta.startswith("Erro") and "sem gravação da etapa 'minuta'" in minuta
+    assert player.calls[0]["reproducao"] == "sem_gravacao"
+
+
+def test_stages_and_missing_headings():
+    module = import_backend_module()
+    generator = module.MinutaGenerator(None)
+    template = module.prompt_registry_instance.get("transferencia_pontos")
+    case_context = generator._build_case_context("Petição.")
+    assert module.ModelCassette.stage(generator._build_outline_prompt(case_context, template)) == "plano"
+    assert module.ModelCassette.stage(generator._build_section_prompt(template.sections[1], "PLANO", case_context, template)) == "secao 2.1"
+    assert module.ModelCassette.stage(generator._build_continuation_prompt(generator._build_prompt("Petição.", template=template), "Parte")) == "continuacao"
+
+    minuta = "**1. Relatório dos fatos**\n2. FUNDAMENTAÇÃO JURÍDICA\n2.1 Do mérito – aspectos materiais\n**3. PEDIDOS**"
+    assert template.missing_headings(minuta) == ["JURISPRUDÊNCIA CONSOLIDADA", "INSUFICIÊNCIA PROBATÓRIA DA MERA DECLARAÇÃO", "QUESTÕES PROBATÓRIAS"]
+
+
+def _avaliacao(monkeypatch, cassetes):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    monkeypatch.setattr(module.logger, "setLevel", lambda level: None)
+    monkeypatch.setitem(sys.modules, "contestacao", module)
+    return types.SimpleNamespace(corpus=os.path.join(benchmarks.PASTA_AVALIACAO, "corpus"), variantes=os.path.join(benchmarks.PASTA_AVALIACAO, "variantes.json"),
+                                 cassetes=cassetes, gravar=False, ms_por_mil_tokens_entrada=40.0, detalhes=False)
+
+
+def test_committed_cassettes_cover_every_variant_of_the_corpus(monkeypatch, capsys):
+    args = _avaliacao(monkeypatch, os.path.join(benchmarks.PASTA_AVALIACAO, "cassetes"))
+
+    benchmarks.bench_avaliacao(args)
+
+    report = capsys.readouterr().out
+    assert report.count("estrutura completa em 3/3 casos") == report.count("\nVariante '") == 3
+    assert "tokens de entrada: 0 " not in report and "US$ 0.0000" not in report
+
+
+def test_missing_cassette_entry_aborts_the_evaluation(tmp_path, monkeypatch):
+    args = _avaliacao(monkeypatch, str(tmp_path))
+
+    with pytest.raises(SystemExit) as exit_info:
+        benchmarks.bench_avaliacao(args)
+    assert "sem gravação de 01_transferencia_pontos (minuta)" in str(exit_info.value.code)
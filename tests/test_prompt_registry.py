@@ -0,0 +1,72 @@
+import os
+import types
+
+from tests.test_pdfprocessor import import_backend_module
+
+TEMPLATE = """---
+id: {id}
+versao: {versao}
+titulo: Teste
+palavras_chave: {palavras}
+max_tokens_saida: 8000
+---
+@@cabecalho
+CABEÇALHO {id} v{versao}
+@@secao 1
+SEÇÃO 1
+@@secao 2
+SEÇÃO 2
+@@diretrizes
+DIRETRIZES
+"""
+
+
+def test_bundled_templates_classify_detran_matters():
+    module = import_backend_module()
+    registry = module.PromptRegistry(module.PROMPTS_DIR)
+
+    def classify(text):
+        return registry.classify(text)[0].id
+
+    assert classify("Requer a transferência de pontos ao real condutor, pois perdeu o prazo de indicação do condutor (art. 257).") == "transferencia_pontos"
+    assert classify("Pede a anulação do auto de infração lavrado por radar sem aferição do INMETRO e sem dupla notificação (Súmula 312).") == "auto_infracao"
+    assert classify("O autor impugna o processo administrativo de suspensão do direito de dirigir e a entrega da CNH.") == "suspensao_cassacao"
+    assert classify("Fez a comunicação de venda (art. 134) e o veículo foi removido ao pátio, com cobrança de diárias.") == "registro_veiculo"
+    assert classify("Petição sem termos característicos.") == registry.default.id
+    assert len(registry.get("auto_infracao").static_prefix) < len(registry.default.static_prefix) / 2
+
+
+def test_latest_version_is_used_unless_pinned(tmp_path):
+    module = import_backend_module()
+    for versao in (1, 2):
+        (tmp_path / f"multa.v{versao}.md").write_text(TEMPLATE.format(id="multa", versao=versao, palavras="multa:2"), encoding="utf-8")
+    (tmp_path / "LEIAME.txt").write_text("ignorado", encoding="utf-8")
+
+    template = module.PromptRegistry(str(tmp_path), default_id="multa", pinned_versions={}).get("multa")
+    assert template.key == "multa.v2"
+    assert [key for key, _ in template.sections] == ["1", "2"]
+    assert template.static_prefix == "CABEÇALHO multa v2\nSEÇÃO 1\nSEÇÃO 2\nDIRETRIZES\n"
+    assert module.PromptRegistry(str(tmp_path), default_id="multa", pinned_versions={"multa": 1}).get("multa").key == "multa.v1"
+
+
+def test_stats_are_collected_per_template(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    (tmp_path / "multa.v1.md").write_text(TEMPLATE.format(id="multa", versao=1, palavras="multa:2"), encoding="utf-8")
+    registry = module.PromptRegistry(str(tmp_path), default_id="multa", pinned_versions={})
+    prompts, configs = [], []
+
+    class Model:
+        def generate_content(self, contents, generation_config=None):
+            prompts.append(contents[0]); configs.append(generation_config)
+            part = types.SimpleNamespace(text="MINUTA")
+            candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[part]))
+            usage = types.SimpleNamespace(prompt_token_count=300, candidates_token_count=100, total_token_count=400)
+            return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate], usage_metadata=usage)
+
+    generator = module.MinutaGenerator(Model(), prompt_registry=registry)
+    assert generator.generate_minuta("Multa indevida") == "MINUTA"
+
+    assert prompts[0].startswith("CABEÇALHO multa v1") and configs[0]["max_output_tokens"] == 8000
+    stats = registry.snapshot()[0]
+    assert (stats["id"], stats["chamadas"], stats["erros"], stats["tokensEntradaMedia"]) == ("multa", 1, 0, 300)
@@ -0,0 +1,54 @@
+from tests.test_pdfprocessor import import_backend_module
+
+
+def hello_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"ok"]
+
+
+def test_only_requests_with_token_are_profiled(tmp_path):
+    module = import_backend_module()
+    profiler = module.RequestProfiler(hello_app, profile_dir=str(tmp_path), token="segredo", sample_rate=0)
+    headers = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        headers.update(response_headers)
+
+    assert profiler({"PATH_INFO": "/minuta", "HTTP_X_PROFILE": "errado"}, start_response) == [b"ok"]
+    assert profiler.list_reports() == [] and "X-Profile-Report" not in headers
+
+    # Token na URL não vale: ficaria nos logs de acesso e no histórico do navegador
+    assert profiler({"PATH_INFO": "/minuta", "REQUEST_METHOD": "GET", "QUERY_STRING": "profile=segredo"}, start_response) == [b"ok"]
+    assert profiler.list_reports() == []
+
+    assert profiler({"PATH_INFO": "/minuta", "REQUEST_METHOD": "GET", "HTTP_X_PROFILE": "segredo"}, start_response) == [b"ok"]
+    reports = profiler.list_reports()
+    assert len(reports) == 1 and reports[0]["nome"].endswith("GET-minuta")
+    assert headers["X-Profile-Report"] == f"{reports[0]['nome']}.txt"
+    assert profiler.report_path(f"{reports[0]['nome']}.prof")
+    assert profiler.report_path("../segredo.txt") is None
+
+
+def test_old_reports_are_pruned(tmp_path):
+    module = import_backend_module()
+    profiler = module.RequestProfiler(hello_app, profile_dir=str(tmp_path), token="", sample_rate=1.0, max_reports=2)
+
+    for _ in range(4):
+        profiler({"PATH_INFO": "/"}, lambda *args: None)
+
+    assert len(profiler.list_reports()) == 2
+    assert len(list(tmp_path.iterdir())) == 4
+
+
+def test_admin_token_comes_only_from_its_own_header(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    with real_flask_app(tmp_path, monkeypatch, PROFILING_TOKEN="perfil") as module:
+        client = module.app.test_client()
+        # O token de perfilamento não abre a área administrativa
+        assert client.get("/admin/perfis", headers={"X-Admin-Token": "perfil"}).status_code == 403
+
+    with real_flask_app(tmp_path, monkeypatch, ADMIN_TOKEN="segredo") as module:
+        client = module.app.test_client()
+        assert client.get("/admin/uso?token=segredo").status_code == 403
+        assert client.get("/admin/uso", headers={"X-Admin-Token": "segredo"}).status_code == 200
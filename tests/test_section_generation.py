@@ -0,0 +1,49 @@
+import re
+import types
+
+from tests.test_pdfprocessor import import_backend_module
+
+REPEATED = "A presunção de legitimidade do auto de infração só cede diante de prova robusta e idônea do autor."
+
+
+def make_response(text):
+    part = types.SimpleNamespace(text=text)
+    candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[part]))
+    return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate])
+
+
+class SectionModel:
+    def __init__(self):
+        self.prompts = []
+
+    def generate_content(self, contents, generation_config=None):
+        prompt = contents[0]
+        self.prompts.append(prompt)
+        match = re.search(r"REDIGIR APENAS A SEÇÃO (\S+)", prompt)
+        if not match:
+            return make_response("FATOS ESSENCIAIS: autor pede transferência de pontos.")
+        return make_response(f"**SEÇÃO {match.group(1)}**\n{REPEATED}\nTexto próprio da seção {match.group(1)}.")
+
+
+def test_sections_are_generated_in_parallel_and_assembled_in_order(monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    model = SectionModel()
+
+    minuta = module.MinutaGenerator(model).generate_minuta("PETIÇÃO INICIAL", mode="secoes")
+
+    keys = [key for key, _ in module.prompt_registry_instance.default.sections]
+    assert len(model.prompts) == len(keys) + 1
+    assert [re.search(r"SEÇÃO (\S+)\*\*", line).group(1) for line in minuta.splitlines() if line.startswith("**SEÇÃO")] == keys
+    assert minuta.count(REPEATED) == 1
+    assert all("PETIÇÃO INICIAL" in prompt for prompt in model.prompts)
+
+
+def test_instructions_keep_single_call_mode(monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    model = SectionModel()
+
+    module.MinutaGenerator(model).generate_minuta("PETIÇÃO INICIAL", instructions="Mais curta", mode="secoes")
+
+    assert len(model.prompts) == 1
@@ -0,0 +1,38 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+def test_spans_nest_and_export_otlp_json(tmp_path):
+    module = import_backend_module()
+    trace_file = tmp_path / "traces.jsonl"
+    tracer = module.Tracer(exporter="file", file_path=str(trace_file), service_name="teste")
+
+    root, token = tracer.start_span("POST /", kind=2, traceparent=f"00-{'a' * 32}-{'b' * 16}-01")
+    with tracer.span("pdf.extracao", arquivo="peticao.pdf", paginas=3):
+        pass
+    tracer.end_span(root, token)
+
+    lines = [json.loads(line) for line in trace_file.read_text(encoding="utf-8").splitlines()]
+    spans = [line["resourceSpans"][0]["scopeSpans"][0]["spans"][0] for line in lines]
+    assert [span["name"] for span in spans] == ["pdf.extracao", "POST /"]
+    assert spans[1]["traceId"] == "a" * 32 and spans[1]["parentSpanId"] == "b" * 16
+    assert spans[0]["traceId"] == "a" * 32 and spans[0]["parentSpanId"] == spans[1]["spanId"]
+    assert {"key": "paginas", "value": {"intValue": "3"}} in spans[0]["attributes"]
+    assert lines[0]["resourceSpans"][0]["resource"]["attributes"][0]["value"] == {"stringValue": "teste"}
+    assert tracer.current_span() is None
+
+
+def test_bind_carries_span_and_request_id_into_threads():
+    module = import_backend_module()
+    tracer = module.Tracer(exporter="none")
+    token = module.request_id_var.set("req-123")
+    try:
+        with tracer.span("POST /") as root:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                seen = executor.submit(tracer.bind(lambda: (tracer.current_span(), module.request_id_var.get()))).result()
+    finally:
+        module.request_id_var.reset(token)
+
+    assert seen == (root, "req-123")
@@ -0,0 +1,54 @@
+import pytest
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+def test_validator_rejects_non_pdf_from_first_chunk():
+    module = import_backend_module()
+    validator = module.StreamingPDFValidator("peticao.pdf")
+
+    with pytest.raises(module.UploadRejected) as exc:
+        validator.write(b"PK\x03\x04" + b"\x00" * 2048)
+
+    assert "não é um PDF válido" in exc.value.message
+
+
+def test_validator_rejects_oversize_while_streaming():
+    module = import_backend_module()
+    validator = module.StreamingPDFValidator("processo.pdf", max_size=4096)
+    validator.write(b"%PDF-1.7\n" + b"0" * 3000)
+
+    with pytest.raises(module.UploadRejected) as exc:
+        validator.write(b"0" * 2000)
+
+    assert exc.value.status_code == 413
+
+
+def test_validator_accepts_small_pdf_and_keeps_content():
+    module = import_backend_module()
+    validator = module.StreamingPDFValidator("inicial.pdf")
+    validator.write(b"%PDF-1.4\n%%EOF")
+    validator.seek(0)
+
+    assert validator.read() == b"%PDF-1.4\n%%EOF"
+
+
+def test_bad_uploads_are_rejected_with_json_over_http(tmp_path, monkeypatch):
+    import io
+
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        client = module.app.test_client()
+        def upload(filename, content):
+            return client.post("/", data={"action": "upload_pdfs", "files": (io.BytesIO(content), filename)}, content_type="multipart/form-data")
+
+        disfarcado = upload("peticao.pdf", b"PK\x03\x04" + b"\x00" * 4096)
+        assert disfarcado.status_code == 400
+        assert disfarcado.get_json() == {"success": False, "error": "Arquivo 'peticao.pdf' não é um PDF válido.", "warnings": None}
+
+        extensao = upload("peticao.docx", b"%PDF-1.7\n")
+        assert extensao.status_code == 400 and extensao.get_json()["error"] == "Arquivo 'peticao.docx' não é um PDF válido."
+
+        grande = upload("processo.pdf", b"%PDF-1.7\n" + b"0" * module.MAX_FILE_SIZE)
+        assert grande.status_code == 413
+        assert grande.get_json()["success"] is False and "excede o limite de 10MB" in grande.get_json()["error"]
@@ -0,0 +1,88 @@
+import types
+
+from tests.test_pdfprocessor import import_backend_module
+
+
+class UsageModel:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, contents, generation_config=None):
+        self.calls += 1
+        part = types.SimpleNamespace(text="**CONTESTAÇÃO**")
+        candidate = types.SimpleNamespace(finish_reason=1, content=types.SimpleNamespace(parts=[part]))
+        usage = types.SimpleNamespace(prompt_token_count=1000, candidates_token_count=200, total_token_count=1200)
+        return types.SimpleNamespace(prompt_feedback=None, candidates=[candidate], usage_metadata=usage)
+
+
+def test_every_call_is_recorded_and_reported_by_case(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    ledger = module.UsageLedger(str(tmp_path / "uso.sqlite3"), daily_budget=0, price_input=1.0, price_output=10.0)
+    generator = module.MinutaGenerator(UsageModel(), usage_ledger=ledger)
+
+    request_token = module.request_id_var.set("req-1")
+    context_token = module.usage_context_var.set({"sessao": "s1", "usuario": "ana"})
+    try:
+        generator.generate_minuta("PETIÇÃO")
+        generator.generate_minuta("PETIÇÃO", instructions="Mais curta")
+    finally:
+        module.usage_context_var.reset(context_token)
+        module.request_id_var.reset(request_token)
+    ledger.assign_case("req-1", "caso-1")
+
+    [por_caso] = ledger.report("caso")
+    assert (por_caso["grupo"], por_caso["chamadas"], por_caso["tokens_total"]) == ("caso-1", 2, 2400)
+    assert por_caso["custo_usd"] == 2 * (1000 * 1.0 + 200 * 10.0) / 1_000_000
+    assert por_caso["nao_finalizadas"] == 0
+    assert ledger.report("dia")[0]["chamadas"] == 2
+
+
+def test_budget_is_checked_before_the_call(tmp_path, monkeypatch):
+    module = import_backend_module()
+    monkeypatch.setattr(module.genai.types, "GenerationConfig", lambda **kwargs: kwargs)
+    ledger = module.UsageLedger(str(tmp_path / "uso.sqlite3"), daily_budget=0, user_budgets={"ana": 2500})
+    model = UsageModel()
+    generator = module.MinutaGenerator(model, usage_ledger=ledger)
+
+    token = module.usage_context_var.set({"usuario": "ana"})
+    try:
+        assert not generator.generate_minuta("PETIÇÃO").startswith("Erro")
+        assert generator.generate_minuta("PETIÇÃO").startswith("Erro: Orçamento diário")
+    finally:
+        module.usage_context_var.reset(token)
+
+    assert model.calls == 1
+
+
+def test_usage_is_keyed_on_the_case_owner_not_on_client_headers(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        assert module.usage_context_var.get() is None
+        contexts = []
+        for usuario in (None, "dono-1"):
+            with module.app.test_request_context("/casos", headers={"X-Usuario": "ana"}):
+                if usuario: module.session["usuario"] = usuario
+                module.app.preprocess_request()
+                contexts.append(module.usage_context_var.get())
+                assert contexts[-1]["usuario"] == module._case_owner() == usuario
+                module.app.do_teardown_request()
+        assert contexts[0] is not contexts[1] and module.usage_context_var.get() is None
+
+        # O dono criado por uma rota que cria casos passa a valer para o uso da própria requisição
+        with module.app.test_request_context("/casos", method="POST"):
+            module.app.preprocess_request()
+            owner = module._case_owner(create=True)
+            assert owner and module.usage_context_var.get()["usuario"] == owner == module.session["usuario"]
+            module.app.do_teardown_request()
+
+
+def test_requests_without_a_session_do_not_create_session_files(tmp_path, monkeypatch):
+    from tests.real_flask import real_flask_app
+    with real_flask_app(tmp_path, monkeypatch) as module:
+        arquivos = lambda: sorted(path.name for path in (tmp_path / "sessoes").glob("*"))
+        inicial = arquivos() # Só o contador interno do cachelib
+        for url in ("/", "/casos", "/fila/pedido-inexistente", "/casos/inexistente"):
+            response = module.app.test_client().get(url)
+            assert response.status_code in (200, 404) and "Set-Cookie" not in response.headers
+        assert arquivos() == inicial and len(inicial) <= 1